@@ -0,0 +1,55 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from deepext_with_lightning.metrics.async_metric import AsyncMetric
+from deepext_with_lightning.metrics.object_detection import DetectionIoU, MeanAveragePrecision, COCO_IOU_THRESHOLDS
+from benchmark_scripts.benchmark_detection_metrics import generate_dummy_batch
+
+
+def build_dummy_model() -> nn.Module:
+    return nn.Sequential(nn.Conv2d(3, 32, 3, stride=2, padding=1), nn.ReLU(),
+                         nn.Conv2d(32, 64, 3, stride=2, padding=1), nn.ReLU(),
+                         nn.Conv2d(64, 64, 3, padding=1), nn.ReLU()).eval()
+
+
+def measure_validation(model: nn.Module, metrics, batches, image_size: int) -> float:
+    """
+    :return: Images per second of forward and metric update, including compute.
+    """
+    start = time.perf_counter()
+    with torch.no_grad():
+        for preds, targets in batches:
+            model(torch.rand(len(preds), 3, image_size, image_size))
+            for metric in metrics:
+                metric(preds, targets)
+    for metric in metrics:
+        metric.compute()
+    return sum([len(preds) for preds, _ in batches]) / (time.perf_counter() - start)
+
+
+parser = argparse.ArgumentParser(description='Benchmark of validation throughput with asynchronous metrics.')
+parser.add_argument('--batch_size', type=int, default=8, help='Batch size')
+parser.add_argument('--n_bboxes', type=int, default=100, help='Bounding box count by image')
+parser.add_argument('--n_classes', type=int, default=20, help='Number of classes')
+parser.add_argument('--n_batches', type=int, default=20, help='Number of validation batches')
+parser.add_argument('--image_size', type=int, default=128, help='Image size of dummy model input')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    batches = [generate_dummy_batch(args.batch_size, args.n_bboxes, args.n_classes) for _ in range(args.n_batches)]
+    model = build_dummy_model()
+
+    def build_metrics():
+        return [MeanAveragePrecision(args.n_classes, iou_thresholds=COCO_IOU_THRESHOLDS),
+                DetectionIoU(args.n_classes)]
+
+    model_only = measure_validation(model, [], batches, args.image_size)
+    sync_throughput = measure_validation(model, build_metrics(), batches, args.image_size)
+    async_throughput = measure_validation(model, [AsyncMetric(metric) for metric in build_metrics()], batches,
+                                          args.image_size)
+    print(f"forward only: {model_only:.1f} images/s")
+    print(f"sync metrics: {sync_throughput:.1f} images/s, async metrics: {async_throughput:.1f} images/s "
+          f"({async_throughput / sync_throughput:.2f}x)")
@@ -0,0 +1,64 @@
+import argparse
+import time
+from typing import List, Callable
+
+import numpy as np
+import torch
+
+from deepext_with_lightning.dataset import AdjustDetectionTensorCollator
+
+
+def legacy_resize_batch_bbox(batch_bboxes: List, padding_val: int = -1) -> torch.Tensor:
+    """
+    Previous implementation (float64 array filled by scalar) and conversion of EfficientDetector.training_step.
+    """
+    max_bbox = max(list(map(lambda bboxes: len(bboxes), batch_bboxes)))
+    new_batch_bboxes = np.ones([len(batch_bboxes), max_bbox, 5]) * padding_val
+    for i, bboxes in enumerate(batch_bboxes):
+        for j in range(len(batch_bboxes[i])):
+            new_batch_bboxes[i, j, 0] = batch_bboxes[i][j][0]
+            new_batch_bboxes[i, j, 1] = batch_bboxes[i][j][1]
+            new_batch_bboxes[i, j, 2] = batch_bboxes[i][j][2]
+            new_batch_bboxes[i, j, 3] = batch_bboxes[i][j][3]
+            new_batch_bboxes[i, j, 4] = batch_bboxes[i][j][4]
+    return torch.tensor(new_batch_bboxes).float()
+
+
+def generate_dummy_targets(batch_size: int, n_bboxes: int, random_state: np.random.RandomState,
+                           as_list: bool) -> List:
+    targets = []
+    for _ in range(batch_size):
+        bboxes = np.concatenate([random_state.rand(n_bboxes, 4) * 512, random_state.randint(0, 20, [n_bboxes, 1])],
+                                axis=1)
+        targets.append(bboxes.tolist() if as_list else bboxes)
+    return targets
+
+
+def measure(func: Callable[[List], torch.Tensor], batches: List[List]) -> float:
+    """
+    :return: Milliseconds by batch.
+    """
+    start = time.perf_counter()
+    for targets in batches:
+        func(targets)
+    return (time.perf_counter() - start) * 1000 / len(batches)
+
+
+parser = argparse.ArgumentParser(description='Benchmark of bounding box collation.')
+parser.add_argument('--batch_size', type=int, default=64, help='Batch size')
+parser.add_argument('--n_bboxes', type=int, default=100, help='Bounding box count by image')
+parser.add_argument('--n_batches', type=int, default=50, help='Number of batches')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    random_state = np.random.RandomState(0)
+    collator = AdjustDetectionTensorCollator()
+    for as_list in [True, False]:
+        batches = [generate_dummy_targets(args.batch_size, args.n_bboxes, random_state, as_list)
+                   for _ in range(args.n_batches)]
+        legacy_ms = measure(legacy_resize_batch_bbox, batches)
+        new_ms = measure(lambda targets: collator._resize_batch_bbox(targets)[0], batches)
+        for targets in batches[:3]:
+            assert torch.equal(legacy_resize_batch_bbox(targets), collator._resize_batch_bbox(targets)[0])
+        print(f"targets as {'list' if as_list else 'ndarray'}: legacy {legacy_ms:.2f} ms/batch, "
+              f"new {new_ms:.2f} ms/batch ({legacy_ms / new_ms:.1f}x)")
@@ -0,0 +1,128 @@
+import argparse
+import time
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from deepext_with_lightning.metrics.object_detection import DetectionIoU, RecallPrecision, MeanAveragePrecision, \
+    StreamingMeanAveragePrecision, calc_bbox_overlap_union_iou, calc_area, COCO_IOU_THRESHOLDS
+
+
+def generate_dummy_batch(batch_size: int, n_bboxes: int, n_classes: int, image_size: int = 512) \
+        -> Tuple[List[np.ndarray], np.ndarray]:
+    """
+    :return: predictions (batch size, N, 6), targets (batch size, N, 5)
+    """
+    preds, targets = [], np.full([batch_size, n_bboxes, 5], -1.)
+    for i in range(batch_size):
+        xy = np.random.uniform(0, image_size * 0.8, [n_bboxes, 2])
+        wh = np.random.uniform(10, image_size * 0.2, [n_bboxes, 2])
+        labels = np.random.randint(0, n_classes, [n_bboxes, 1])
+        targets[i] = np.concatenate([xy, xy + wh, labels], axis=1)
+        noise = np.random.normal(0, 8, [n_bboxes, 4])
+        pred = np.concatenate([targets[i, :, :4] + noise, labels, np.random.uniform(0, 1, [n_bboxes, 1])], axis=1)
+        preds.append(pred[np.argsort(-pred[:, 5])])
+    return preds, targets
+
+
+def legacy_detection_iou(preds: List[np.ndarray], targets: np.ndarray, n_classes: int):
+    for i in range(targets.shape[0]):
+        pred_by_class = [[] for _ in range(n_classes)]
+        for pred_bbox in preds[i]:
+            pred_by_class[int(pred_bbox[4])].append(pred_bbox)
+        total_area_by_classes = [0 for _ in range(n_classes)]
+        total_overlap_by_classes = [0 for _ in range(n_classes)]
+        is_label_appeared = [False for _ in range(n_classes)]
+        for bbox_annotation in targets[i]:
+            label = int(bbox_annotation[4])
+            total_area_by_classes[label] += calc_area(bbox_annotation)
+            for pred_bbox in pred_by_class[label]:
+                overlap, _, _ = calc_bbox_overlap_union_iou(pred_bbox, bbox_annotation)
+                total_overlap_by_classes[label] += overlap
+                if is_label_appeared[label]:
+                    continue
+                total_area_by_classes[label] += calc_area(pred_bbox)
+            is_label_appeared[label] = True
+
+
+def legacy_recall_precision(preds: List[np.ndarray], targets: np.ndarray, n_classes: int):
+    for i in range(targets.shape[0]):
+        pred_by_class = [[] for _ in range(n_classes)]
+        for pred_bbox in preds[i]:
+            pred_by_class[int(pred_bbox[4])].append(pred_bbox)
+        for bbox_annotation in targets[i]:
+            for pred_bbox in pred_by_class[int(bbox_annotation[4])]:
+                _, _, iou = calc_bbox_overlap_union_iou(pred_bbox, bbox_annotation)
+                if iou >= 0.5:
+                    break
+
+
+def legacy_mean_average_precision(preds: List[np.ndarray], targets: np.ndarray, n_classes: int):
+    for pred_bboxes, target_bboxes in zip(preds, targets):
+        detected_indices = []
+        for i in range(pred_bboxes.shape[0]):
+            pred_label = int(pred_bboxes[i][4])
+            for j in filter(lambda k: int(target_bboxes[k][4]) == pred_label and k not in detected_indices,
+                            range(target_bboxes.shape[0])):
+                _, _, iou = calc_bbox_overlap_union_iou(pred_bboxes[i], target_bboxes[j])
+                if iou >= 0.5:
+                    detected_indices.append(j)
+                    break
+
+
+def measure(func, n_iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n_iterations):
+        func()
+    return (time.perf_counter() - start) / n_iterations * 1000.
+
+
+parser = argparse.ArgumentParser(description='Benchmark of detection metrics update.')
+parser.add_argument('--batch_size', type=int, default=8, help='Batch size')
+parser.add_argument('--n_bboxes', type=int, default=50, help='Bounding box count by image')
+parser.add_argument('--n_classes', type=int, default=20, help='Number of classes')
+parser.add_argument('--n_iterations', type=int, default=20, help='Number of iterations')
+parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                    help='Device of padded tensor metrics')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    preds, targets = generate_dummy_batch(args.batch_size, args.n_bboxes, args.n_classes)
+
+    for metric_class, legacy_func in [(DetectionIoU, legacy_detection_iou),
+                                      (RecallPrecision, legacy_recall_precision),
+                                      (MeanAveragePrecision, legacy_mean_average_precision)]:
+        metric = metric_class(args.n_classes)
+        legacy_ms = measure(lambda: legacy_func(preds, targets, args.n_classes), args.n_iterations)
+        vectorized_ms = measure(lambda: metric.update(preds, targets), args.n_iterations)
+        print(f"{metric_class.__name__}: loop {legacy_ms:.2f}ms/batch, vectorized {vectorized_ms:.2f}ms/batch, "
+              f"{legacy_ms / vectorized_ms:.1f}x")
+
+    # All IoU thresholds are evaluated from the same IoU matrix.
+    single_metric = MeanAveragePrecision(args.n_classes)
+    coco_metric = MeanAveragePrecision(args.n_classes, iou_thresholds=COCO_IOU_THRESHOLDS)
+    single_ms = measure(lambda: single_metric.update(preds, targets), args.n_iterations)
+    coco_ms = measure(lambda: coco_metric.update(preds, targets), args.n_iterations)
+    print(f"MeanAveragePrecision IoU 0.5: {single_ms:.2f}ms/batch, "
+          f"IoU 0.5:0.95({len(COCO_IOU_THRESHOLDS)} thresholds): {coco_ms:.2f}ms/batch")
+
+    streaming_metric = StreamingMeanAveragePrecision(args.n_classes, iou_thresholds=COCO_IOU_THRESHOLDS)
+    streaming_ms = measure(lambda: streaming_metric.update(preds, targets), args.n_iterations)
+    print(f"StreamingMeanAveragePrecision IoU 0.5:0.95: {streaming_ms:.2f}ms/batch, "
+          f"histogram {streaming_metric.score_histogram.numel() * 8 / 1024 ** 2:.1f}MB, "
+          f"exact buffers {int(coco_metric.detection_count)} detections")
+    exact_result, streaming_result = coco_metric.compute(), streaming_metric.compute()
+    print(f"mAP exact {exact_result['map']:.5f}, streaming {streaming_result['map']:.5f}")
+
+    # Padded tensors stay on device.
+    device = torch.device(args.device)
+    padded_preds, padded_targets = torch.tensor(np.stack(preds), device=device), torch.tensor(targets, device=device)
+    for metric_class, kwargs in [(DetectionIoU, {}), (RecallPrecision, {}),
+                                 (MeanAveragePrecision, {"iou_thresholds": COCO_IOU_THRESHOLDS})]:
+        numpy_metric, tensor_metric = metric_class(args.n_classes, **kwargs), metric_class(args.n_classes, **kwargs)
+        numpy_metric.to(device), tensor_metric.to(device)
+        numpy_ms = measure(lambda: numpy_metric.update(preds, padded_targets), args.n_iterations)
+        tensor_ms = measure(lambda: (tensor_metric.update(padded_preds, padded_targets),
+                                     torch.cuda.synchronize() if device.type == "cuda" else None), args.n_iterations)
+        print(f"{metric_class.__name__}: numpy {numpy_ms:.2f}ms/batch, tensor({device.type}) {tensor_ms:.2f}ms/batch")
@@ -0,0 +1,158 @@
+import argparse
+import multiprocessing
+import resource
+import time
+from typing import Callable, Tuple
+
+import torch
+
+from deepext_with_lightning.models.object_detection.efficientdet.efficientdet_lib.models.losses import calc_iou, \
+    FocalLoss
+from deepext_with_lightning.models.object_detection.efficientdet.efficientdet_lib.models.module import Anchors
+
+
+def legacy_focal_loss(classifications, regressions, anchors, annotations):
+    """
+    Previous implementation (loop by image and dense -1/0/1 targets) with .cuda() replaced by device of inputs.
+    """
+    alpha = 0.25
+    gamma = 2.0
+    device = classifications.device
+    batch_size = classifications.shape[0]
+    classification_losses = []
+    regression_losses = []
+
+    anchor = anchors[0, :, :]
+
+    anchor_widths = anchor[:, 2] - anchor[:, 0]
+    anchor_heights = anchor[:, 3] - anchor[:, 1]
+    anchor_ctr_x = anchor[:, 0] + 0.5 * anchor_widths
+    anchor_ctr_y = anchor[:, 1] + 0.5 * anchor_heights
+
+    for j in range(batch_size):
+        classification = classifications[j, :, :]
+        regression = regressions[j, :, :]
+
+        bbox_annotation = annotations[j, :, :]
+        bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
+
+        if bbox_annotation.shape[0] == 0:
+            regression_losses.append(torch.tensor(0).float().to(device))
+            classification_losses.append(torch.tensor(0).float().to(device))
+            continue
+
+        classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
+        IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4])
+        IoU_max, IoU_argmax = torch.max(IoU, dim=1)
+
+        targets = torch.ones(classification.shape) * -1
+        targets = targets.to(device)
+        targets[torch.lt(IoU_max, 0.4), :] = 0
+        positive_indices = torch.ge(IoU_max, 0.5)
+        num_positive_anchors = positive_indices.sum()
+        assigned_annotations = bbox_annotation[IoU_argmax, :]
+        targets[positive_indices, :] = 0
+        targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
+
+        alpha_factor = torch.ones(targets.shape).to(device) * alpha
+        alpha_factor = torch.where(torch.eq(targets, 1.), alpha_factor, 1. - alpha_factor)
+        focal_weight = torch.where(torch.eq(targets, 1.), 1. - classification, classification)
+        focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
+        bce = -(targets * torch.log(classification) + (1.0 - targets) * torch.log(1.0 - classification))
+        cls_loss = focal_weight * bce
+        cls_loss = torch.where(torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape).to(device))
+        classification_losses.append(cls_loss.sum() / torch.clamp(num_positive_anchors.float(), min=1.0))
+
+        if positive_indices.sum() > 0:
+            assigned_annotations = assigned_annotations[positive_indices, :]
+            gt_widths = assigned_annotations[:, 2] - assigned_annotations[:, 0]
+            gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
+            gt_ctr_x = assigned_annotations[:, 0] + 0.5 * gt_widths
+            gt_ctr_y = assigned_annotations[:, 1] + 0.5 * gt_heights
+            gt_widths = torch.clamp(gt_widths, min=1)
+            gt_heights = torch.clamp(gt_heights, min=1)
+            targets = torch.stack((
+                (gt_ctr_x - anchor_ctr_x[positive_indices]) / anchor_widths[positive_indices],
+                (gt_ctr_y - anchor_ctr_y[positive_indices]) / anchor_heights[positive_indices],
+                torch.log(gt_widths / anchor_widths[positive_indices]),
+                torch.log(gt_heights / anchor_heights[positive_indices]))).t()
+            targets = targets / torch.Tensor([[0.1, 0.1, 0.2, 0.2]]).to(device)
+            regression_diff = torch.abs(targets - regression[positive_indices, :])
+            regression_loss = torch.where(torch.le(regression_diff, 1.0 / 9.0),
+                                          0.5 * 9.0 * torch.pow(regression_diff, 2), regression_diff - 0.5 / 9.0)
+            regression_losses.append(regression_loss.mean())
+        else:
+            regression_losses.append(torch.tensor(0).float().to(device))
+
+    return torch.stack(classification_losses).mean(dim=0, keepdim=True), \
+           torch.stack(regression_losses).mean(dim=0, keepdim=True)
+
+
+def generate_dummy_inputs(batch_size: int, image_size: int, n_classes: int, n_bboxes: int) -> Tuple:
+    anchors = Anchors()(torch.zeros(1, 3, image_size, image_size))
+    n_anchors = anchors.shape[1]
+    classifications = torch.rand(batch_size, n_anchors, n_classes, requires_grad=True)
+    regressions = torch.randn(batch_size, n_anchors, 4, requires_grad=True)
+    xy = torch.rand(batch_size, n_bboxes, 2) * image_size * 0.8
+    wh = torch.rand(batch_size, n_bboxes, 2) * image_size * 0.5 + 8
+    labels = torch.randint(0, n_classes, [batch_size, n_bboxes, 1]).float()
+    annotations = torch.cat([xy, (xy + wh).clamp(max=image_size), labels], dim=2)
+    # Padding like AdjustDetectionTensorCollator.
+    annotations[:, n_bboxes // 2:][torch.rand(batch_size, n_bboxes - n_bboxes // 2) < 0.5] = -1
+    return classifications, regressions, anchors, annotations
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+
+
+def measure(loss_func: Callable, inputs: Tuple, n_steps: int) -> Tuple[float, float]:
+    """
+    :return: Milliseconds by step (forward and backward), peak RSS (MB) increased by first step.
+    """
+    def step():
+        classification_loss, regression_loss = loss_func(*inputs)
+        (classification_loss + regression_loss).sum().backward()
+
+    rss_mb = _rss_mb()
+    step()
+    # ru_maxrss is KB on Linux. Later steps are not measured, because freed memory is not always returned to OS.
+    peak_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_mb, 0.)
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    return (time.perf_counter() - start) * 1000 / n_steps, peak_mb
+
+
+def measure_in_process(is_legacy: bool, args) -> Tuple[float, float]:
+    """
+    Measure in new process, so peak RSS is not affected by the other implementation.
+    """
+    torch.manual_seed(0)
+    torch.set_num_threads(args.n_threads)
+    inputs = generate_dummy_inputs(args.batch_size, args.image_size, args.n_classes, args.n_bboxes)
+    return measure(legacy_focal_loss if is_legacy else FocalLoss(), inputs, args.n_steps)
+
+
+parser = argparse.ArgumentParser(description='Benchmark of EfficientDet focal loss on CPU.')
+parser.add_argument('--batch_size', type=int, default=8, help='Batch size')
+parser.add_argument('--image_size', type=int, default=512, help='Image size')
+parser.add_argument('--n_classes', type=int, default=20, help='Number of classes')
+parser.add_argument('--n_bboxes', type=int, default=20, help='Max bounding box count by image')
+parser.add_argument('--n_steps', type=int, default=10, help='Number of measured steps')
+parser.add_argument('--n_threads', type=int, default=1, help='Number of torch threads')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    # Measure before running losses in this process, because peak RSS of parent process is inherited.
+    with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+        legacy_ms, legacy_mb = pool.apply(measure_in_process, (True, args))
+        new_ms, new_mb = pool.apply(measure_in_process, (False, args))
+    torch.manual_seed(0)
+    inputs = generate_dummy_inputs(args.batch_size, args.image_size, args.n_classes, args.n_bboxes)
+    for legacy_loss, new_loss in zip(legacy_focal_loss(*inputs), FocalLoss()(*inputs)):
+        assert torch.allclose(legacy_loss, new_loss, rtol=1e-4), (legacy_loss, new_loss)
+    print(f"anchors {inputs[2].shape[1]}, batch size {args.batch_size}, classes {args.n_classes}")
+    print(f"legacy: {legacy_ms:.1f} ms/step, peak RSS +{legacy_mb:.1f} MB")
+    print(f"new: {new_ms:.1f} ms/step, peak RSS +{new_mb:.1f} MB ({legacy_ms / new_ms:.1f}x faster)")
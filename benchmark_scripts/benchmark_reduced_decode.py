@@ -0,0 +1,68 @@
+import argparse
+import os
+import tempfile
+import time
+from typing import List, Callable, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from deepext_with_lightning.dataset.common import open_image
+from deepext_with_lightning.image_process.convert import pil_to_cv
+
+
+def generate_dummy_jpegs(out_dir: str, n_images: int, width: int, height: int) -> List[str]:
+    random_state = np.random.RandomState(0)
+    file_paths = []
+    for i in range(n_images):
+        # Smooth gradation with noise, JPEG size is close to photo.
+        gradation = np.linspace(0, 255, width)[None, :, None] * np.linspace(0.2, 1., height)[:, None, None]
+        image = np.clip(gradation + random_state.normal(0, 20, [height, width, 3]), 0, 255).astype(np.uint8)
+        file_path = os.path.join(out_dir, f"{i:03d}.jpg")
+        Image.fromarray(image).save(file_path, quality=90)
+        file_paths.append(file_path)
+    return file_paths
+
+
+def measure(load_func: Callable[[str], np.ndarray], file_paths: List[str], size: int, n_repeats: int) -> float:
+    """
+    :return: Images per second of decode and resize to (size, size).
+    """
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        for file_path in file_paths:
+            cv2.resize(load_func(file_path), (size, size), interpolation=cv2.INTER_AREA)
+    return len(file_paths) * n_repeats / (time.perf_counter() - start)
+
+
+def cv2_reduced_flag(image_size: Tuple, size: int) -> int:
+    scale = min(image_size) // size
+    for reduced_scale, flag in [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)]:
+        if scale >= reduced_scale:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+parser = argparse.ArgumentParser(description='Benchmark of reduced JPEG decoding.')
+parser.add_argument('--n_images', type=int, default=8, help='Number of dummy images')
+parser.add_argument('--width', type=int, default=4000, help='Dummy image width (default is 12MP)')
+parser.add_argument('--height', type=int, default=3000, help='Dummy image height')
+parser.add_argument('--sizes', type=int, nargs="+", default=[96, 128, 256], help='Target image sizes')
+parser.add_argument('--n_repeats', type=int, default=3, help='Number of repeats')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_paths = generate_dummy_jpegs(tmp_dir, args.n_images, args.width, args.height)
+        full_throughput = measure(lambda file_path: pil_to_cv(open_image(file_path)), file_paths,
+                                  min(args.sizes), args.n_repeats)
+        print(f"full decode: {full_throughput:.1f} images/s")
+        for size in args.sizes:
+            draft_throughput = measure(lambda file_path: pil_to_cv(open_image(file_path, decode_size=(size, size))),
+                                       file_paths, size, args.n_repeats)
+            flag = cv2_reduced_flag((args.height, args.width), size)
+            cv2_throughput = measure(lambda file_path: cv2.imread(file_path, flag), file_paths, size, args.n_repeats)
+            print(f"size {size}: PIL draft {draft_throughput:.1f} images/s ({draft_throughput / full_throughput:.1f}x),"
+                  f" cv2 IMREAD_REDUCED {cv2_throughput:.1f} images/s ({cv2_throughput / full_throughput:.1f}x)")
@@ -3,3 +3,8 @@ from .classification import *
 from .segmentation import *
 from .detection import *
 from .splitter import DatasetSplitter
+from .sampler import ClassResamplingSampler, DatasetEpochSampler, AspectRatioBatchSampler
+from .cache import SharedImageCache
+from .voc_index import VOCAnnotation, VOCAnnotationIndex
+from .manifest import ImageManifest, build_manifest
+from .packed import pack_dataset, PackedImageDataset
@@ -0,0 +1,302 @@
+import hashlib
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory
+from typing import Optional, Callable, Dict, Tuple
+
+import numpy as np
+
+__all__ = ["SharedImageCache"]
+
+_DTYPES = (np.bool_, np.uint8, np.uint16, np.int32, np.int64, np.float32)
+_MAX_NDIM = 3
+_ALIGNMENT = 64
+# Columns of entry table. Entry is valid if nbytes > 0. prev/next are rows of LRU list. (-1 is none)
+_KEY, _OFFSET, _NBYTES, _PREV, _NEXT, _DTYPE, _NDIM, _SHAPE = 0, 1, 2, 3, 4, 5, 6, 7
+_N_COLUMNS = _SHAPE + _MAX_NDIM
+# Counters. head is most recently used row and tail is least recently used row.
+_HITS, _MISSES, _EVICTIONS, _HEAD, _TAIL, _N_ORDERED, _N_FREE = 0, 1, 2, 3, 4, 5, 6
+_N_COUNTERS = 7
+
+
+def _hash_key(key: str) -> int:
+    # Same value in all processes. (hash() is randomized by process)
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little", signed=True)
+
+
+def _aligned(nbytes: int) -> int:
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+
+class SharedImageCache:
+    """
+    LRU cache of decoded images shared by all DataLoader workers.
+    Arrays are stored in one shared memory arena limited by budget_bytes, and entry table and hit/miss counters are
+    also in shared memory, so each image is decoded once for all workers.
+    Keys are found by open addressing hash slots, and entries are kept in LRU list and in order of offset,
+    so get and put do not scan or sort whole entry table under lock.
+    Create it in main process before DataLoader and pass it to datasets (e.g. VOCDataset.create(..., cache=cache)).
+    """
+
+    def __init__(self, budget_bytes: int, max_entries: int = 100000, multiprocessing_context: str = None):
+        """
+        :param budget_bytes: Size of shared memory arena.
+        :param max_entries: Maximum number of cached arrays.
+        :param multiprocessing_context: Same as DataLoader. (e.g. "spawn")
+        """
+        self._budget_bytes = budget_bytes
+        self._max_entries = max_entries
+        self._arena = shared_memory.SharedMemory(create=True, size=max(budget_bytes, 1))
+        self._meta = shared_memory.SharedMemory(create=True, size=self._meta_size() * 8)
+        self._lock = mp.get_context(multiprocessing_context).Lock()
+        # Forked workers have copy of this, so owner is checked by process id too.
+        self._is_owner, self._owner_pid = True, os.getpid()
+        self._create_views()
+        self._counters[:] = 0
+        self._counters[[_HEAD, _TAIL]] = -1
+        self._counters[_N_FREE] = max_entries
+        self._table[:] = 0
+        self._slots[:] = 0
+        # Stack of free rows, row 0 is popped first.
+        self._free_rows[:] = np.arange(max_entries)[::-1]
+
+    def _n_slots(self) -> int:
+        # Power of 2 and load factor <= 0.5
+        return 1 << max(2 * self._max_entries - 1, 1).bit_length()
+
+    def _meta_size(self) -> int:
+        return _N_COUNTERS + self._max_entries * (_N_COLUMNS + 4) + self._n_slots()
+
+    def _create_views(self):
+        meta = np.ndarray((self._meta_size(),), dtype=np.int64, buffer=self._meta.buf)
+        sections = np.cumsum([_N_COUNTERS, self._max_entries * _N_COLUMNS, self._n_slots()] +
+                             [self._max_entries] * 3)
+        self._counters = meta[:sections[0]]
+        self._table = meta[sections[0]:sections[1]].reshape(self._max_entries, _N_COLUMNS)
+        # row + 1 of entry, 0 is empty.
+        self._slots = meta[sections[1]:sections[2]]
+        # Valid entries sorted by offset. (offset, aligned end, row)
+        self._order_offsets = meta[sections[2]:sections[3]]
+        self._order_ends = meta[sections[3]:sections[4]]
+        self._order_rows = meta[sections[4]:sections[5]]
+        self._free_rows = meta[sections[5]:]
+        self._data = np.ndarray((self._budget_bytes,), dtype=np.uint8, buffer=self._arena.buf)
+
+    def get_or_load(self, key: str, loader: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        :param key: e.g. file path.
+        :param loader: Called if key is not cached.
+        :return: Copy of cached array or result of loader.
+        """
+        hashed_key = _hash_key(key)
+        array = self.get(hashed_key)
+        if array is None:
+            array = loader()
+            self.put(hashed_key, array)
+        return array
+
+    def get(self, key: int) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self._find(key)
+            if row is None:
+                self._counters[_MISSES] += 1
+                return None
+            self._counters[_HITS] += 1
+            self._unlink(row)
+            self._link_head(row)
+            entry = self._table[row]
+            offset, nbytes, ndim = entry[_OFFSET], entry[_NBYTES], entry[_NDIM]
+            # Copy in lock, entry may be evicted by other worker after that.
+            return self._data[offset:offset + nbytes].view(_DTYPES[entry[_DTYPE]]).reshape(
+                entry[_SHAPE:_SHAPE + ndim]).copy()
+
+    def put(self, key: int, array: np.ndarray) -> bool:
+        """
+        :return: False if array can not be cached. (too large, empty or unsupported dtype)
+        """
+        array = np.ascontiguousarray(array)
+        if not 0 < array.nbytes <= self._budget_bytes or array.ndim > _MAX_NDIM or array.dtype not in _DTYPES:
+            return False
+        with self._lock:
+            if self._find(key) is not None:  # Cached by other worker.
+                return True
+            offset = self._allocate(array.nbytes)
+            self._data[offset:offset + array.nbytes] = array.reshape(-1).view(np.uint8)
+            self._counters[_N_FREE] -= 1
+            row = int(self._free_rows[self._counters[_N_FREE]])
+            entry = self._table[row]
+            entry[[_KEY, _OFFSET, _NBYTES, _DTYPE, _NDIM]] = [
+                key, offset, array.nbytes, _DTYPES.index(array.dtype), array.ndim]
+            entry[_SHAPE:_SHAPE + array.ndim] = array.shape
+            self._link_head(row)
+            self._insert_slot(key, row)
+            self._insert_order(offset, offset + _aligned(array.nbytes), row)
+        return True
+
+    def _find(self, key: int) -> Optional[int]:
+        slot = self._find_slot(key)
+        return int(self._slots[slot]) - 1 if self._slots[slot] > 0 else None
+
+    def _home_slot(self, key: int) -> int:
+        # Fibonacci hashing, so sequential int keys are not clustered in consecutive slots.
+        n_bits = self._slots.shape[0].bit_length() - 1
+        return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - n_bits)
+
+    def _find_slot(self, key: int) -> int:
+        """
+        :return: Slot of key, or empty slot where key is inserted.
+        """
+        mask = self._slots.shape[0] - 1
+        slot = self._home_slot(key)
+        while True:
+            value = int(self._slots[slot])
+            if value == 0 or self._table[value - 1, _KEY] == key:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _insert_slot(self, key: int, row: int):
+        self._slots[self._find_slot(key)] = row + 1
+
+    def _remove_slot(self, key: int):
+        """
+        Backward shift deletion of linear probing, so deleted slots do not remain as tombstones.
+        """
+        mask = self._slots.shape[0] - 1
+        empty = self._find_slot(key)
+        slot = empty
+        while True:
+            slot = (slot + 1) & mask
+            value = int(self._slots[slot])
+            if value == 0:
+                break
+            home = self._home_slot(int(self._table[value - 1, _KEY]))
+            # Entry can move to empty slot if its home is not between empty slot and its slot.
+            if (slot - home) & mask >= (slot - empty) & mask:
+                self._slots[empty] = value
+                empty = slot
+        self._slots[empty] = 0
+
+    def _link_head(self, row: int):
+        head = int(self._counters[_HEAD])
+        self._table[row, _PREV], self._table[row, _NEXT] = -1, head
+        if head >= 0:
+            self._table[head, _PREV] = row
+        else:
+            self._counters[_TAIL] = row
+        self._counters[_HEAD] = row
+
+    def _unlink(self, row: int):
+        prev_row, next_row = int(self._table[row, _PREV]), int(self._table[row, _NEXT])
+        if prev_row >= 0:
+            self._table[prev_row, _NEXT] = next_row
+        else:
+            self._counters[_HEAD] = next_row
+        if next_row >= 0:
+            self._table[next_row, _PREV] = prev_row
+        else:
+            self._counters[_TAIL] = prev_row
+
+    def _insert_order(self, offset: int, end: int, row: int):
+        n = int(self._counters[_N_ORDERED])
+        position = int(np.searchsorted(self._order_offsets[:n], offset))
+        for array, value in [(self._order_offsets, offset), (self._order_ends, end), (self._order_rows, row)]:
+            array[position + 1:n + 1] = array[position:n]
+            array[position] = value
+        self._counters[_N_ORDERED] = n + 1
+
+    def _remove_order(self, offset: int) -> Tuple[int, int]:
+        """
+        :return: Gap (start, end) after removal.
+        """
+        n = int(self._counters[_N_ORDERED])
+        position = int(np.searchsorted(self._order_offsets[:n], offset))
+        for array in [self._order_offsets, self._order_ends, self._order_rows]:
+            array[position:n - 1] = array[position + 1:n]
+        self._counters[_N_ORDERED] = n - 1
+        gap_start = int(self._order_ends[position - 1]) if position > 0 else 0
+        gap_end = int(self._order_offsets[position]) if position < n - 1 else self._budget_bytes
+        return gap_start, gap_end
+
+    def _evict_lru(self) -> Tuple[int, int]:
+        """
+        :return: Gap (start, end) including space of evicted entry.
+        """
+        row = int(self._counters[_TAIL])
+        self._unlink(row)
+        self._remove_slot(int(self._table[row, _KEY]))
+        gap = self._remove_order(int(self._table[row, _OFFSET]))
+        self._table[row, _NBYTES] = 0
+        self._free_rows[self._counters[_N_FREE]] = row
+        self._counters[_N_FREE] += 1
+        self._counters[_EVICTIONS] += 1
+        return gap
+
+    def _allocate(self, nbytes: int) -> int:
+        """
+        First fit in gaps between cached arrays. Evict least recently used entry until it fits and a row is free.
+        Only gap around evicted entry changes, so other gaps are not searched again.
+        :return: offset
+        """
+        n = int(self._counters[_N_ORDERED])
+        gap_starts = np.concatenate([[0], self._order_ends[:n]])
+        gap_ends = np.concatenate([self._order_offsets[:n], [self._budget_bytes]])
+        fit_gaps = np.nonzero(gap_ends - gap_starts >= nbytes)[0]
+        offset = int(gap_starts[fit_gaps[0]]) if fit_gaps.shape[0] > 0 else None
+        while offset is None or self._counters[_N_FREE] == 0:
+            gap_start, gap_end = self._evict_lru()
+            if gap_end - gap_start >= nbytes and (offset is None or gap_start < offset):
+                offset = gap_start
+        return offset
+
+    def stats(self) -> Dict[str, float]:
+        """
+        :return: dict of hits, misses, evictions, hit_rate, n_entries, used_bytes and budget_bytes.
+        """
+        with self._lock:
+            hits, misses, evictions = self._counters[[_HITS, _MISSES, _EVICTIONS]].tolist()
+            nbytes = self._table[:, _NBYTES]
+            n_entries, used_bytes = int(np.count_nonzero(nbytes)), int(nbytes.sum())
+        return {"hits": hits, "misses": misses, "evictions": evictions,
+                "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.,
+                "n_entries": n_entries, "used_bytes": used_bytes, "budget_bytes": self._budget_bytes}
+
+    def reset_stats(self):
+        with self._lock:
+            self._counters[[_HITS, _MISSES, _EVICTIONS]] = 0
+
+    def close(self):
+        """
+        Release shared memory. Unlinked if called on instance which created it.
+        """
+        if self._arena is None:
+            return
+        self._counters, self._table, self._data = None, None, None
+        self._arena.close()
+        self._meta.close()
+        if self._is_owner and os.getpid() == self._owner_pid:
+            self._arena.unlink()
+            self._meta.unlink()
+        self._arena, self._meta = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, "_arena", None) is not None and self._is_owner and os.getpid() == self._owner_pid:
+            self.close()
+
+    def __getstate__(self):
+        # For spawned workers. Shared memory is attached by name and not owned.
+        return {"budget_bytes": self._budget_bytes, "max_entries": self._max_entries, "lock": self._lock,
+                "arena_name": self._arena.name, "meta_name": self._meta.name}
+
+    def __setstate__(self, state):
+        self._budget_bytes, self._max_entries = state["budget_bytes"], state["max_entries"]
+        self._lock = state["lock"]
+        self._is_owner, self._owner_pid = False, None
+        self._arena = shared_memory.SharedMemory(name=state["arena_name"])
+        self._meta = shared_memory.SharedMemory(name=state["meta_name"])
+        self._create_views()
@@ -1,159 +1,248 @@
 from collections import OrderedDict
-from functools import reduce
-from typing import Dict, List, Optional, Callable
+from typing import Dict, List, Optional, Callable, Tuple, Union
 from warnings import warn
 from torch.utils.data import Dataset
-import csv
-from PIL import Image
 from pathlib import Path
 import numpy as np
+import pandas as pd
+import torch
+
+from .cache import SharedImageCache
+from .common import open_image, StringArray
+from .sampler import sample_indices_by_classes, DatasetEpochSampler
 
 
 class CSVAnnotationDatasetWithUnderSampling(Dataset):
-    def __init__(self, image_dir: str, annotation_dict: Dict[str, int], transforms,
-                 label_dist: List[int], under_sampling_rate: List[float]):
+    def __init__(self, image_dir: str, filenames: StringArray, labels: np.ndarray, transforms,
+                 under_sampling_rate: List[float], seed: int = 0, cache: SharedImageCache = None,
+                 decode_size: Tuple[int, int] = None):
+        """
+        Samples of each epoch are chosen at once by seed and epoch. see set_epoch.
+        Use sampler of create_sampler to change samples by epoch, because Lightning calls set_epoch of sampler.
+        (e.g. DataLoader(dataset, batch_size, sampler=dataset.create_sampler()))
+        :param image_dir:
+        :param filenames: (N, ) Filename array.
+        :param labels: (N, ) Label array.
+        :param transforms:
+        :param under_sampling_rate:
+        :param seed:
+        :param cache:
+        :param decode_size:
+        """
         self._image_dir = image_dir
-        self._annotation_dict = annotation_dict
+        self._cache = cache
+        self._decode_size = decode_size
+        self._filenames = filenames
+        self._labels = labels
         self._transforms = transforms
-        self._n_classes = len(under_sampling_rate)
-        self._filenames_by_classes = [[] for _ in range(self._n_classes)]
-        for filename, label in self._annotation_dict.items():
-            self._filenames_by_classes[label].append(filename)
+        self._under_sampling_rate = under_sampling_rate
+        self._seed = seed
+        # Shared with DataLoader workers including persistent workers.
+        self._epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self._sampled_epoch = None
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int):
+        """
+        Resample indices. Result is same in all processes and DataLoader workers.
+        """
+        self._epoch[0] = epoch
+        self._sampled_indices_of_epoch()
 
-        self._sampled_label_dist = list(map(lambda x_y: round(x_y[0] * x_y[1]), zip(under_sampling_rate, label_dist)))
-        self._data_len = sum(self._sampled_label_dist)
-        self._norm_label_dist = np.array(label_dist) / sum(label_dist)
+    def create_sampler(self, shuffle: bool = True, num_replicas: int = None,
+                       rank: int = None) -> DatasetEpochSampler:
+        """
+        Under DDP, create in train_dataloader so world size and rank are taken from initialized process group.
+        """
+        return DatasetEpochSampler(self, shuffle=shuffle, seed=self._seed, num_replicas=num_replicas, rank=rank)
+
+    def _sampled_indices_of_epoch(self) -> np.ndarray:
+        epoch = int(self._epoch[0])
+        if self._sampled_epoch != epoch:
+            self._sampled_indices = sample_indices_by_classes(self._labels, self._under_sampling_rate,
+                                                              np.random.default_rng([self._seed, epoch]))
+            self._sampled_epoch = epoch
+        return self._sampled_indices
 
     def __len__(self):
-        return self._data_len
+        return self._sampled_indices.shape[0]
 
     def __getitem__(self, idx):
-        label = np.random.choice([i for i in range(self._n_classes)], p=self._norm_label_dist)
-        filenames = self._filenames_by_classes[label]
-        filename = np.random.choice(filenames)
-        label = self._annotation_dict[filename]
-        filepath = Path(self._image_dir).joinpath(filename)
-        img = Image.open(str(filepath))
-        img = img.convert("RGB")
-        if self._transforms:
-            return self._transforms(img, label)
-        return img, label
+        index = self._sampled_indices_of_epoch()[idx]
+        return _load_image_with_label(self._image_dir, self._filenames[index], int(self._labels[index]),
+                                      self._transforms, self._cache, self._decode_size)
 
     def labels_distribution(self) -> List[int]:
-        return self._sampled_label_dist
+        return np.bincount(self._labels[self._sampled_indices_of_epoch()],
+                           minlength=len(self._under_sampling_rate)).tolist()
 
 
 class CSVAnnotationDatasetWithOverSampling(Dataset):
-    def __init__(self, image_dir: str, annotation_dict: Dict[str, int], transforms, over_sampling_rate: List[int]):
+    def __init__(self, image_dir: str, filenames: StringArray, labels: np.ndarray, transforms,
+                 over_sampling_rate: List[int], cache: SharedImageCache = None,
+                 decode_size: Tuple[int, int] = None):
+        """
+        :param image_dir:
+        :param filenames: (N, ) Filename array.
+        :param labels: (N, ) Label array.
+        :param transforms:
+        :param over_sampling_rate:
+        :param cache:
+        :param decode_size:
+        """
         self._image_dir = image_dir
-        self._annotation_dict = annotation_dict
+        self._cache = cache
+        self._decode_size = decode_size
         self._transforms = transforms
-        self._file_name_list = list(
-            map(lambda filename_label: [filename_label[0]] * over_sampling_rate[filename_label[1]],
-                annotation_dict.items()))  # Apply oversampling
-        self._file_name_list = reduce(lambda a, b: a + b, self._file_name_list)  # Flatten list
+        # Apply oversampling
+        sampled_indices = np.repeat(np.arange(labels.shape[0]), np.array(over_sampling_rate)[labels])
+        self._filenames = filenames[sampled_indices]
+        self._labels = labels[sampled_indices]
 
     def __len__(self):
-        return len(self._file_name_list)
+        return self._labels.shape[0]
 
     def __getitem__(self, idx):
-        filename = self._file_name_list[idx]
-        label = self._annotation_dict[filename]
-        filepath = Path(self._image_dir).joinpath(filename)
-        img = Image.open(str(filepath))
-        img = img.convert("RGB")
-        if self._transforms:
-            return self._transforms(img, label)
-        return img, label
+        return _load_image_with_label(self._image_dir, self._filenames[idx], int(self._labels[idx]),
+                                      self._transforms, self._cache, self._decode_size)
 
     def labels_distribution(self, n_classes: int) -> List[int]:
         """
         summarize labels distribution.
         :return: result[label] = count
         """
-        result = [0 for _ in range(n_classes)]
-        for filename in self._file_name_list:
-            result[self._annotation_dict[filename]] += 1
-        return result
+        return np.bincount(self._labels, minlength=n_classes).tolist()
 
 
 class CSVAnnotationDataset(Dataset):
     @staticmethod
     def create(image_dir: str, annotation_csv_filepath: str, transforms: Optional[Callable],
-               label_dict: Dict[str, int] = None) -> 'CSVAnnotationDataset':
+               label_dict: Dict[str, int] = None, cache: SharedImageCache = None,
+               decode_size: Tuple[int, int] = None) -> 'CSVAnnotationDataset':
         """
         Create dataset from CSV file.
         If CSV column 2 value is string, required label_dict arg.
         :param label_dict:
         :param image_dir:
-        :param annotation_csv_filepath: 
+        :param annotation_csv_filepath:
         :param transforms:
+        :param cache: Shared cache of decoded images.
+        :param decode_size: (width, height) If given, JPEG is decoded at reduced size not less than this.
+        Set minimum size required by transforms. (e.g. size of Resize)
         :return:
         """
-        filename_label_dict = CSVAnnotationDataset._create_filename_label_dict(annotation_csv_filepath, label_dict)
-        return CSVAnnotationDataset(image_dir, filename_label_dict=filename_label_dict, transforms=transforms)
+        filenames, labels = CSVAnnotationDataset._load_annotation_arrays(annotation_csv_filepath, label_dict)
+        return CSVAnnotationDataset.from_arrays(image_dir, filenames, labels, transforms=transforms, cache=cache,
+                                                decode_size=decode_size)
 
     @staticmethod
-    def _create_filename_label_dict(annotation_csv_filepath: str, label_dict: Dict[str, int] = None) -> OrderedDict:
-        filename_label_dict = OrderedDict()
-        with open(annotation_csv_filepath, "r") as file:
-            reader = csv.reader(file)
-            for row in reader:
-                filename = Path(row[0]).name
-                label = row[1]
-                if not label.isdigit():
-                    if label_dict is None:
-                        raise RuntimeError("Required dict transform label name to class number.")
-                    label_num = label_dict.get(label)
-                    if label_num is None:
-                        warn(f"Invalid label name: {label},  {row}")
-                        continue
-                    filename_label_dict[filename] = label_num
-                    continue
-                filename_label_dict[filename] = int(label)
-        return filename_label_dict
-
-    def __init__(self, image_dir: str, filename_label_dict: OrderedDict, transforms: Optional[Callable]):
+    def from_arrays(image_dir: str, filenames: Union[np.ndarray, StringArray], labels: np.ndarray,
+                    transforms: Optional[Callable], cache: SharedImageCache = None,
+                    decode_size: Tuple[int, int] = None) -> 'CSVAnnotationDataset':
+        """
+        :param image_dir:
+        :param filenames: (N, ) Filename array or StringArray.
+        :param labels: (N, ) Label array.
+        :param transforms:
+        :param cache:
+        :param decode_size:
+        :return:
+        """
+        dataset = CSVAnnotationDataset(image_dir, OrderedDict(), transforms, cache=cache, decode_size=decode_size)
+        dataset._filenames = filenames if isinstance(filenames, StringArray) else StringArray(filenames.tolist())
+        dataset._labels = labels.astype(np.int32)
+        return dataset
+
+    @staticmethod
+    def _load_annotation_arrays(annotation_csv_filepath: str, label_dict: Dict[str, int] = None,
+                                chunk_size: int = 100000) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: filenames (N, ), labels (N, ) Same filename is kept at first position with last label.
+        """
+        filenames_ls, labels_ls = [], []
+        for chunk in pd.read_csv(annotation_csv_filepath, header=None, usecols=[0, 1], dtype=str,
+                                 keep_default_na=False, chunksize=chunk_size):
+            filenames, label_values = chunk[0].str.split("/").str[-1].to_numpy(), chunk[1]
+            is_digit = label_values.str.isdigit().to_numpy()
+            labels = np.full(len(chunk), -1, dtype=np.int32)
+            labels[is_digit] = label_values[is_digit].astype(np.int32).to_numpy()
+            if not np.all(is_digit):
+                if label_dict is None:
+                    raise RuntimeError("Required dict transform label name to class number.")
+                label_nums = label_values[~is_digit].map(label_dict)
+                for label, row in zip(label_values[~is_digit][label_nums.isna()],
+                                      chunk[~is_digit][label_nums.isna()].values.tolist()):
+                    warn(f"Invalid label name: {label},  {row}")
+                labels[~is_digit] = label_nums.fillna(-1).astype(np.int32).to_numpy()
+            is_valid = labels >= 0
+            filenames_ls.append(filenames[is_valid].astype(str))
+            labels_ls.append(labels[is_valid])
+        if len(filenames_ls) == 0:
+            return np.array([], dtype=str), np.array([], dtype=np.int32)
+
+        filenames, labels = np.concatenate(filenames_ls), np.concatenate(labels_ls)
+        # Remove duplicated filenames like dict. (first position, last label)
+        unique_filenames, first_indices = np.unique(filenames, return_index=True)
+        _, reversed_first_indices = np.unique(filenames[::-1], return_index=True)
+        last_labels = labels[filenames.shape[0] - 1 - reversed_first_indices]
+        order = np.argsort(first_indices)
+        return unique_filenames[order], last_labels[order]
+
+    def __init__(self, image_dir: str, filename_label_dict: OrderedDict, transforms: Optional[Callable],
+                 cache: SharedImageCache = None, decode_size: Tuple[int, int] = None):
         self._image_dir = image_dir
         self._transforms = transforms
-        self._filepath_label_dict = filename_label_dict
+        self._cache = cache
+        self._decode_size = decode_size
+        # Parallel arrays for O(1) indexing. No Python object by sample for forked workers.
+        self._filenames = StringArray(filename_label_dict.keys())
+        self._labels = np.array(list(filename_label_dict.values()), dtype=np.int32)
 
     def labels_distribution(self, n_classes: int) -> List[int]:
         """
         summarize labels distribution.
         :return: result[label] = count
         """
-        result = [0 for _ in range(n_classes)]
-        for label in self._filepath_label_dict.values():
-            result[label] += 1
-        return result
+        return np.bincount(self._labels, minlength=n_classes).tolist()
 
     def __len__(self):
-        return len(self._filepath_label_dict)
+        return self._labels.shape[0]
 
     def __getitem__(self, idx):
-        filename, label = list(self._filepath_label_dict.items())[idx]
-        filepath = Path(self._image_dir).joinpath(filename)
-        img = Image.open(str(filepath))
-        img = img.convert("RGB")
-        if self._transforms:
-            return self._transforms(img, label)
-        return img, label
+        return _load_image_with_label(self._image_dir, self._filenames[idx], int(self._labels[idx]),
+                                      self._transforms, self._cache, self._decode_size)
 
     def split_dataset(self, indices: np.ndarray) -> 'CSVAnnotationDataset':
-        new_annotation_dict_keys = list(
-            filter(lambda index_key: index_key[0] in indices, enumerate(list(self._filepath_label_dict.keys()))))
-        new_annotation_dict = OrderedDict()
-        for _, key in new_annotation_dict_keys:
-            new_annotation_dict[key] = self._filepath_label_dict[key]
-        return CSVAnnotationDataset(self._image_dir, new_annotation_dict, self._transforms)
+        # Keep original order.
+        indices = np.unique(indices)
+        indices = indices[(indices >= 0) & (indices < len(self))]
+        return CSVAnnotationDataset.from_arrays(self._image_dir, self._filenames[indices], self._labels[indices],
+                                                self._transforms, cache=self._cache,
+                                                decode_size=self._decode_size)
 
     def apply_over_sampling(self, over_sampling_rate: List[int]) -> CSVAnnotationDatasetWithOverSampling:
-        return CSVAnnotationDatasetWithOverSampling(self._image_dir, self._filepath_label_dict,
-                                                    self._transforms, over_sampling_rate)
-
-    def apply_under_sampling(self, under_sampling_rate: List[float]) -> CSVAnnotationDatasetWithUnderSampling:
-        return CSVAnnotationDatasetWithUnderSampling(self._image_dir, self._filepath_label_dict,
-                                                     self._transforms,
-                                                     self.labels_distribution(len(under_sampling_rate)),
-                                                     under_sampling_rate)
+        return CSVAnnotationDatasetWithOverSampling(self._image_dir, self._filenames, self._labels,
+                                                    self._transforms, over_sampling_rate, cache=self._cache,
+                                                    decode_size=self._decode_size)
+
+    def apply_under_sampling(self, under_sampling_rate: List[float],
+                             seed: int = 0) -> CSVAnnotationDatasetWithUnderSampling:
+        return CSVAnnotationDatasetWithUnderSampling(self._image_dir, self._filenames, self._labels,
+                                                     self._transforms, under_sampling_rate, seed=seed,
+                                                     cache=self._cache, decode_size=self._decode_size)
+
+    @property
+    def labels(self) -> np.ndarray:
+        """
+        Label of each sample. Used for ClassResamplingSampler.
+        """
+        return self._labels
+
+
+def _load_image_with_label(image_dir: str, filename: str, label: int, transforms: Optional[Callable],
+                           cache: SharedImageCache = None, decode_size: Tuple[int, int] = None):
+    filepath = Path(image_dir).joinpath(str(filename))
+    img = open_image(str(filepath), cache=cache, decode_size=decode_size)
+    if transforms:
+        return transforms(img, label)
+    return img, label
@@ -1,8 +1,12 @@
-from typing import Tuple, List, TypeVar
+from typing import Tuple, List, TypeVar, Optional, Iterable, Union, Callable
 from pathlib import Path
+import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 
+from .cache import SharedImageCache, _hash_key
+from .manifest import build_manifest
+
 T_ROOT_DATASET = TypeVar("T_ROOT_DATASET", bound=Dataset)
 
 
@@ -26,8 +30,143 @@ class TransformsWrapperDataset(Dataset):
         return self._root_dataset
 
 
-def create_filepath_ls(image_dir_path: str, valid_suffixes: List[str] = None) -> List[Path]:
+class StringArray:
+    """
+    Strings stored in one utf-8 byte array and offsets.
+    Unlike list of str/Path, reading an item does not update reference counts of many objects,
+    so pages stay shared with forked DataLoader workers instead of being copied.
+    """
+
+    def __init__(self, strings: Iterable[str] = ()):
+        encoded = [str(string).encode() for string in strings]
+        self._offsets = np.concatenate([[0], np.cumsum([len(value) for value in encoded])]).astype(np.int64)
+        self._bytes = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return self._offsets.shape[0] - 1
+
+    def __getitem__(self, idx: Union[int, slice, np.ndarray]) -> Union[str, 'StringArray']:
+        """
+        :param idx: int returns str. Slice, index array or bool mask returns StringArray.
+        """
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f"Index {idx} is out of range.")
+            return self._bytes[self._offsets[idx]:self._offsets[idx + 1]].tobytes().decode()
+        indices = np.arange(len(self))[idx]
+        counts = self._offsets[indices + 1] - self._offsets[indices]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        result = StringArray()
+        result._offsets = offsets
+        result._bytes = self._bytes[np.repeat(self._offsets[indices] - offsets[:-1], counts) + np.arange(offsets[-1])]
+        return result
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self) -> List[str]:
+        return list(self)
+
+
+def open_image(file_path: str, mode: Optional[str] = "RGB", cache: SharedImageCache = None,
+               decode_size: Tuple[int, int] = None) -> Image.Image:
+    """
+    :param file_path:
+    :param mode: If None, image is not converted. (e.g. index image)
+    :param cache: If given, decoded image is shared by DataLoader workers.
+    :param decode_size: (width, height) If given, JPEG is decoded at the smallest 1/2, 1/4 or 1/8 scale
+    not less than this size by DCT scaling. Other formats are decoded at full size.
+    """
+    if cache is not None:
+        return Image.fromarray(cache.get_or_load(
+            f"{mode}:{decode_size}:{file_path}",
+            lambda: np.asarray(open_image(file_path, mode=mode, decode_size=decode_size))))
+    return _decode_image(file_path, mode, decode_size)[0]
+
+
+def open_image_with_size(file_path: str, mode: Optional[str] = "RGB", cache: SharedImageCache = None,
+                         decode_size: Tuple[int, int] = None) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Same as open_image, and (width, height) before reduced decoding read in the same open.
+    If cache is given, the size is cached with the image, so the file is not opened on cache hit.
+    """
+    if cache is None:
+        return _decode_image(file_path, mode, decode_size)
+    image_key, size_key = _hash_key(f"{mode}:{decode_size}:{file_path}"), _hash_key(f"size:{file_path}")
+    size = cache.get(size_key)
+    image_array = cache.get(image_key) if size is not None else None
+    if image_array is None:
+        image, size = _decode_image(file_path, mode, decode_size)
+        image_array = np.asarray(image)
+        cache.put(image_key, image_array)
+        cache.put(size_key, np.asarray(size, dtype=np.int64))
+    return Image.fromarray(image_array), (int(size[0]), int(size[1]))
+
+
+def _decode_image(file_path: str, mode: Optional[str], decode_size: Optional[Tuple[int, int]]) \
+        -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    :return: Image, (width, height) before draft.
+    """
+    image = Image.open(file_path)
+    size = image.size
+    if decode_size is not None:
+        image.draft(mode or image.mode, decode_size)
+    return (image.convert(mode) if mode is not None else image), size
+
+
+class BucketTransformsWrapperDataset(Dataset):
+    """
+    Dataset for AspectRatioBatchSampler. Index is (index, (height, width)) and transforms for the shape are used.
+    """
+
+    def __init__(self, root_dataset: T_ROOT_DATASET, build_transforms: Callable[[int, int], Callable],
+                 default_shape: Tuple[int, int]):
+        """
+        :param root_dataset: Dataset without transforms.
+        :param build_transforms: Returns transforms resizing to (height, width).
+        (e.g. lambda height, width: AlbumentationsDetectionWrapperTransform([A.Resize(height, width), ...]))
+        :param default_shape: (height, width) Used for int index. (e.g. callbacks, DataLoader without
+        AspectRatioBatchSampler)
+        """
+        super().__init__()
+        if default_shape is None or len(default_shape) != 2:
+            raise ValueError(f"default_shape must be (height, width), but {default_shape} is given.")
+        self._root_dataset = root_dataset
+        self._build_transforms = build_transforms
+        self._default_shape = tuple(default_shape)
+        self._transforms_by_shape = {}
+
+    def __len__(self):
+        return len(self._root_dataset)
+
+    def __getitem__(self, sample: Union[int, Tuple[int, Tuple[int, int]]]):
+        idx, shape = sample if isinstance(sample, tuple) else (sample, self._default_shape)
+        if shape not in self._transforms_by_shape:
+            self._transforms_by_shape[shape] = self._build_transforms(*shape)
+        image, label = self._root_dataset[idx]
+        return self._transforms_by_shape[shape](image, label)
+
+    @property
+    def root_dataset(self) -> T_ROOT_DATASET:
+        return self._root_dataset
+
+
+def create_filepath_ls(image_dir_path: str, valid_suffixes: List[str] = None,
+                       manifest_path: str = None) -> List[Path]:
+    """
+    :param image_dir_path:
+    :param valid_suffixes:
+    :param manifest_path: If given, file list is read from manifest file and only changes are scanned.
+    Not decodable images are excepted. see build_manifest.
+    """
     valid_suffixes = valid_suffixes or ["*.png", "*.jpg", "*.jpeg", "*.bmp"]
+    if manifest_path is not None:
+        manifest = build_manifest(image_dir_path, manifest_path, valid_suffixes=valid_suffixes, recursive=False)
+        return [Path(file_path) for file_path in manifest.file_paths()]
     image_path_ls = []
     image_dir = Path(image_dir_path)
     for suffix in valid_suffixes:
@@ -37,11 +176,25 @@ def create_filepath_ls(image_dir_path: str, valid_suffixes: List[str] = None) ->
 
 
 class ImageOnlyDataset(Dataset):
-    def __init__(self, image_dir: str, image_transform):
+    def __init__(self, image_dir: str, image_transform, cache: SharedImageCache = None,
+                 decode_size: Tuple[int, int] = None, manifest_path: str = None):
+        """
+        :param image_dir:
+        :param image_transform:
+        :param cache:
+        :param decode_size: (width, height) Minimum size of reduced JPEG decoding. see open_image.
+        :param manifest_path: see create_filepath_ls.
+        """
         self._image_transform = image_transform
+        self._cache = cache
+        self._decode_size = decode_size
         image_dir_path = Path(image_dir)
-        self._image_file_path_ls = list(image_dir_path.glob("*.jpg")) + list(image_dir_path.glob("*.jpeg")) + list(
-            image_dir_path.glob("*.png")) + list(image_dir_path.glob("*.bmp"))
+        if manifest_path is not None:
+            image_file_path_ls = create_filepath_ls(image_dir, manifest_path=manifest_path)
+        else:
+            image_file_path_ls = list(image_dir_path.glob("*.jpg")) + list(image_dir_path.glob("*.jpeg")) + \
+                                 list(image_dir_path.glob("*.png")) + list(image_dir_path.glob("*.bmp"))
+        self._image_file_path_ls = StringArray(image_file_path_ls)
         self._current_image_size = None
         self._current_file_path = None
 
@@ -60,10 +213,9 @@ class ImageOnlyDataset(Dataset):
     def __getitem__(self, idx):
         file_path = self._image_file_path_ls[idx]
         self._current_file_path = file_path
-        img = Image.open(str(file_path))
-        img = img.convert("RGB")
-        width, height = img.size[:2]
-        self._current_image_size = width, height
+        # Size before reduced decoding.
+        img, self._current_image_size = open_image_with_size(file_path, cache=self._cache,
+                                                             decode_size=self._decode_size)
         if self._image_transform:
             img, label = self._image_transform(img, None)
         return img
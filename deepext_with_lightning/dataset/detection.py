@@ -1,3 +1,4 @@
+import itertools
 from typing import List, Union, Dict, Tuple, Optional, Callable
 from warnings import warn
 
@@ -6,8 +7,9 @@ import numpy as np
 import torch
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from PIL import Image
-from .common import create_filepath_ls
+from .cache import SharedImageCache
+from .common import create_filepath_ls, open_image, StringArray
+from .voc_index import VOCAnnotation, VOCAnnotationIndex
 
 
 class AdjustDetectionTensorCollator:
@@ -16,28 +18,40 @@ class AdjustDetectionTensorCollator:
     すべてのBounding boxを-1埋めで固定長にする.
     """
 
-    def __init__(self, padding_val=-1):
+    def __init__(self, padding_val=-1, return_counts=False):
+        """
+        :param padding_val:
+        :param return_counts: If True, returns bounding box count of each image (Batch size, ) too.
+        """
         self._padding_val = padding_val
+        self._return_counts = return_counts
 
     def __call__(self, batch):
         images, targets = list(zip(*batch))
-        return [torch.stack(images, dim=0), self._resize_batch_bbox(targets)]
+        bboxes, counts = self._resize_batch_bbox(targets)
+        if self._return_counts:
+            return [torch.stack(images, dim=0), bboxes, counts]
+        return [torch.stack(images, dim=0), bboxes]
 
-    def _resize_batch_bbox(self, batch_bboxes: List[List[List[Union[float, int]]]]):
+    def _resize_batch_bbox(self, batch_bboxes: List[Union[List[List[Union[float, int]]], np.ndarray]]) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
         """
         :param batch_bboxes: Batch size * N * 5(x_min, y_min, x_max, y_max, class label)
-        :return: Batch size * max_bbox * 5
+        :return: (Batch size, max_bbox, 5) float32 tensor, (Batch size, ) bounding box counts
         """
-        max_bbox = max(list(map(lambda bboxes: len(bboxes), batch_bboxes)))
-        new_batch_bboxes = np.ones([len(batch_bboxes), max_bbox, 5]) * self._padding_val
-        for i, bboxes in enumerate(batch_bboxes):
-            for j in range(len(batch_bboxes[i])):
-                new_batch_bboxes[i, j, 0] = batch_bboxes[i][j][0]
-                new_batch_bboxes[i, j, 1] = batch_bboxes[i][j][1]
-                new_batch_bboxes[i, j, 2] = batch_bboxes[i][j][2]
-                new_batch_bboxes[i, j, 3] = batch_bboxes[i][j][3]
-                new_batch_bboxes[i, j, 4] = batch_bboxes[i][j][4]
-        return new_batch_bboxes
+        bboxes_ls = [np.asarray(bboxes, dtype=np.float32).reshape(-1, 5)
+                     if isinstance(bboxes, (np.ndarray, torch.Tensor)) else _bbox_list_to_array(bboxes)
+                     for bboxes in batch_bboxes]
+        counts = np.array([bboxes.shape[0] for bboxes in bboxes_ls], dtype=np.int64)
+        new_batch_bboxes = np.full([len(bboxes_ls), counts.max(initial=0), 5], self._padding_val, dtype=np.float32)
+        # All boxes are assigned at once.
+        new_batch_bboxes[np.arange(new_batch_bboxes.shape[1])[None, :] < counts[:, None]] = np.concatenate(bboxes_ls)
+        return torch.from_numpy(new_batch_bboxes), torch.from_numpy(counts)
+
+
+def _bbox_list_to_array(bboxes: List[List[Union[float, int]]]) -> np.ndarray:
+    # Faster than np.asarray for nested list.
+    return np.fromiter(itertools.chain.from_iterable(bboxes), dtype=np.float32, count=len(bboxes) * 5).reshape(-1, 5)
 
 
 class VOCAnnotationTransform:
@@ -51,7 +65,9 @@ class VOCAnnotationTransform:
         self._class_index_dict = class_index_dict
         self._ignore_labels = ignore_labels or []
 
-    def __call__(self, target: ET.Element or Dict):
+    def __call__(self, target: ET.Element or Dict or VOCAnnotation):
+        if isinstance(target, VOCAnnotation):
+            return self._transform_indexed_annotation(target)
         assert isinstance(target, ET.Element) or isinstance(target, dict)
         is_target_dict = isinstance(target, dict)
         result = []
@@ -80,32 +96,61 @@ class VOCAnnotationTransform:
             result.append(bbox + [class_index, ])
         return result
 
+    def _transform_indexed_annotation(self, target: VOCAnnotation):
+        adjust_width_rate = self._size[1] / target.width if self._size is not None else 1.
+        adjust_height_rate = self._size[0] / target.height if self._size is not None else 1.
+        bboxes = (target.boxes - 1) * np.array([adjust_width_rate, adjust_height_rate] * 2)
+        result = []
+        for class_name, bbox in zip(target.names.tolist(), bboxes.tolist()):
+            class_index = self._class_index_dict.get(class_name)
+            if class_index is None or class_name in self._ignore_labels:  # Except not exist class.
+                warn(f"Invalid class name: {class_name}")
+                continue
+            result.append(bbox + [class_index, ])
+        return result
+
 
 class VOCDataset(Dataset):
     @staticmethod
     def create(image_dir_path: str, annotation_dir_path: str, transforms: Optional[Callable],
                class_index_dict: Dict[str, int],
-               valid_suffixes: List[str] = None):
-        image_path_ls = create_filepath_ls(image_dir_path, valid_suffixes)
-        return VOCDataset(image_path_ls, image_dir_path, annotation_dir_path, class_index_dict, transforms)
+               valid_suffixes: List[str] = None, cache: SharedImageCache = None,
+               annotation_index_path: str = None, manifest_path: str = None):
+        """
+        :param annotation_index_path: If given, all annotations are parsed once and cached to this file.
+        :param manifest_path: If given, image files are listed by manifest. see create_filepath_ls.
+        """
+        image_path_ls = create_filepath_ls(image_dir_path, valid_suffixes, manifest_path=manifest_path)
+        annotation_index = None
+        if annotation_index_path is not None:
+            annotation_index = VOCAnnotationIndex.build(
+                [Path(annotation_dir_path).joinpath(f"{image_path.stem}.xml") for image_path in image_path_ls],
+                cache_path=annotation_index_path)
+        return VOCDataset(image_path_ls, image_dir_path, annotation_dir_path, class_index_dict, transforms,
+                          cache=cache, annotation_index=annotation_index)
 
     def __init__(self, image_filename_ls: List[Path], image_dir_path: str, annotation_dir_path: str,
-                 class_index_dict: Dict[str, int], transform: Optional[Callable]):
+                 class_index_dict: Dict[str, int], transform: Optional[Callable], cache: SharedImageCache = None,
+                 annotation_index: VOCAnnotationIndex = None):
         self._image_dir = Path(image_dir_path)
         self._annotation_dir = Path(annotation_dir_path)
         self._class_index_dict = class_index_dict
-        self._image_filename_ls = image_filename_ls
+        self._image_filename_ls = StringArray([Path(image_filename).name for image_filename in image_filename_ls])
         self._transform = transform
         self._voc_transform = VOCAnnotationTransform(class_index_dict)
+        self._cache = cache
+        self._annotation_index = annotation_index
 
     def __getitem__(self, idx: int):
-        image_name = self._image_filename_ls[idx].name
+        image_name = self._image_filename_ls[idx]
         image_path = self._image_dir.joinpath(image_name)
         annotation_path = self._annotation_dir.joinpath(f"{Path(image_name).stem}.xml")
 
-        image = Image.open(str(image_path)).convert("RGB")
-        annotation_node = ET.parse(str(annotation_path)).getroot()
-        annotation = self._voc_transform(annotation_node)
+        image = open_image(str(image_path), cache=self._cache)
+        if self._annotation_index is not None:
+            annotation = self._voc_transform(self._annotation_index[str(annotation_path)])
+        else:
+            annotation = self._voc_transform(ET.parse(str(annotation_path)).getroot())
 
         if self._transform:
             return self._transform(image, annotation)
@@ -113,3 +158,35 @@ class VOCDataset(Dataset):
 
     def __len__(self):
         return len(self._image_filename_ls)
+
+
+class IndexedVOCDetection(Dataset):
+    """
+    torchvision VOCDetection reading annotations from VOCAnnotationIndex instead of parsing XML every time.
+    Targets are VOCAnnotation, so VOCAnnotationTransform is used as annotation transform like dict targets.
+    """
+
+    def __init__(self, voc_dataset: Dataset, transforms: Optional[Callable] = None, annotation_index_path: str = None,
+                 n_workers: int = None, cache: SharedImageCache = None):
+        """
+        :param voc_dataset: torchvision.datasets.VOCDetection
+        :param transforms:
+        :param annotation_index_path: Cache file of VOCAnnotationIndex.
+        :param n_workers: Number of processes for parsing.
+        :param cache:
+        """
+        self._image_paths = StringArray(voc_dataset.images)
+        self._annotation_index = VOCAnnotationIndex.build(voc_dataset.annotations, cache_path=annotation_index_path,
+                                                          n_workers=n_workers)
+        self._transforms = transforms
+        self._cache = cache
+
+    def __len__(self):
+        return len(self._image_paths)
+
+    def __getitem__(self, idx: int):
+        image = open_image(self._image_paths[idx], cache=self._cache)
+        annotation = self._annotation_index.get_by_row(idx)
+        if self._transforms:
+            return self._transforms(image, annotation)
+        return image, annotation
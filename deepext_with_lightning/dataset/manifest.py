@@ -0,0 +1,233 @@
+import fnmatch
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+__all__ = ["ImageManifest", "build_manifest"]
+
+DEFAULT_SUFFIXES = ["*.png", "*.jpg", "*.jpeg", "*.bmp"]
+
+# name, size, mtime(ns)
+_FileStat = Tuple[str, int, int]
+
+
+def _scan_directory(dir_path: str, valid_suffixes: List[str]) -> Tuple[List[str], List[_FileStat]]:
+    """
+    :return: child directory paths, stats of image files.
+    """
+    child_dirs, files = [], []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                child_dirs.append(entry.path)
+            elif entry.is_file() and any(fnmatch.fnmatchcase(entry.name, suffix) for suffix in valid_suffixes):
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return child_dirs, files
+
+
+def _probe_image(file_path: str, verify: bool) -> Tuple[int, int, bool]:
+    """
+    :return: width, height, decodable or not.
+    """
+    try:
+        with Image.open(file_path) as image:
+            width, height = image.size
+            if verify:
+                image.load()
+        return width, height, True
+    except Exception:
+        return 0, 0, False
+
+
+def _take_columns(manifest: 'ImageManifest', indices: np.ndarray):
+    return manifest.names[indices], manifest.sizes[indices], manifest.mtimes[indices], \
+           manifest.image_sizes[indices], manifest.is_valid[indices]
+
+
+class ImageManifest:
+    """
+    File list of image directories with size, mtime, image size and decodable flag.
+    Arrays are by file and sorted by path. Paths are stored as byte strings.
+    """
+
+    @staticmethod
+    def load(manifest_path: str) -> 'ImageManifest':
+        with np.load(manifest_path) as data:
+            return ImageManifest(**{key: data[key] for key in data.files})
+
+    def __init__(self, root_dir: np.ndarray, valid_suffixes: np.ndarray, dir_paths: np.ndarray,
+                 dir_mtimes: np.ndarray, dir_ids: np.ndarray, names: np.ndarray, sizes: np.ndarray, mtimes: np.ndarray,
+                 image_sizes: np.ndarray, is_valid: np.ndarray, recursive: np.ndarray = None):
+        """
+        :param root_dir: () Scanned root directory.
+        :param valid_suffixes: File name patterns when scanned.
+        :param dir_paths: (Directories, ) Scanned directories.
+        :param dir_mtimes: (Directories, ) mtime(ns) of directories when scanned.
+        :param dir_ids: (N, ) Directory index of each file.
+        :param names: (N, ) File names.
+        :param sizes: (N, ) File sizes.
+        :param mtimes: (N, ) mtime(ns) of files.
+        :param image_sizes: (N, 2(width, height))
+        :param is_valid: (N, ) Image is decodable or not.
+        :param recursive: () Sub directories are scanned or not. None for manifests saved before it was stored.
+        """
+        self.root_dir, self.valid_suffixes = np.asarray(root_dir), valid_suffixes
+        self.dir_paths, self.dir_mtimes = dir_paths, dir_mtimes
+        self.dir_ids, self.names, self.sizes, self.mtimes = dir_ids, names, sizes, mtimes
+        self.image_sizes, self.is_valid = image_sizes, is_valid
+        self.recursive = np.asarray(recursive) if recursive is not None else None
+        # Not saved.
+        self.scan_stats = {"scanned_dirs": 0, "reused_dirs": 0, "probed_files": 0}
+
+    def save(self, manifest_path: str):
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, root_dir=self.root_dir, valid_suffixes=self.valid_suffixes, dir_paths=self.dir_paths,
+                 dir_mtimes=self.dir_mtimes, dir_ids=self.dir_ids, names=self.names, sizes=self.sizes,
+                 mtimes=self.mtimes, image_sizes=self.image_sizes, is_valid=self.is_valid,
+                 **({"recursive": self.recursive} if self.recursive is not None else {}))
+        os.replace(tmp_path, manifest_path)
+
+    def __len__(self):
+        return self.names.shape[0]
+
+    def file_paths(self, valid_only: bool = True, valid_suffixes: List[str] = None) -> List[str]:
+        """
+        :param valid_only: Except not decodable images.
+        :param valid_suffixes: Filter by patterns. (e.g. ["*.png"])
+        :return: Sorted file paths.
+        """
+        is_target = self._target_mask(valid_only, valid_suffixes)
+        names = [os.fsdecode(name) for name in self.names[is_target].tolist()]
+        dir_paths = [os.fsdecode(dir_path) for dir_path in self.dir_paths.tolist()]
+        return [os.path.join(dir_paths[dir_id], name) for name, dir_id in zip(names, self.dir_ids[is_target].tolist())]
+
+    def file_image_sizes(self, valid_only: bool = True, valid_suffixes: List[str] = None) -> np.ndarray:
+        """
+        :return: (N, 2(width, height)) Same order as file_paths. (e.g. for AspectRatioBatchSampler)
+        """
+        return self.image_sizes[self._target_mask(valid_only, valid_suffixes)]
+
+    def _target_mask(self, valid_only: bool, valid_suffixes: Optional[List[str]]) -> np.ndarray:
+        is_target = self.is_valid.copy() if valid_only else np.ones(len(self), dtype=bool)
+        if valid_suffixes is not None:
+            is_target &= np.array([any(fnmatch.fnmatchcase(os.fsdecode(name), suffix) for suffix in valid_suffixes)
+                                   for name in self.names.tolist()], dtype=bool)
+        return is_target
+
+    def invalid_file_paths(self) -> List[str]:
+        return sorted(set(self.file_paths(valid_only=False)) - set(self.file_paths()))
+
+    def _records_by_dir(self) -> Dict[str, Tuple[int, np.ndarray]]:
+        """
+        :return: dict of directory path and (mtime, file indices)
+        """
+        order = np.argsort(self.dir_ids, kind="stable")
+        boundaries = np.searchsorted(self.dir_ids[order], np.arange(self.dir_paths.shape[0] + 1))
+        return {os.fsdecode(dir_path): (mtime, order[boundaries[i]:boundaries[i + 1]])
+                for i, (dir_path, mtime) in enumerate(zip(self.dir_paths.tolist(), self.dir_mtimes.tolist()))}
+
+
+def build_manifest(root_dir: str, manifest_path: str = None, valid_suffixes: List[str] = None,
+                   recursive: bool = True, verify: bool = True, n_workers: int = 16) -> ImageManifest:
+    """
+    Scan image files by os.scandir in threads. If manifest_path exists, directories whose mtime is not changed are
+    not scanned again, and files whose size and mtime are not changed are not opened again.
+    Note that files overwritten in place do not change mtime of directory.
+    :param root_dir:
+    :param manifest_path: npz file. Updated after scanning.
+    :param valid_suffixes: File name patterns. Default is png, jpg, jpeg and bmp.
+    :param recursive: Scan sub directories.
+    :param verify: Decode whole image to check it is not broken. If False, only header is read.
+    :param n_workers: Number of threads. Many threads are effective on network file system.
+    :return:
+    """
+    valid_suffixes = valid_suffixes or DEFAULT_SUFFIXES
+    root_dir = os.path.abspath(root_dir)
+    old_manifest: Optional[ImageManifest] = None
+    if manifest_path is not None and os.path.exists(manifest_path):
+        old_manifest = ImageManifest.load(manifest_path)
+        # Files of sub directories are missing or extra if recursive is different.
+        if os.fsdecode(old_manifest.root_dir.item()) != root_dir or \
+                old_manifest.valid_suffixes.tolist() != valid_suffixes or \
+                old_manifest.recursive is None or bool(old_manifest.recursive.item()) != recursive:
+            old_manifest = None
+    old_records = old_manifest._records_by_dir() if old_manifest is not None else {}
+    old_child_dirs: Dict[str, List[str]] = {}
+    for dir_path in old_records.keys():
+        if dir_path != root_dir:
+            old_child_dirs.setdefault(os.path.dirname(dir_path), []).append(dir_path)
+
+    # Scan directories level by level. Unchanged directories reuse old records.
+    dir_results: Dict[str, Tuple[int, Optional[List[_FileStat]]]] = {}
+    scan_stats = {"scanned_dirs": 0, "reused_dirs": 0, "probed_files": 0}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        current_dirs = [root_dir]
+        while len(current_dirs) > 0:
+            mtimes = list(executor.map(lambda dir_path: os.stat(dir_path).st_mtime_ns, current_dirs))
+            scan_dirs = [dir_path for dir_path, mtime in zip(current_dirs, mtimes)
+                         if dir_path not in old_records or old_records[dir_path][0] != mtime]
+            next_dirs = []
+            for dir_path, mtime in zip(current_dirs, mtimes):
+                if dir_path in old_records and old_records[dir_path][0] == mtime:
+                    dir_results[dir_path] = (mtime, None)
+                    next_dirs += old_child_dirs.get(dir_path, [])
+            # mtime before scan, so changes while scanning are scanned next time.
+            mtime_by_dir = dict(zip(current_dirs, mtimes))
+            for dir_path, (child_dirs, files) in zip(
+                    scan_dirs, executor.map(lambda dir_path: _scan_directory(dir_path, valid_suffixes), scan_dirs)):
+                dir_results[dir_path] = (mtime_by_dir[dir_path], files)
+                next_dirs += child_dirs
+            scan_stats["scanned_dirs"] += len(scan_dirs)
+            scan_stats["reused_dirs"] += len(current_dirs) - len(scan_dirs)
+            current_dirs = next_dirs if recursive else []
+
+        dir_paths = sorted(dir_results.keys())
+        # Columns by directory: names, sizes, mtimes, image sizes, is_valid
+        dir_columns, probe_paths, probe_targets = [], [], []
+        for dir_path in dir_paths:
+            mtime, files = dir_results[dir_path]
+            old_indices = old_records[dir_path][1] if dir_path in old_records else np.zeros([0], dtype=np.int64)
+            if files is None:
+                dir_columns.append(_take_columns(old_manifest, old_indices))
+                continue
+            files = sorted(files)
+            names = np.array([os.fsencode(name) for name, _, _ in files], dtype=bytes).reshape(-1)
+            sizes = np.array([size for _, size, _ in files], dtype=np.int64)
+            mtimes = np.array([file_mtime for _, _, file_mtime in files], dtype=np.int64)
+            image_sizes, is_valid = np.zeros([len(files), 2], dtype=np.int32), np.zeros([len(files)], dtype=bool)
+            old_files = {(name, size, file_mtime): i for name, size, file_mtime, i in zip(
+                old_manifest.names[old_indices].tolist(), old_manifest.sizes[old_indices].tolist(),
+                old_manifest.mtimes[old_indices].tolist(), old_indices.tolist())} if old_indices.shape[0] > 0 else {}
+            for i, name, size, file_mtime in zip(range(len(files)), names.tolist(), sizes.tolist(), mtimes.tolist()):
+                old_index = old_files.get((name, size, file_mtime))
+                if old_index is not None:
+                    image_sizes[i], is_valid[i] = old_manifest.image_sizes[old_index], old_manifest.is_valid[old_index]
+                else:
+                    probe_paths.append(os.path.join(dir_path, os.fsdecode(name)))
+                    probe_targets.append((image_sizes, is_valid, i))
+            dir_columns.append((names, sizes, mtimes, image_sizes, is_valid))
+        for (image_sizes, is_valid, i), (width, height, decodable) in zip(probe_targets, executor.map(
+                lambda file_path: _probe_image(file_path, verify), probe_paths)):
+            image_sizes[i], is_valid[i] = (width, height), decodable
+        scan_stats["probed_files"] = len(probe_paths)
+
+    manifest = ImageManifest(root_dir=np.array(os.fsencode(root_dir)), valid_suffixes=np.array(valid_suffixes),
+                             dir_paths=np.array([os.fsencode(dir_path) for dir_path in dir_paths], dtype=bytes),
+                             dir_mtimes=np.array([dir_results[dir_path][0] for dir_path in dir_paths],
+                                                 dtype=np.int64),
+                             dir_ids=np.repeat(np.arange(len(dir_paths), dtype=np.int32),
+                                               [columns[0].shape[0] for columns in dir_columns]),
+                             names=np.concatenate([columns[0] for columns in dir_columns]),
+                             sizes=np.concatenate([columns[1] for columns in dir_columns]),
+                             mtimes=np.concatenate([columns[2] for columns in dir_columns]),
+                             image_sizes=np.concatenate([columns[3] for columns in dir_columns]),
+                             is_valid=np.concatenate([columns[4] for columns in dir_columns]),
+                             recursive=np.array(recursive))
+    manifest.scan_stats = scan_stats
+    if manifest_path is not None:
+        manifest.save(manifest_path)
+    return manifest
@@ -0,0 +1,195 @@
+import json
+import os
+from typing import Tuple, Optional, Callable
+
+import cv2
+import numpy as np
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+from ..image_process.convert import pil_to_cv
+
+__all__ = ["pack_dataset", "PackedImageDataset"]
+
+TARGET_TYPES = ["label", "bboxes", "mask"]
+META_FILENAME = "meta.json"
+IMAGES_FILENAME = "images.u8"
+MASKS_FILENAME = "masks.u8"
+ORIGINAL_SIZES_FILENAME = "original_sizes.npy"
+LABELS_FILENAME = "labels.npy"
+BBOXES_FILENAME = "bboxes.npy"
+BBOX_OFFSETS_FILENAME = "bbox_offsets.npy"
+
+
+class _ResizeDataset(Dataset):
+    """
+    Decode and resize in DataLoader workers.
+    """
+
+    def __init__(self, dataset: Dataset, image_size: Tuple[int, int], target_type: str,
+                 target_transform: Optional[Callable]):
+        self._dataset = dataset
+        self._image_size = image_size
+        self._target_type = target_type
+        self._target_transform = target_transform
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def __getitem__(self, idx):
+        image, target = self._dataset[idx]
+        if self._target_transform is not None:
+            target = self._target_transform(target)
+        image = pil_to_cv(image.convert("RGB")) if isinstance(image, Image.Image) else np.asarray(image)
+        height, width = image.shape[:2]
+        image = cv2.resize(image, (self._image_size[1], self._image_size[0]), interpolation=cv2.INTER_AREA)
+
+        if self._target_type == "label":
+            target = np.int64(target)
+        elif self._target_type == "bboxes":
+            target = np.asarray(target, dtype=np.float32).reshape(-1, 5)
+            target[:, [0, 2]] *= self._image_size[1] / width
+            target[:, [1, 3]] *= self._image_size[0] / height
+        else:
+            target = cv2.resize(np.asarray(target, dtype=np.uint8), (self._image_size[1], self._image_size[0]),
+                                interpolation=cv2.INTER_NEAREST)
+        return image, target, (width, height)
+
+
+def _identity(sample):
+    return sample
+
+
+def pack_dataset(dataset: Dataset, out_dir: str, image_size: Tuple[int, int], target_type: str,
+                 target_transform: Optional[Callable] = None, n_workers: int = 0):
+    """
+    Decode and resize all images once and write them to one uint8 file for PackedImageDataset.
+    Images are stored as BGR (same as pil_to_cv), so Albumentations wrapper transforms can be used as they are.
+    :param dataset: Dataset without transforms. Returns (PIL image or np.ndarray, target).
+    :param out_dir:
+    :param image_size: (height, width)
+    :param target_type: "label"(int), "bboxes"(N * 5(x_min, y_min, x_max, y_max, label)) or "mask"(index image)
+    :param target_transform: Applied to target before packing. (e.g. VOCAnnotationTransform for torchvision VOC)
+    :param n_workers: Number of DataLoader workers for decoding.
+    """
+    assert target_type in TARGET_TYPES, f"target_type must be in {TARGET_TYPES}"
+    os.makedirs(out_dir, exist_ok=True)
+    n_samples, (height, width) = len(dataset), image_size
+    images = np.memmap(os.path.join(out_dir, IMAGES_FILENAME), dtype=np.uint8, mode="w+",
+                       shape=(max(n_samples, 1), height, width, 3))
+    masks = np.memmap(os.path.join(out_dir, MASKS_FILENAME), dtype=np.uint8, mode="w+",
+                      shape=(max(n_samples, 1), height, width)) if target_type == "mask" else None
+    original_sizes = np.zeros([n_samples, 2], dtype=np.int32)
+    labels = np.zeros([n_samples], dtype=np.int64)
+    bboxes_ls = []
+
+    data_loader = DataLoader(_ResizeDataset(dataset, image_size, target_type, target_transform), batch_size=None,
+                             num_workers=n_workers, collate_fn=_identity)
+    for i, (image, target, original_size) in enumerate(data_loader):
+        images[i] = image
+        original_sizes[i] = original_size
+        if target_type == "label":
+            labels[i] = target
+        elif target_type == "bboxes":
+            bboxes_ls.append(target)
+        else:
+            masks[i] = target
+    images.flush()
+    del images
+    if masks is not None:
+        masks.flush()
+        del masks
+
+    np.save(os.path.join(out_dir, ORIGINAL_SIZES_FILENAME), original_sizes)
+    if target_type == "label":
+        np.save(os.path.join(out_dir, LABELS_FILENAME), labels)
+    elif target_type == "bboxes":
+        counts = [bboxes.shape[0] for bboxes in bboxes_ls]
+        np.save(os.path.join(out_dir, BBOXES_FILENAME),
+                np.concatenate(bboxes_ls) if n_samples > 0 else np.zeros([0, 5], dtype=np.float32))
+        np.save(os.path.join(out_dir, BBOX_OFFSETS_FILENAME), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    # Write meta at last. Incomplete directory has no meta.
+    with open(os.path.join(out_dir, META_FILENAME), "w") as file:
+        json.dump({"n_samples": n_samples, "image_size": [height, width], "target_type": target_type}, file)
+
+
+class PackedImageDataset(Dataset):
+    """
+    Dataset of pack_dataset output. Images and masks are read-only views of memory mapped file (no decode, no copy),
+    so copy them before modifying in place.
+    """
+
+    def __init__(self, root_dir: str, transforms: Optional[Callable] = None):
+        """
+        :param root_dir: out_dir of pack_dataset.
+        :param transforms: Called with (image (H, W, 3) BGR uint8, target).
+        """
+        with open(os.path.join(root_dir, META_FILENAME), "r") as file:
+            meta = json.load(file)
+        self._root_dir = root_dir
+        self._transforms = transforms
+        self._n_samples = meta["n_samples"]
+        self._image_size = tuple(meta["image_size"])
+        self._target_type = meta["target_type"]
+        self._original_sizes = np.load(os.path.join(root_dir, ORIGINAL_SIZES_FILENAME))
+        self._labels = np.load(os.path.join(root_dir, LABELS_FILENAME)) if self._target_type == "label" else None
+        if self._target_type == "bboxes":
+            self._bboxes = np.load(os.path.join(root_dir, BBOXES_FILENAME))
+            self._bbox_offsets = np.load(os.path.join(root_dir, BBOX_OFFSETS_FILENAME))
+        self._images, self._masks = None, None
+
+    def _open(self):
+        # Opened lazily in each process, so memory map is not pickled to DataLoader workers.
+        shape = (max(self._n_samples, 1),) + self._image_size
+        self._images = np.memmap(os.path.join(self._root_dir, IMAGES_FILENAME), dtype=np.uint8, mode="r",
+                                 shape=shape + (3,))
+        if self._target_type == "mask":
+            self._masks = np.memmap(os.path.join(self._root_dir, MASKS_FILENAME), dtype=np.uint8, mode="r",
+                                    shape=shape)
+
+    def __len__(self):
+        return self._n_samples
+
+    def __getitem__(self, idx: int):
+        if idx < 0:
+            idx += self._n_samples
+        if not 0 <= idx < self._n_samples:
+            raise IndexError(f"Index {idx} is out of range.")
+        if self._images is None:
+            self._open()
+        image = self._images[idx]
+        if self._target_type == "label":
+            target = int(self._labels[idx])
+        elif self._target_type == "bboxes":
+            target = self._bboxes[self._bbox_offsets[idx]:self._bbox_offsets[idx + 1]]
+        else:
+            target = self._masks[idx]
+        if self._transforms:
+            return self._transforms(image, target)
+        return image, target
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"], state["_masks"] = None, None
+        return state
+
+    @property
+    def image_size(self) -> Tuple[int, int]:
+        """
+        :return: (height, width)
+        """
+        return self._image_size
+
+    @property
+    def original_image_sizes(self) -> np.ndarray:
+        """
+        :return: (N, 2(width, height)) Image size before resize.
+        """
+        return self._original_sizes
+
+    @property
+    def labels(self) -> Optional[np.ndarray]:
+        """
+        Label of each sample if target type is label. Used for ClassResamplingSampler.
+        """
+        return self._labels
@@ -0,0 +1,229 @@
+import math
+from typing import List, Iterator, Tuple, Dict
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler, Dataset, DistributedSampler
+
+__all__ = ["sample_indices_by_classes", "ClassResamplingSampler", "DatasetEpochSampler", "create_bucket_shapes",
+           "letterbox_padding_ratio", "AspectRatioBatchSampler"]
+
+DEFAULT_ASPECT_RATIOS = (0.5, 0.75, 1., 4 / 3, 2.)
+
+
+def sample_indices_by_classes(labels: np.ndarray, sampling_rate: List[float], random_state: np.random.Generator,
+                              shuffle: bool = True) -> np.ndarray:
+    """
+    Under/Over sampling by classes at once.
+    Each class has round(rate * count) indices. Samples are repeated rate // 1 times and the rest are chosen randomly.
+    :param labels: (N, ) Label of each sample.
+    :param sampling_rate: Sampling rate by class. Less than 1 is under sampling and greater than 1 is over sampling.
+    :param random_state:
+    :param shuffle: If False, result is sorted by index.
+    :return: Sampled indices.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    sampling_rate = np.asarray(sampling_rate, dtype=np.float64)
+    counts = np.bincount(labels, minlength=sampling_rate.shape[0])
+    n_targets = np.round(sampling_rate * counts[:sampling_rate.shape[0]]).astype(np.int64)
+
+    # Random position of each sample in its class.
+    order = np.lexsort((random_state.random(labels.shape[0]), labels))
+    class_offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    positions = np.empty_like(order)
+    positions[order] = np.arange(labels.shape[0]) - class_offsets[labels[order]]
+
+    safe_counts = np.maximum(counts, 1)[labels]
+    n_copies = n_targets[labels] // safe_counts + (positions < n_targets[labels] % safe_counts)
+    indices = np.repeat(np.arange(labels.shape[0]), n_copies)
+    return random_state.permutation(indices) if shuffle else indices
+
+
+class ClassResamplingSampler(Sampler):
+    """
+    Sampler for under/over sampling by classes. Indices of each epoch are generated at once from seed and epoch,
+    so they are reproducible and same in all processes. Under DDP, each process takes its own part of them
+    like DistributedSampler.
+    """
+
+    def __init__(self, labels: np.ndarray, sampling_rate: List[float], shuffle: bool = True, seed: int = 0,
+                 num_replicas: int = None, rank: int = None):
+        """
+        :param labels: (N, ) Label of each sample of dataset.
+        :param sampling_rate: Sampling rate by class.
+        :param shuffle:
+        :param seed:
+        :param num_replicas: Default is world size.
+        :param rank: Default is rank of current process.
+        """
+        is_distributed = dist.is_available() and dist.is_initialized()
+        self._labels = np.asarray(labels, dtype=np.int64)
+        self._sampling_rate = sampling_rate
+        self._shuffle = shuffle
+        self._seed = seed
+        self._num_replicas = num_replicas or (dist.get_world_size() if is_distributed else 1)
+        self._rank = rank if rank is not None else (dist.get_rank() if is_distributed else 0)
+        self._epoch = 0
+        counts = np.bincount(self._labels, minlength=len(sampling_rate))[:len(sampling_rate)]
+        self._total_size = int(np.round(np.asarray(sampling_rate) * counts).astype(np.int64).sum())
+
+    def __iter__(self) -> Iterator[int]:
+        random_state = np.random.default_rng([self._seed, self._epoch])
+        indices = sample_indices_by_classes(self._labels, self._sampling_rate, random_state, shuffle=self._shuffle)
+        # Pad to be divisible by number of processes.
+        indices = np.resize(indices, len(self) * self._num_replicas)
+        return iter(indices[self._rank::self._num_replicas].tolist())
+
+    def __len__(self):
+        return math.ceil(self._total_size / self._num_replicas)
+
+    def set_epoch(self, epoch: int):
+        self._epoch = epoch
+
+
+class DatasetEpochSampler(DistributedSampler):
+    """
+    DistributedSampler which also calls set_epoch of dataset, for datasets resampled by epoch.
+    (e.g. CSVAnnotationDatasetWithUnderSampling) Lightning calls set_epoch of sampler at start of each epoch,
+    and does not replace it with DistributedSampler under DDP.
+    """
+
+    def __init__(self, dataset: Dataset, shuffle: bool = True, seed: int = 0, num_replicas: int = None,
+                 rank: int = None):
+        """
+        :param dataset: Dataset with set_epoch.
+        :param shuffle:
+        :param seed:
+        :param num_replicas: Default is world size, 1 if not distributed.
+        :param rank: Default is rank of current process, 0 if not distributed.
+        """
+        is_distributed = dist.is_available() and dist.is_initialized()
+        num_replicas = num_replicas or (dist.get_world_size() if is_distributed else 1)
+        rank = rank if rank is not None else (dist.get_rank() if is_distributed else 0)
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+
+    def set_epoch(self, epoch: int):
+        super().set_epoch(epoch)
+        self.dataset.set_epoch(epoch)
+
+
+def create_bucket_shapes(base_size: int, aspect_ratios: List[float], size_divisor: int = 32) -> np.ndarray:
+    """
+    Shapes with about same area as base_size * base_size.
+    :param base_size:
+    :param aspect_ratios: width / height of each bucket.
+    :param size_divisor: Height and width are multiple of this. (e.g. 32 for EfficientDet and UNet)
+    :return: (buckets, 2(height, width))
+    """
+    aspect_ratios = np.asarray(aspect_ratios, dtype=np.float64)
+    heights = base_size / np.sqrt(aspect_ratios)
+    widths = base_size * np.sqrt(aspect_ratios)
+    shapes = np.stack([heights, widths], axis=1)
+    return np.maximum(np.round(shapes / size_divisor), 1).astype(np.int64) * size_divisor
+
+
+def letterbox_padding_ratio(image_sizes: np.ndarray, shapes: np.ndarray) -> float:
+    """
+    Ratio of padding pixels when images are resized into shapes keeping aspect ratio.
+    :param image_sizes: (N, 2(width, height))
+    :param shapes: (N, 2(height, width)) or (2, ) Output shape of each image.
+    """
+    image_sizes = np.asarray(image_sizes, dtype=np.float64)
+    shapes = np.broadcast_to(np.asarray(shapes, dtype=np.float64), image_sizes.shape)
+    scales = np.minimum(shapes[:, 0] / image_sizes[:, 1], shapes[:, 1] / image_sizes[:, 0])
+    content_pixels = image_sizes[:, 0] * image_sizes[:, 1] * scales ** 2
+    total_pixels = shapes[:, 0] * shapes[:, 1]
+    return float(1. - content_pixels.sum() / total_pixels.sum())
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batch sampler grouping images by aspect ratio. Each image belongs to the bucket with the nearest aspect ratio,
+    and all images of a batch are in one bucket.
+    Items of batch are (index, (height, width)) of bucket, use BucketTransformsWrapperDataset to resize each image
+    to the shape. So batches are stacked by AdjustDetectionTensorCollator or default collate.
+    """
+
+    def __init__(self, image_sizes: np.ndarray, batch_size: int, base_size: int,
+                 aspect_ratios: List[float] = DEFAULT_ASPECT_RATIOS, size_divisor: int = 32, shuffle: bool = True,
+                 seed: int = 0, drop_last: bool = False, num_replicas: int = None, rank: int = None):
+        """
+        :param image_sizes: (N, 2(width, height)) Original image sizes of dataset.
+        (e.g. ImageManifest.file_image_sizes, PackedImageDataset.original_image_sizes)
+        :param batch_size:
+        :param base_size: Shapes of buckets have about same area as base_size * base_size.
+        :param aspect_ratios: width / height of buckets.
+        :param size_divisor:
+        :param shuffle:
+        :param seed:
+        :param drop_last: Drop last incomplete batch of each bucket.
+        :param num_replicas: Default is world size.
+        :param rank: Default is rank of current process.
+        """
+        is_distributed = dist.is_available() and dist.is_initialized()
+        self._image_sizes = np.asarray(image_sizes, dtype=np.int64)
+        self._batch_size = batch_size
+        self._base_size = base_size
+        self._bucket_shapes = create_bucket_shapes(base_size, aspect_ratios, size_divisor)
+        self._shuffle = shuffle
+        self._seed = seed
+        self._drop_last = drop_last
+        self._num_replicas = num_replicas or (dist.get_world_size() if is_distributed else 1)
+        self._rank = rank if rank is not None else (dist.get_rank() if is_distributed else 0)
+        self._epoch = 0
+        # Nearest in log scale.
+        image_log_ratios = np.log(self._image_sizes[:, 0] / self._image_sizes[:, 1])
+        bucket_log_ratios = np.log(self._bucket_shapes[:, 1] / self._bucket_shapes[:, 0])
+        self._bucket_ids = np.argmin(np.abs(image_log_ratios[:, None] - bucket_log_ratios[None, :]), axis=1)
+        bucket_counts = np.bincount(self._bucket_ids, minlength=self._bucket_shapes.shape[0])
+        n_batches = bucket_counts // batch_size if drop_last else -(-bucket_counts // batch_size)
+        self._n_batches = int(n_batches.sum())
+
+    def __iter__(self) -> Iterator[List[Tuple[int, Tuple[int, int]]]]:
+        random_state = np.random.default_rng([self._seed, self._epoch])
+        order = random_state.permutation(self._bucket_ids.shape[0]) if self._shuffle \
+            else np.arange(self._bucket_ids.shape[0])
+        order = order[np.argsort(self._bucket_ids[order], kind="stable")]
+        bucket_ids = self._bucket_ids[order]
+        # Split sorted indices at bucket boundaries and every batch_size in bucket.
+        bucket_starts = np.searchsorted(bucket_ids, np.arange(self._bucket_shapes.shape[0]))
+        positions_in_bucket = np.arange(order.shape[0]) - bucket_starts[bucket_ids]
+        is_batch_start = positions_in_bucket % self._batch_size == 0
+        batches = np.split(order, np.nonzero(is_batch_start)[0][1:])
+        if self._drop_last:
+            batches = [batch for batch in batches if batch.shape[0] == self._batch_size]
+        batch_order = random_state.permutation(len(batches)) if self._shuffle else np.arange(len(batches))
+        # Pad to be divisible by number of processes.
+        batch_order = np.resize(batch_order, len(self) * self._num_replicas)[self._rank::self._num_replicas]
+        for batch_index in batch_order.tolist():
+            batch = batches[batch_index]
+            height, width = self._bucket_shapes[self._bucket_ids[batch[0]]].tolist()
+            yield [(index, (height, width)) for index in batch.tolist()]
+
+    def __len__(self):
+        return math.ceil(self._n_batches / self._num_replicas)
+
+    def set_epoch(self, epoch: int):
+        self._epoch = epoch
+
+    @property
+    def bucket_shapes(self) -> np.ndarray:
+        """
+        :return: (buckets, 2(height, width))
+        """
+        return self._bucket_shapes
+
+    def padding_report(self) -> Dict[str, float]:
+        """
+        Compare padding pixels with resizing all images into base_size * base_size keeping aspect ratio.
+        :return: dict of fixed_padding_ratio, bucket_padding_ratio and saved_pixels_ratio (ratio of total pixels).
+        """
+        fixed_shape = np.array([self._base_size, self._base_size])
+        fixed_padding_ratio = letterbox_padding_ratio(self._image_sizes, fixed_shape)
+        bucket_shapes = self._bucket_shapes[self._bucket_ids]
+        bucket_padding_ratio = letterbox_padding_ratio(self._image_sizes, bucket_shapes)
+        fixed_padding_pixels = fixed_padding_ratio * self._base_size ** 2 * self._image_sizes.shape[0]
+        bucket_padding_pixels = bucket_padding_ratio * np.prod(bucket_shapes, axis=1).sum()
+        return {"fixed_padding_ratio": fixed_padding_ratio, "bucket_padding_ratio": bucket_padding_ratio,
+                "saved_pixels_ratio": float((fixed_padding_pixels - bucket_padding_pixels) /
+                                            (self._base_size ** 2 * self._image_sizes.shape[0]))}
@@ -1,34 +1,35 @@
 from typing import List, Optional, Callable
-from PIL import Image
 from torch.utils.data import Dataset
 from pathlib import Path
 
-from .common import create_filepath_ls
+from .cache import SharedImageCache
+from .common import create_filepath_ls, open_image, StringArray
 
 
 class IndexImageDataset(Dataset):
     @staticmethod
     def create(image_dir_path: str, index_image_dir_path: str, transforms: Optional[Callable],
-               valid_suffixes: List[str] = None):
-        image_path_ls = create_filepath_ls(image_dir_path, valid_suffixes)
-        return IndexImageDataset(image_path_ls, image_dir_path, index_image_dir_path, transforms)
+               valid_suffixes: List[str] = None, cache: SharedImageCache = None, manifest_path: str = None):
+        image_path_ls = create_filepath_ls(image_dir_path, valid_suffixes, manifest_path=manifest_path)
+        return IndexImageDataset(image_path_ls, image_dir_path, index_image_dir_path, transforms, cache=cache)
 
     def __init__(self, image_filename_ls: List[Path], image_dir: str, index_image_dir: str,
-                 transform: Optional[Callable]):
+                 transform: Optional[Callable], cache: SharedImageCache = None):
         self._transform = transform
+        self._cache = cache
         self._image_dir = Path(image_dir)
         self._index_image_dir = Path(index_image_dir)
-        self._image_filename_ls = image_filename_ls
+        self._image_filename_ls = StringArray([Path(image_filename).name for image_filename in image_filename_ls])
 
     def __len__(self):
         return len(self._image_filename_ls)
 
     def __getitem__(self, idx: int):
-        image_name = self._image_filename_ls[idx].name
+        image_name = self._image_filename_ls[idx]
         image_path = self._image_dir.joinpath(image_name)
         index_image_path = self._index_image_dir.joinpath(f"{Path(image_name).stem}.png")
-        image = Image.open(str(image_path)).convert("RGB")
-        index_image = Image.open(str(index_image_path))
+        image = open_image(str(image_path), cache=self._cache)
+        index_image = open_image(str(index_image_path), mode=None, cache=self._cache)
         if self._transform:
             return self._transform(image, index_image)
         return image, index_image
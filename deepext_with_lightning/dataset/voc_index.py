@@ -0,0 +1,159 @@
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+__all__ = ["VOCAnnotation", "VOCAnnotationIndex"]
+
+_POINTS = ["xmin", "ymin", "xmax", "ymax"]
+
+
+class VOCAnnotation(NamedTuple):
+    width: int
+    height: int
+    names: np.ndarray  # (N, ) Class names.
+    boxes: np.ndarray  # (N, 4(x_min, y_min, x_max, y_max)) Values in XML.
+
+
+def _parse_voc_annotation(annotation_path: str) -> Tuple[int, int, List[str], np.ndarray]:
+    root = ET.parse(annotation_path).getroot()
+    names, boxes = [], []
+    for obj in root.iter("object"):
+        bbox_obj = obj.find("bndbox")
+        if bbox_obj is None:
+            continue
+        names.append(obj.find("name").text)
+        boxes.append([float(bbox_obj.find(point).text) for point in _POINTS])
+    return int(root.find("size/width").text), int(root.find("size/height").text), names, \
+           np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+def _take_ragged(offsets: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: Flat indices of rows, new offsets.
+    """
+    counts = offsets[rows + 1] - offsets[rows]
+    new_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    flat_indices = np.repeat(offsets[rows] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return flat_indices, new_offsets
+
+
+class VOCAnnotationIndex:
+    """
+    All VOC XML annotations parsed once. Boxes are one ragged array (flat boxes and offsets by file),
+    so an annotation is read in O(1) without parsing XML.
+    """
+
+    @staticmethod
+    def build(annotation_paths: List[str], cache_path: str = None, n_workers: int = None) -> 'VOCAnnotationIndex':
+        """
+        Parse XML files in parallel. If cache_path is given, files whose mtime is not changed are read from cache,
+        and cache is updated.
+        :param annotation_paths:
+        :param cache_path: npz file path.
+        :param n_workers: Number of processes. If 0, parse in this process. Default is CPU count.
+        """
+        paths = np.array([os.path.abspath(str(path)) for path in annotation_paths], dtype=str)
+        mtimes = np.array([os.stat(path).st_mtime_ns for path in paths], dtype=np.int64)
+        cached = VOCAnnotationIndex.load(cache_path) \
+            if cache_path is not None and os.path.exists(cache_path) else VOCAnnotationIndex.empty()
+
+        cached_rows = cached._rows_of(paths)
+        is_reused = cached_rows >= 0
+        is_reused[is_reused] = cached._mtimes[cached_rows[is_reused]] == mtimes[is_reused]
+        # Rows are read by index of dataset (get_by_row), so cached order must also be same.
+        if np.all(is_reused) and np.array_equal(cached._paths, paths):
+            return cached
+
+        parse_paths = paths[~is_reused].tolist()
+        if n_workers == 0 or len(parse_paths) == 0:
+            parsed = [_parse_voc_annotation(path) for path in parse_paths]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                parsed = list(executor.map(_parse_voc_annotation, parse_paths,
+                                           chunksize=max(1, len(parse_paths) // ((n_workers or os.cpu_count()) * 4))))
+
+        # Reused rows and parsed rows are concatenated and then reordered.
+        reused_flat, reused_offsets = _take_ragged(cached._offsets, cached_rows[is_reused])
+        parsed_counts = [boxes.shape[0] for _, _, _, boxes in parsed]
+        parsed_names = np.array([name for _, _, names, _ in parsed for name in names], dtype=str)
+        names, name_ids = np.unique(np.concatenate([cached._names[cached._name_ids[reused_flat]], parsed_names]),
+                                    return_inverse=True)
+        boxes = np.concatenate([cached._boxes[reused_flat]] + [boxes for _, _, _, boxes in parsed]).reshape(-1, 4)
+        offsets = np.concatenate([reused_offsets, reused_offsets[-1] + np.cumsum(parsed_counts, dtype=np.int64)])
+        sizes = np.concatenate([cached._sizes[cached_rows[is_reused]],
+                                np.array([[width, height] for width, height, _, _ in parsed],
+                                         dtype=np.int32).reshape(-1, 2)])
+        order = np.argsort(np.concatenate([np.nonzero(is_reused)[0], np.nonzero(~is_reused)[0]]), kind="stable")
+        flat_indices, offsets = _take_ragged(offsets, order)
+        index = VOCAnnotationIndex(paths, mtimes, sizes[order], boxes[flat_indices],
+                                   name_ids[flat_indices].astype(np.int32), names, offsets)
+        if cache_path is not None:
+            index.save(cache_path)
+        return index
+
+    @staticmethod
+    def empty() -> 'VOCAnnotationIndex':
+        return VOCAnnotationIndex(np.array([], dtype=str), np.zeros([0], dtype=np.int64),
+                                  np.zeros([0, 2], dtype=np.int32), np.zeros([0, 4], dtype=np.float32),
+                                  np.zeros([0], dtype=np.int32), np.array([], dtype=str), np.zeros([1], dtype=np.int64))
+
+    @staticmethod
+    def load(cache_path: str) -> 'VOCAnnotationIndex':
+        with np.load(cache_path) as data:
+            return VOCAnnotationIndex(data["paths"], data["mtimes"], data["sizes"], data["boxes"], data["name_ids"],
+                                      data["names"], data["offsets"])
+
+    def __init__(self, paths: np.ndarray, mtimes: np.ndarray, sizes: np.ndarray, boxes: np.ndarray,
+                 name_ids: np.ndarray, names: np.ndarray, offsets: np.ndarray):
+        """
+        :param paths: (N, ) Absolute annotation file paths.
+        :param mtimes: (N, ) mtime(ns) when parsed.
+        :param sizes: (N, 2(width, height))
+        :param boxes: (Total boxes, 4) Flat boxes of all files.
+        :param name_ids: (Total boxes, ) Index of names.
+        :param names: (Class names, )
+        :param offsets: (N + 1, ) Boxes of file i are boxes[offsets[i]:offsets[i + 1]].
+        """
+        self._paths, self._mtimes, self._sizes = paths, mtimes, sizes
+        self._boxes, self._name_ids, self._names, self._offsets = boxes, name_ids, names, offsets
+        # Sorted fixed width strings instead of dict of str, so lookups in forked DataLoader workers do not update
+        # reference counts (pages stay shared).
+        self._path_order = np.argsort(paths, kind="stable")
+        self._sorted_paths = paths[self._path_order]
+
+    def save(self, cache_path: str):
+        # Write and rename, so other processes do not read half written file.
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, paths=self._paths, mtimes=self._mtimes, sizes=self._sizes, boxes=self._boxes,
+                 name_ids=self._name_ids, names=self._names, offsets=self._offsets)
+        os.replace(tmp_path, cache_path)
+
+    def __len__(self):
+        return self._paths.shape[0]
+
+    def __contains__(self, annotation_path: str):
+        return self._rows_of(np.array([os.path.abspath(str(annotation_path))]))[0] >= 0
+
+    def __getitem__(self, annotation_path: str) -> VOCAnnotation:
+        row = self._rows_of(np.array([os.path.abspath(str(annotation_path))]))[0]
+        if row < 0:
+            raise KeyError(annotation_path)
+        return self.get_by_row(int(row))
+
+    def _rows_of(self, paths: np.ndarray) -> np.ndarray:
+        """
+        :param paths: (N, ) Absolute paths.
+        :return: (N, ) Rows of paths, -1 if not indexed.
+        """
+        if len(self) == 0:
+            return np.full(paths.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_paths, paths), len(self) - 1)
+        return np.where(self._sorted_paths[positions] == paths, self._path_order[positions], -1).astype(np.int64)
+
+    def get_by_row(self, row: int) -> VOCAnnotation:
+        start, end = self._offsets[row], self._offsets[row + 1]
+        width, height = self._sizes[row].tolist()
+        return VOCAnnotation(width, height, self._names[self._name_ids[start:end]], self._boxes[start:end])
@@ -110,6 +110,8 @@ def img_to_cv(img: Image.Image or torch.Tensor or np.ndarray):
 
 
 def normalize255(img: np.ndarray):
+    if img.dtype == np.uint8:  # Already 0~255. (uint8 transport)
+        return img
     return (img * 255).astype("uint8")
 
 
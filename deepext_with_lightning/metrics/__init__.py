@@ -1 +1 @@
-from . import classification, segmentation, object_detection
+from . import classification, segmentation, object_detection, async_metric
@@ -0,0 +1,71 @@
+import queue
+import threading
+
+import torch
+import pytorch_lightning as pl
+
+
+class AsyncMetric(torch.nn.Module):
+    """
+    Run update of wrapped metric in background thread to overlap it with forward of next batch.
+    Inputs are passed as they are, so they must not be modified after update.
+    compute and reset wait until all queued updates are finished.
+    """
+
+    def __init__(self, metric: pl.metrics.Metric, max_queue_size: int = 4):
+        """
+        :param metric:
+        :param max_queue_size: update blocks while this number of inputs are waiting.
+        """
+        super().__init__()
+        self.metric = metric
+        self._max_queue_size = max_queue_size
+        self._queue, self._thread, self._error = None, None, None
+
+    def forward(self, *args, **kwargs):
+        self.update(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self._raise_error()
+        if self._thread is None or not self._thread.is_alive():
+            self._queue = queue.Queue(maxsize=self._max_queue_size)
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True)
+            self._thread.start()
+        self._queue.put((args, kwargs))
+
+    def join(self):
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def compute(self):
+        self.join()
+        return self.metric.compute()
+
+    def reset(self):
+        self.join()
+        self.metric.reset()
+
+    def _run(self, input_queue: queue.Queue):
+        while True:
+            args, kwargs = input_queue.get()
+            try:
+                # Skip remaining inputs after error.
+                if self._error is None:
+                    self.metric(*args, **kwargs)
+            except Exception as e:
+                self._error = e
+            finally:
+                input_queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def __getstate__(self):
+        # Queue and thread can not be pickled (e.g. ddp_spawn).
+        self.join()
+        state = self.__dict__.copy()
+        state["_queue"], state["_thread"] = None, None
+        return state
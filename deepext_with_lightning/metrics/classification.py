@@ -2,7 +2,7 @@ import torch
 import pytorch_lightning as pl
 
 
-class ClassificationAccuracy(pl.metrics.Metric):
+class ClassificationConfusionMatrix(pl.metrics.Metric):
     def __init__(self, n_classes: int, by_classes=False, average=False):
         if by_classes and average:
             raise ValueError("by_classes and average must be either")
@@ -10,14 +10,26 @@ class ClassificationAccuracy(pl.metrics.Metric):
         self._n_classes = n_classes
         self._by_classes = by_classes
         self._average = average
+        # Rows are predictions, columns are targets.
         self.add_state("confusion_matrix",
-                       default=torch.zeros((n_classes, n_classes)))
+                       default=torch.zeros((n_classes, n_classes)), dist_reduce_fx="sum")
 
     def update(self, preds: torch.Tensor, targets: torch.Tensor):
-        for i in range(preds.shape[0]):
-            self.confusion_matrix[preds[i], targets[i]] += 1
+        """
+        :param preds: (Batch size, ) Label index.
+        :param targets: (Batch size, ) Label index.
+        """
+        indices = preds.reshape(-1).long() * self._n_classes + targets.reshape(-1).long()
+        counts = torch.bincount(indices, minlength=self._n_classes ** 2)
+        self.confusion_matrix += counts.reshape(self._n_classes, self._n_classes).to(self.confusion_matrix)
 
     def compute(self):
+        """
+        :return: (classes, classes) confusion matrix. Rows are predictions, columns are targets.
+        """
+        return self.confusion_matrix
+
+    def _compute_accuracy(self):
         tp = torch.diag(self.confusion_matrix)
         fn_tp = torch.sum(self.confusion_matrix, dim=0)
         if self._average:
@@ -27,23 +39,7 @@ class ClassificationAccuracy(pl.metrics.Metric):
             return tp / fn_tp
         return torch.sum(tp) / torch.sum(fn_tp)
 
-
-class ClassificationRecallPrecision(pl.metrics.Metric):
-    def __init__(self, n_classes: int, by_classes=False, average=False):
-        if by_classes and average:
-            raise ValueError("by_classes and average must be either")
-        super().__init__(compute_on_step=False)
-        self._n_classes = n_classes
-        self._by_classes = by_classes
-        self._average = average
-        self.add_state("confusion_matrix",
-                       default=torch.zeros((n_classes, n_classes)))
-
-    def update(self, preds: torch.Tensor, targets: torch.Tensor):
-        for i in range(preds.shape[0]):
-            self.confusion_matrix[preds[i], targets[i]] += 1
-
-    def compute(self):
+    def _compute_recall_precision(self):
         tp = torch.diag(self.confusion_matrix)
         fp_tp = torch.sum(self.confusion_matrix, dim=1)
         fn_tp = torch.sum(self.confusion_matrix, dim=0)
@@ -62,3 +58,38 @@ class ClassificationRecallPrecision(pl.metrics.Metric):
         recall = total_tp / total_fn_tp
         precision = total_tp / total_fp_tp
         return recall, precision
+
+
+class ClassificationAccuracy(ClassificationConfusionMatrix):
+    def compute(self):
+        return self._compute_accuracy()
+
+
+class ClassificationRecallPrecision(ClassificationConfusionMatrix):
+    def compute(self):
+        return self._compute_recall_precision()
+
+
+class ClassificationMetricCollection(ClassificationConfusionMatrix):
+    def compute(self):
+        """
+        All metrics are computed from one confusion matrix.
+        :return: dict of acc, recall, precision and f_score.
+        """
+        epsilon = 1e-8
+        recall, precision = self._compute_recall_precision()
+        if self._average:
+            # Average of F score by classes.
+            tp = torch.diag(self.confusion_matrix)
+            recall_by_classes = tp / torch.sum(self.confusion_matrix, dim=0)
+            precision_by_classes = tp / torch.sum(self.confusion_matrix, dim=1)
+            f_score = torch.mean(
+                2. * recall_by_classes * precision_by_classes / (recall_by_classes + precision_by_classes + epsilon))
+        else:
+            f_score = 2. * recall * precision / (recall + precision + epsilon)
+        return {
+            "acc": self._compute_accuracy(),
+            "recall": recall,
+            "precision": precision,
+            "f_score": f_score,
+        }
@@ -1,15 +1,25 @@
+from abc import abstractmethod
 from typing import List, Tuple, Union
 
 import numpy as np
 import torch
 
 import pytorch_lightning as pl
+from pytorch_lightning.utilities.distributed import gather_all_tensors
 
 
 def calc_area(bbox: np.ndarray):
     return (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
 
 
+def calc_areas(bboxes: np.ndarray) -> np.ndarray:
+    """
+    :param bboxes: ndarray (N, 4+(x_min, y_min, x_max, y_max, ...))
+    :return: ndarray (N, )
+    """
+    return (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+
+
 def calc_bbox_overlap_union_iou(pred: np.ndarray or None, teacher: np.ndarray) -> Tuple[float, float, float]:
     """
     :param pred: ndarray (4, )
@@ -31,6 +41,183 @@ def calc_bbox_overlap_union_iou(pred: np.ndarray or None, teacher: np.ndarray) -
     return overlap, union, iou
 
 
+def calc_bbox_overlap_union_iou_matrix(preds: np.ndarray, teachers: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Broadcasting version of calc_bbox_overlap_union_iou. Compute every (prediction, teacher) pair at once.
+    :param preds: ndarray (N, 4+(x_min, y_min, x_max, y_max, ...))
+    :param teachers: ndarray (M, 4+(x_min, y_min, x_max, y_max, ...))
+    :return: overlap (N, M), union (N, M), iou (N, M)
+    """
+    preds, teachers = preds[:, None, :4], teachers[None, :, :4]
+    intersection_width = np.maximum(
+        np.minimum(preds[..., 2], teachers[..., 2]) - np.maximum(preds[..., 0], teachers[..., 0]), 0)
+    intersection_height = np.maximum(
+        np.minimum(preds[..., 3], teachers[..., 3]) - np.maximum(preds[..., 1], teachers[..., 1]), 0)
+
+    overlap = intersection_width * intersection_height
+    pred_area = (preds[..., 2] - preds[..., 0]) * (preds[..., 3] - preds[..., 1])
+    teacher_area = (teachers[..., 2] - teachers[..., 0]) * (teachers[..., 3] - teachers[..., 1])
+    union = pred_area + teacher_area - overlap
+    iou = overlap / np.maximum(union, np.finfo(np.float64).eps)
+    return overlap, union, iou
+
+
+def match_bboxes(pred_bboxes: np.ndarray, target_bboxes: np.ndarray,
+                 iou_threshold: Union[float, List[float]] = 0.5, iou_matrix: np.ndarray = None) -> np.ndarray:
+    """
+    Greedy one-to-one matching between predictions and targets of the same class.
+    Predictions are visited in descending score order and take the unmatched target with the highest IoU.
+    If predictions have no score column, they are visited in given order.
+    :param pred_bboxes: (N, 5 or 6(x_min, y_min, x_max, y_max, label, score))
+    :param target_bboxes: (M, 5(x_min, y_min, x_max, y_max, label))
+    :param iou_threshold: Minimum IoU to be matched. If list is given, matching is done for each threshold
+                          with the same IoU matrix.
+    :param iou_matrix: (N, M) Precomputed IoU matrix.
+    :return: (N, ) or (thresholds, N) Matched target index of each prediction. -1 means not matched.
+    """
+    iou_thresholds = np.atleast_1d(np.asarray(iou_threshold, dtype=np.float64))
+    matched_indices = np.full([iou_thresholds.shape[0], pred_bboxes.shape[0]], -1, dtype=np.int64)
+    is_multi_threshold = np.ndim(iou_threshold) > 0
+    if pred_bboxes.shape[0] == 0 or target_bboxes.shape[0] == 0:
+        return matched_indices if is_multi_threshold else matched_indices[0]
+    if iou_matrix is None:
+        _, _, iou_matrix = calc_bbox_overlap_union_iou_matrix(pred_bboxes, target_bboxes)
+
+    is_same_class = pred_bboxes[:, 4].astype(np.int64)[:, None] == target_bboxes[:, 4].astype(np.int64)[None, :]
+    pred_indices, target_indices = np.nonzero(is_same_class & (iou_matrix >= iou_thresholds.min()))
+    if pred_indices.shape[0] == 0:
+        return matched_indices if is_multi_threshold else matched_indices[0]
+
+    # Visit candidate pairs by (score rank of prediction, descending IoU).
+    order = np.argsort(-pred_bboxes[:, 5], kind="stable") if pred_bboxes.shape[1] > 5 else np.arange(
+        pred_bboxes.shape[0])
+    pred_ranks = np.empty_like(order)
+    pred_ranks[order] = np.arange(order.shape[0])
+    pair_ious = iou_matrix[pred_indices, target_indices]
+    pair_order = np.lexsort((-pair_ious, pred_ranks[pred_indices]))
+    pred_indices, target_indices, pair_ious = pred_indices[pair_order], target_indices[pair_order], pair_ious[
+        pair_order]
+
+    for t, threshold in enumerate(iou_thresholds):
+        is_pair_valid = pair_ious >= threshold
+        is_pred_matched = [False for _ in range(pred_bboxes.shape[0])]
+        is_target_matched = [False for _ in range(target_bboxes.shape[0])]
+        for i, j in zip(pred_indices[is_pair_valid].tolist(), target_indices[is_pair_valid].tolist()):
+            if is_pred_matched[i] or is_target_matched[j]:
+                continue
+            matched_indices[t, i] = j
+            is_pred_matched[i] = True
+            is_target_matched[j] = True
+    return matched_indices if is_multi_threshold else matched_indices[0]
+
+
+def to_bbox_array(bboxes: Union[np.ndarray, torch.Tensor, List], n_columns: int) -> np.ndarray:
+    """
+    :param bboxes: Bounding boxes of 1 image. Empty list is allowed.
+    :param n_columns: Minimum column count of result.
+    :return: ndarray (N, n_columns or more)
+    """
+    if isinstance(bboxes, torch.Tensor):
+        bboxes = bboxes.cpu().detach().numpy()
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    if bboxes.size == 0:
+        return np.zeros([0, bboxes.shape[-1] if bboxes.ndim == 2 else n_columns])
+    return bboxes
+
+
+def calc_batch_areas(bboxes: torch.Tensor) -> torch.Tensor:
+    """
+    :param bboxes: Tensor (..., N, 4+(x_min, y_min, x_max, y_max, ...))
+    :return: Tensor (..., N)
+    """
+    return (bboxes[..., 2] - bboxes[..., 0]) * (bboxes[..., 3] - bboxes[..., 1])
+
+
+def calc_batch_bbox_overlap_union_iou_matrix(preds: torch.Tensor, teachers: torch.Tensor) \
+        -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Tensor version of calc_bbox_overlap_union_iou_matrix for padded batch.
+    :param preds: Tensor (batch size, N, 4+(x_min, y_min, x_max, y_max, ...))
+    :param teachers: Tensor (batch size, M, 4+(x_min, y_min, x_max, y_max, ...))
+    :return: overlap (batch size, N, M), union (batch size, N, M), iou (batch size, N, M)
+    """
+    preds, teachers = preds[:, :, None, :4], teachers[:, None, :, :4]
+    intersection_width = (torch.min(preds[..., 2], teachers[..., 2]) - torch.max(preds[..., 0], teachers[..., 0])) \
+        .clamp(min=0)
+    intersection_height = (torch.min(preds[..., 3], teachers[..., 3]) - torch.max(preds[..., 1], teachers[..., 1])) \
+        .clamp(min=0)
+
+    overlap = intersection_width * intersection_height
+    union = calc_batch_areas(preds) + calc_batch_areas(teachers) - overlap
+    iou = overlap / union.clamp(min=torch.finfo(union.dtype).eps)
+    return overlap, union, iou
+
+
+def match_batch_bboxes(pred_bboxes: torch.Tensor, target_bboxes: torch.Tensor,
+                       iou_thresholds: torch.Tensor, iou_matrix: torch.Tensor = None) -> torch.Tensor:
+    """
+    Tensor version of match_bboxes for padded batch. Result is same as match_bboxes of each image.
+    Greedy matching is resolved in rounds instead of visiting predictions one by one.
+    In each round, every prediction takes the best available target, and predictions are fixed up to the first
+    prediction competing with a higher score prediction for the same target by class.
+    Highest score pending prediction is always accepted and takes a target, so min(N, M) rounds are enough.
+    On GPU all rounds run without host sync, on CPU loop ends when all predictions are resolved (no sync cost).
+    :param pred_bboxes: (batch size, N, 5 or 6(x_min, y_min, x_max, y_max, label, score)) Padding has label -1.
+    :param target_bboxes: (batch size, M, 5(x_min, y_min, x_max, y_max, label)) Padding has label -1.
+    :param iou_thresholds: (thresholds, )
+    :param iou_matrix: (batch size, N, M) Precomputed IoU matrix.
+    :return: (batch size, thresholds, N) Matched target index of each prediction. -1 means not matched.
+    """
+    batch_size, n_preds, n_targets = pred_bboxes.shape[0], pred_bboxes.shape[1], target_bboxes.shape[1]
+    device = pred_bboxes.device
+    matched_indices = torch.full([batch_size, iou_thresholds.shape[0], n_preds], -1, dtype=torch.long, device=device)
+    if n_preds == 0 or n_targets == 0:
+        return matched_indices
+    if iou_matrix is None:
+        _, _, iou_matrix = calc_batch_bbox_overlap_union_iou_matrix(pred_bboxes, target_bboxes)
+
+    # Visit predictions by score rank.
+    if pred_bboxes.shape[2] > 5:
+        order = torch.sort(pred_bboxes[..., 5], dim=1, descending=True, stable=True)[1]
+    else:
+        order = torch.arange(n_preds, device=device)[None].expand(batch_size, -1)
+    pred_labels = torch.gather(pred_bboxes[..., 4], 1, order).long()
+    iou_matrix = torch.gather(iou_matrix, 1, order[..., None].expand(-1, -1, n_targets))
+    target_labels = target_bboxes[..., 4].long()
+    is_same_class = (pred_labels[:, :, None] == target_labels[:, None, :]) & (target_labels[:, None, :] >= 0)
+    # (batch size, thresholds, N, M)
+    is_pair_valid = is_same_class[:, None] & (iou_matrix[:, None] >= iou_thresholds.to(iou_matrix)[None, :, None, None])
+    masked_iou_matrix = torch.where(is_pair_valid, iou_matrix[:, None], torch.full_like(iou_matrix[:, None], -1))
+
+    # [i, j] is True if j has higher score than i.
+    is_higher_rank = torch.ones([n_preds, n_preds], dtype=torch.bool, device=device).tril(diagonal=-1)
+    is_higher_or_same_rank = torch.ones([n_preds, n_preds], dtype=torch.bool, device=device).tril()
+    is_same_pred_class = (pred_labels[:, :, None] == pred_labels[:, None, :])[:, None]
+    ranked_matched_indices = torch.full_like(matched_indices, -1)
+    is_target_taken = torch.zeros([batch_size, iou_thresholds.shape[0], n_targets], dtype=torch.bool, device=device)
+    is_resolved = torch.zeros_like(matched_indices, dtype=torch.bool)
+    for _ in range(min(n_preds, n_targets)):
+        is_available = is_pair_valid & ~is_target_taken[:, :, None, :]
+        is_pending = is_available.any(dim=3) & ~is_resolved
+        if device.type == "cpu" and not is_pending.any():
+            break
+        candidates = torch.where(is_available, masked_iou_matrix, torch.full_like(masked_iou_matrix, -1)).argmax(dim=3)
+        # Competing with higher score prediction for the same target.
+        is_conflict = ((candidates[..., :, None] == candidates[..., None, :]) & is_pending[..., :, None]
+                       & is_pending[..., None, :] & is_higher_rank).any(dim=3)
+        # Lower score predictions of the same class wait until conflict is resolved.
+        is_blocked = (is_conflict[..., None, :] & is_same_pred_class & is_higher_or_same_rank).any(dim=3)
+        is_accepted = is_pending & ~is_blocked
+        ranked_matched_indices = torch.where(is_accepted, candidates, ranked_matched_indices)
+        taken_count = torch.zeros_like(is_target_taken, dtype=torch.long).scatter_add_(2, candidates,
+                                                                                         is_accepted.long())
+        is_target_taken |= taken_count > 0
+        is_resolved |= is_accepted
+    return matched_indices.scatter_(2, order[:, None].expand(-1, iou_thresholds.shape[0], -1),
+                                    ranked_matched_indices)
+
+
 class DetectionIoU(pl.metrics.Metric):
     def __init__(self, n_classes: int, by_classes: bool = False):
         super().__init__(compute_on_step=False)
@@ -41,62 +228,84 @@ class DetectionIoU(pl.metrics.Metric):
         self.add_state("total_iou_by_classes", default=torch.tensor([0. for _ in range(n_classes)]),
                        dist_reduce_fx="sum")
 
-    def update(self, preds: List[np.ndarray], targets: Union[np.ndarray, torch.Tensor]) -> None:
+    def update(self, preds: Union[List[np.ndarray], torch.Tensor], targets: Union[np.ndarray, torch.Tensor]) -> None:
         """
         :param preds: Sorted by score. (Batch size, bounding boxes by batch, 5(x_min, y_min, x_max, y_max, label))
+                      If padded tensor is given, metric is computed on its device. Padding has label -1.
         :param targets: (batch size, bounding box count, 5(x_min, y_min, x_max, y_max, label))
         :return:
         """
+        if isinstance(preds, torch.Tensor):
+            self._update_tensor(preds, targets)
+            return
         targets = targets.cpu().detach().numpy() if isinstance(targets, torch.Tensor) else targets
-        # 全探索だと遅いのでクラスごとにまとめておく
-        preds_by_class = []
-        for pred_bboxes in preds:
-            pred_by_class = [[] for _ in range(self._n_classes)]
-            for pred_bbox in pred_bboxes:
-                pred_by_class[int(pred_bbox[4])].append(pred_bbox)
-            preds_by_class.append(pred_by_class)
-
+        total_iou_by_classes = np.zeros(self._n_classes)
+        image_count_by_classes = np.zeros(self._n_classes)
         for i in range(targets.shape[0]):  # Explore every batch.
-            bbox_annotations = targets[i, :, :]
+            bbox_annotations = to_bbox_array(targets[i], 5)
             # Exclude invalid label annotation.
             bbox_annotations = bbox_annotations[bbox_annotations[:, 4] >= 0]
-
-            pred_by_class = preds_by_class[i]
+            pred_bboxes = to_bbox_array(preds[i], 5)
 
             """
             1画像でラベルごとに計算.
             ラベルごとの面積合計/overlapを計算
             1画像ごとにIoU算出、最終的に画像平均を算出
             """
-
-            total_area_by_classes = [0 for _ in range(self._n_classes)]
-            total_overlap_by_classes = [0 for _ in range(self._n_classes)]
-            is_label_appeared = [False for _ in range(self._n_classes)]
-            for bbox_annotation in bbox_annotations:
-
-                label = int(bbox_annotation[4])
-                total_area_by_classes[label] += calc_area(bbox_annotation)
-                pred_bboxes = pred_by_class[label]
-
-                if pred_bboxes is None or len(pred_bboxes) == 0:
-                    continue
-
-                # Calculate area and overlap by class.
-                for pred_bbox in pred_bboxes:
-                    overlap, _, _ = calc_bbox_overlap_union_iou(pred_bbox, bbox_annotation)
-                    total_overlap_by_classes[label] += overlap
-                    if is_label_appeared[label]:
-                        continue
-                    total_area_by_classes[label] += calc_area(pred_bbox)
-                is_label_appeared[label] = True
-
-            for label in range(self._n_classes):
-                # Not exist label in this data.
-                if total_area_by_classes[label] <= 0:
-                    continue
-                self.total_iou_by_classes[label] += total_overlap_by_classes[label] / (
-                        total_area_by_classes[label] - total_overlap_by_classes[label])
-                self.image_count_by_classes[label] += 1
+            target_labels = bbox_annotations[:, 4].astype(np.int64)
+            pred_labels = pred_bboxes[:, 4].astype(np.int64)
+            target_count_by_classes = np.bincount(target_labels, minlength=self._n_classes)
+            target_area_by_classes = np.bincount(target_labels, weights=calc_areas(bbox_annotations),
+                                                 minlength=self._n_classes)
+            pred_area_by_classes = np.bincount(pred_labels, weights=calc_areas(pred_bboxes),
+                                               minlength=self._n_classes)
+            overlap, _, _ = calc_bbox_overlap_union_iou_matrix(pred_bboxes, bbox_annotations)
+            overlap = np.where(pred_labels[:, None] == target_labels[None, :], overlap, 0.)
+            overlap_by_classes = np.bincount(pred_labels, weights=overlap.sum(axis=1), minlength=self._n_classes)
+
+            # Predicted area is counted only for labels which appear in annotations.
+            total_area_by_classes = target_area_by_classes + np.where(target_count_by_classes > 0,
+                                                                      pred_area_by_classes, 0.)
+            # Not exist label in this data.
+            is_valid = total_area_by_classes > 0
+            iou_by_classes = np.divide(overlap_by_classes, total_area_by_classes - overlap_by_classes,
+                                       out=np.zeros(self._n_classes), where=is_valid)
+            total_iou_by_classes += iou_by_classes
+            image_count_by_classes += is_valid
+        self.total_iou_by_classes += torch.as_tensor(total_iou_by_classes, dtype=self.total_iou_by_classes.dtype,
+                                                     device=self.total_iou_by_classes.device)
+        self.image_count_by_classes += torch.as_tensor(image_count_by_classes,
+                                                       dtype=self.image_count_by_classes.dtype,
+                                                       device=self.image_count_by_classes.device)
+
+    def _update_tensor(self, preds: torch.Tensor, targets: torch.Tensor):
+        device, dtype = self.total_iou_by_classes.device, self.total_iou_by_classes.dtype
+        preds, targets = preds.detach().to(device, dtype), torch.as_tensor(targets).detach().to(device, dtype)
+        batch_size = targets.shape[0]
+        target_labels, pred_labels = targets[..., 4].long(), preds[..., 4].long()
+        is_target_valid, is_pred_valid = target_labels >= 0, pred_labels >= 0
+
+        def sum_by_batch_classes(labels: torch.Tensor, values: torch.Tensor) -> torch.Tensor:
+            indices = torch.arange(batch_size, device=device)[:, None] * self._n_classes + labels.clamp(min=0)
+            result = torch.zeros(batch_size * self._n_classes, dtype=dtype, device=device)
+            return result.index_add_(0, indices.reshape(-1), values.reshape(-1)).reshape(batch_size, self._n_classes)
+
+        target_count_by_classes = sum_by_batch_classes(target_labels, is_target_valid.to(dtype))
+        target_area_by_classes = sum_by_batch_classes(target_labels, calc_batch_areas(targets) * is_target_valid)
+        pred_area_by_classes = sum_by_batch_classes(pred_labels, calc_batch_areas(preds) * is_pred_valid)
+        overlap, _, _ = calc_batch_bbox_overlap_union_iou_matrix(preds, targets)
+        is_same_class = (pred_labels[:, :, None] == target_labels[:, None, :]) & is_target_valid[:, None, :]
+        overlap_by_classes = sum_by_batch_classes(pred_labels, (overlap * is_same_class).sum(dim=2) * is_pred_valid)
+
+        # Same as numpy version. (batch size, classes)
+        total_area_by_classes = target_area_by_classes + torch.where(target_count_by_classes > 0,
+                                                                     pred_area_by_classes,
+                                                                     torch.zeros_like(pred_area_by_classes))
+        is_valid = total_area_by_classes > 0
+        iou_by_classes = torch.where(is_valid, overlap_by_classes / (total_area_by_classes - overlap_by_classes)
+                                     .clamp(min=torch.finfo(dtype).eps), torch.zeros_like(overlap_by_classes))
+        self.total_iou_by_classes += iou_by_classes.sum(dim=0)
+        self.image_count_by_classes += is_valid.sum(dim=0).to(dtype)
 
     def compute(self):
         epsilon = 1e-8
@@ -115,50 +324,55 @@ class RecallPrecision(pl.metrics.Metric):
         self.add_state("fp_by_classes", default=torch.tensor([0 for _ in range(n_classes)]), dist_reduce_fx="sum")
         self.add_state("fn_by_classes", default=torch.tensor([0 for _ in range(n_classes)]), dist_reduce_fx="sum")
 
-    def update(self, preds: List[np.ndarray], targets: Union[np.ndarray, torch.Tensor]) -> None:
+    def update(self, preds: Union[List[np.ndarray], torch.Tensor], targets: Union[np.ndarray, torch.Tensor]) -> None:
         """
         :param preds: Sorted by score. (Batch size, bounding boxes by batch, 5(x_min, y_min, x_max, y_max, label))
+                      If padded tensor is given, metric is computed on its device. Padding has label -1.
         :param targets: (batch size, bounding box count, 5(x_min, y_min, x_max, y_max, label))
         :return:
         """
+        if isinstance(preds, torch.Tensor):
+            self._update_tensor(preds, targets)
+            return
         targets = targets.cpu().detach().numpy() if isinstance(targets, torch.Tensor) else targets
-        # 全探索だと遅いのでクラスごとにまとめておく
-        preds_by_class = []
-        for pred_bboxes in preds:
-            pred_by_class = [[] for _ in range(self._n_classes)]
-            for pred_bbox in pred_bboxes:
-                pred_by_class[int(pred_bbox[4])].append(pred_bbox)
-            preds_by_class.append(pred_by_class)
-
+        tp_by_classes = np.zeros(self._n_classes, dtype=np.int64)
+        pred_count_by_classes = np.zeros(self._n_classes, dtype=np.int64)
+        target_count_by_classes = np.zeros(self._n_classes, dtype=np.int64)
         for i in range(targets.shape[0]):
-            bbox_annotations = targets[i, :, :]
+            bbox_annotations = to_bbox_array(targets[i], 5)
             # Exclude invalid label annotation.
             bbox_annotations = bbox_annotations[bbox_annotations[:, 4] >= 0]
-
-            pred_by_class = preds_by_class[i]
-
-            applied_bbox_count_by_classes = [0 for _ in range(self._n_classes)]
-            for bbox_annotation in bbox_annotations:
-                label = int(bbox_annotation[4])
-                pred_bboxes = pred_by_class[label]
-
-                if pred_bboxes is None or len(pred_bboxes) == 0:
-                    self.fn_by_classes[label] += 1
-                    continue
-                # Explore max iou of bbox_annotation
-                is_matched = False
-                for pred_bbox in pred_bboxes:
-                    overlap, union, iou = calc_bbox_overlap_union_iou(pred_bbox, bbox_annotation)
-                    if iou >= 0.5:
-                        applied_bbox_count_by_classes[label] += 1
-                        self.tp_by_classes[label] += 1
-                        is_matched = True
-                        break
-                if not is_matched:
-                    self.fn_by_classes[label] += 1
-
-            for label in range(self._n_classes):
-                self.fp_by_classes[label] += len(pred_by_class[label]) - applied_bbox_count_by_classes[label]
+            pred_bboxes = to_bbox_array(preds[i], 5)
+
+            pred_labels = pred_bboxes[:, 4].astype(np.int64)
+            matched_indices = match_bboxes(pred_bboxes, bbox_annotations, iou_threshold=0.5)
+            tp_by_classes += np.bincount(pred_labels[matched_indices >= 0], minlength=self._n_classes)
+            pred_count_by_classes += np.bincount(pred_labels, minlength=self._n_classes)
+            target_count_by_classes += np.bincount(bbox_annotations[:, 4].astype(np.int64),
+                                                   minlength=self._n_classes)
+
+        device = self.tp_by_classes.device
+        self.tp_by_classes += torch.as_tensor(tp_by_classes, device=device)
+        self.fp_by_classes += torch.as_tensor(pred_count_by_classes - tp_by_classes, device=device)
+        self.fn_by_classes += torch.as_tensor(target_count_by_classes - tp_by_classes, device=device)
+
+    def _update_tensor(self, preds: torch.Tensor, targets: torch.Tensor):
+        device = self.tp_by_classes.device
+        preds, targets = preds.detach().to(device), torch.as_tensor(targets).detach().to(device, preds.dtype)
+        pred_labels, target_labels = preds[..., 4].long(), targets[..., 4].long()
+        matched_indices = match_batch_bboxes(preds, targets, torch.tensor([0.5], device=device))[:, 0]
+
+        def count_by_classes(labels: torch.Tensor, is_counted: torch.Tensor) -> torch.Tensor:
+            is_counted = is_counted & (labels >= 0)
+            return torch.zeros_like(self.tp_by_classes).index_add_(0, labels.clamp(min=0).reshape(-1),
+                                                                   is_counted.reshape(-1).to(self.tp_by_classes))
+
+        tp_by_classes = count_by_classes(pred_labels, matched_indices >= 0)
+        self.tp_by_classes += tp_by_classes
+        self.fp_by_classes += count_by_classes(pred_labels, torch.ones_like(matched_indices, dtype=torch.bool)) \
+            - tp_by_classes
+        self.fn_by_classes += count_by_classes(target_labels, torch.ones_like(target_labels, dtype=torch.bool)) \
+            - tp_by_classes
 
     def compute(self):
         epsilon = 1e-8
@@ -170,108 +384,327 @@ class RecallPrecision(pl.metrics.Metric):
         return torch.mean(recall), torch.mean(precision), torch.mean(f_score)
 
 
-class MeanAveragePrecision(pl.metrics.Metric):
-    def __init__(self, n_classes: int, by_classes=False):
+COCO_IOU_THRESHOLDS = [0.5 + 0.05 * i for i in range(10)]
+# Upper bound of bounding box area of small and medium objects. Same as COCO evaluation.
+COCO_AREA_BOUNDARIES = [32 ** 2, 96 ** 2]
+AREA_RANGE_NAMES = ["small", "medium", "large"]
+# Category of each detection by IoU threshold.
+# False positive: area range index of prediction, True positive: len(AREA_RANGE_NAMES) + area range index of target.
+N_DETECTION_CATEGORIES = len(AREA_RANGE_NAMES) * 2
+
+
+class BaseMeanAveragePrecision(pl.metrics.Metric):
+    def __init__(self, n_classes: int, by_classes=False, iou_thresholds: List[float] = None):
+        """
+        :param n_classes:
+        :param by_classes:
+        :param iou_thresholds: If given, compute returns dict of COCO style metrics (map, map_50, map_75,
+                               map_small, map_medium, map_large) averaged over these thresholds.
+                               All thresholds are evaluated in a single pass with one IoU matrix per image.
+                               e.g. COCO_IOU_THRESHOLDS
+        """
         super().__init__(compute_on_step=False)
         self._n_classes = n_classes
-        # TODO want to implement using add_state
-        self.fp_list_by_classes = [[] for _ in range(n_classes)]
-        self.tp_list_by_classes = [[] for _ in range(n_classes)]
-        self.score_list_by_classes = [[] for _ in range(n_classes)]
-        self.num_annotations_by_classes = [0 for _ in range(n_classes)]
-        # self.add_state("fp_list_by_classes", default=[[] for _ in range(n_classes)], dist_reduce_fx="cat")
-        # self.add_state("tp_list_by_classes", default=[[] for _ in range(n_classes)], dist_reduce_fx="cat")
-        # self.add_state("score_list_by_classes", default=[[] for _ in range(n_classes)], dist_reduce_fx="cat")
-        # self.add_state("num_annotations_by_classes", default=[0 for _ in range(n_classes)], dist_reduce_fx="cat")
         self._by_classes = by_classes
+        self._is_coco_style = iou_thresholds is not None
+        self._iou_thresholds = np.array(iou_thresholds if self._is_coco_style else [0.5], dtype=np.float64)
+        self.add_state("num_annotations_by_area_ranges",
+                       default=torch.zeros([len(AREA_RANGE_NAMES), n_classes], dtype=torch.long),
+                       dist_reduce_fx="sum")
 
-    def update(self, preds: List[np.ndarray], targets: Union[np.ndarray, torch.Tensor]) -> None:
+    def update(self, preds: Union[List[np.ndarray], torch.Tensor], targets: Union[np.ndarray, torch.Tensor]) -> None:
         """
-        :param preds: Sorted by score. (Batch size, bounding boxes by batch, 5(x_min, y_min, x_max, y_max, label))
+        :param preds: Sorted by score. (Batch size, bounding boxes by batch,
+                      6(x_min, y_min, x_max, y_max, label, score))
+                      If padded tensor is given, metric is computed on its device. Padding has label -1.
         :param targets: (batch size, bounding box count, 5(x_min, y_min, x_max, y_max, label))
         :return:
         """
+        if isinstance(preds, torch.Tensor):
+            self._update_tensor(preds, targets)
+            return
         targets = targets.cpu().detach().numpy() if isinstance(targets, torch.Tensor) else targets
+        scores_ls, labels_ls, categories_ls = [], [], []
+        num_annotations = np.zeros([len(AREA_RANGE_NAMES), self._n_classes], dtype=np.int64)
         for i in range(len(preds)):
-            pred_bboxes, target_bboxes = preds[i], targets[i]
+            pred_bboxes, target_bboxes = to_bbox_array(preds[i], 6), to_bbox_array(targets[i], 5)
             # exclude invalid annotations.
             target_bboxes = target_bboxes[target_bboxes[:, 4] >= 0]
-            self._update_num_annotations(target_bboxes)
-            self._update_tp_fp_score(pred_bboxes, target_bboxes)
+            target_area_ranges = np.digitize(calc_areas(target_bboxes), COCO_AREA_BOUNDARIES)
+            np.add.at(num_annotations, (target_area_ranges, target_bboxes[:, 4].astype(np.int64)), 1)
+
+            # (thresholds, N)
+            matched_indices = match_bboxes(pred_bboxes, target_bboxes, iou_threshold=self._iou_thresholds)
+            # Index -1 (not matched) refers appended -1.
+            matched_area_ranges = np.append(target_area_ranges, -1)[matched_indices]
+            pred_area_ranges = np.digitize(calc_areas(pred_bboxes), COCO_AREA_BOUNDARIES)
+            categories = np.where(matched_area_ranges >= 0, len(AREA_RANGE_NAMES) + matched_area_ranges,
+                                  pred_area_ranges[None, :])
+            scores_ls.append(pred_bboxes[:, 5])
+            labels_ls.append(pred_bboxes[:, 4].astype(np.int64))
+            categories_ls.append(categories.T)
+
+        device = self.num_annotations_by_area_ranges.device
+        self.num_annotations_by_area_ranges += torch.as_tensor(num_annotations, device=device)
+        if len(scores_ls) == 0:
+            return
+        self._accumulate(torch.as_tensor(np.concatenate(scores_ls), device=device),
+                         torch.as_tensor(np.concatenate(labels_ls), device=device),
+                         torch.as_tensor(np.concatenate(categories_ls), device=device))
+
+    def _update_tensor(self, preds: torch.Tensor, targets: torch.Tensor):
+        device = self.num_annotations_by_area_ranges.device
+        preds, targets = preds.detach().to(device), torch.as_tensor(targets).detach().to(device, preds.dtype)
+        area_boundaries = torch.tensor(COCO_AREA_BOUNDARIES, dtype=preds.dtype, device=device)
+        pred_labels, target_labels = preds[..., 4].long(), targets[..., 4].long()
+        is_target_valid = target_labels >= 0
+        # Same as np.digitize
+        target_area_ranges = torch.bucketize(calc_batch_areas(targets), area_boundaries, right=True)
+        self.num_annotations_by_area_ranges.view(-1).index_add_(
+            0, (target_area_ranges * self._n_classes + target_labels.clamp(min=0)).reshape(-1),
+            is_target_valid.reshape(-1).long())
+
+        iou_thresholds = torch.as_tensor(self._iou_thresholds, device=device)
+        # (batch size, thresholds, N)
+        matched_indices = match_batch_bboxes(preds, targets, iou_thresholds)
+        # Index -1 (not matched) refers appended -1.
+        target_area_ranges = torch.cat([target_area_ranges, torch.full_like(target_area_ranges[:, :1], -1)], dim=1)
+        matched_indices = torch.where(matched_indices >= 0, matched_indices,
+                                      torch.full_like(matched_indices, targets.shape[1]))
+        matched_area_ranges = torch.gather(target_area_ranges, 1, matched_indices.flatten(1)).view(
+            matched_indices.shape)
+        pred_area_ranges = torch.bucketize(calc_batch_areas(preds), area_boundaries, right=True)
+        categories = torch.where(matched_area_ranges >= 0, len(AREA_RANGE_NAMES) + matched_area_ranges,
+                                 pred_area_ranges[:, None, :].expand_as(matched_area_ranges))
+        # Padding is kept with label -1 to avoid synchronization for detection count.
+        self._accumulate(preds[..., 5].reshape(-1), pred_labels.clamp(min=-1).reshape(-1),
+                         categories.transpose(1, 2).reshape(-1, iou_thresholds.shape[0]))
 
     def compute(self):
-        ap_by_classes = [0 for _ in range(self._n_classes)]
-        for label in range(self._n_classes):
-            num_annotations = self.num_annotations_by_classes[label]
-            tp_list, fp_list = np.array(self.tp_list_by_classes[label]), np.array(self.fp_list_by_classes[label])
-            scores = np.array(self.score_list_by_classes[label])
-            indices = np.argsort(-scores)
-            # sort by score
-            tp_list, fp_list = tp_list[indices], fp_list[indices]
-            # cumulative sum
-            tp_list, fp_list = np.cumsum(tp_list), np.cumsum(fp_list)
+        """
+        :return: If iou_thresholds is not given, mAP(IoU 0.5). Otherwise dict of COCO style metrics.
+        """
+        num_annotations_by_area_ranges = self.num_annotations_by_area_ranges.cpu().numpy()
+        # (points, thresholds, categories) by classes.
+        category_counts_by_classes = self._category_counts_by_classes()
+        n_area_ranges = len(AREA_RANGE_NAMES)
+
+        tp_counts_by_classes = [counts[..., n_area_ranges:].sum(-1) for counts in category_counts_by_classes]
+        fp_counts_by_classes = [counts[..., :n_area_ranges].sum(-1) for counts in category_counts_by_classes]
+        # (classes, thresholds)
+        ap = self._compute_ap_by_classes(tp_counts_by_classes, fp_counts_by_classes,
+                                         num_annotations_by_area_ranges.sum(0))
+        if not self._is_coco_style:
+            ap_by_classes = [ap if not np.isnan(ap) else 0 for ap in ap[:, 0]]
+            return ap_by_classes if self._by_classes else sum(ap_by_classes) / len(ap_by_classes)
+
+        result = {"map": self._summarize(ap)}
+        for key, threshold in [("map_50", 0.5), ("map_75", 0.75)]:
+            threshold_indices = np.where(np.isclose(self._iou_thresholds, threshold))[0]
+            if threshold_indices.shape[0] > 0:
+                result[key] = self._summarize(ap[:, threshold_indices])
+        for area_range, area_range_name in enumerate(AREA_RANGE_NAMES):
+            # Predictions matched with other area range targets and unmatched predictions out of area range are ignored.
+            tp_counts_by_classes = [counts[..., n_area_ranges + area_range] for counts in category_counts_by_classes]
+            fp_counts_by_classes = [counts[..., area_range] for counts in category_counts_by_classes]
+            ap = self._compute_ap_by_classes(tp_counts_by_classes, fp_counts_by_classes,
+                                             num_annotations_by_area_ranges[area_range])
+            result[f"map_{area_range_name}"] = self._summarize(ap)
+        return result
+
+    @abstractmethod
+    def _accumulate(self, scores: torch.Tensor, labels: torch.Tensor, categories: torch.Tensor):
+        """
+        :param scores: (N, )
+        :param labels: (N, ) Detections with label -1 are ignored.
+        :param categories: (N, thresholds) Detection category. see N_DETECTION_CATEGORIES.
+        """
+        pass
+
+    @abstractmethod
+    def _category_counts_by_classes(self) -> List[np.ndarray]:
+        """
+        :return: Detection counts by category (points, thresholds, categories) of each class.
+                 Points are sorted by descending score.
+        """
+        pass
 
+    def _compute_ap_by_classes(self, tp_counts_by_classes: List[np.ndarray], fp_counts_by_classes: List[np.ndarray],
+                               num_annotations_by_classes: np.ndarray) -> np.ndarray:
+        """
+        :param tp_counts_by_classes: (points, thresholds) of each class.
+        :param fp_counts_by_classes: (points, thresholds) of each class.
+        :param num_annotations_by_classes: (classes, )
+        :return: (classes, thresholds) AP. NaN if class has no annotations.
+        """
+        ap_by_classes = np.full([self._n_classes, self._iou_thresholds.shape[0]], np.nan)
+        for label in range(self._n_classes):
+            num_annotations = num_annotations_by_classes[label]
             if num_annotations == 0:
-                ap_by_classes[label] = 0
                 continue
+            # cumulative sum
+            tp_list = np.cumsum(tp_counts_by_classes[label], axis=0)
+            fp_list = np.cumsum(fp_counts_by_classes[label], axis=0)
             recall_curve = tp_list / num_annotations
             precision_curve = tp_list / np.maximum(tp_list + fp_list, np.finfo(np.float64).eps)
             ap_by_classes[label] = self._compute_average_precision(recall_curve, precision_curve)
-        return ap_by_classes if self._by_classes else sum(ap_by_classes) / len(ap_by_classes)
+        return ap_by_classes
 
-    def _update_tp_fp_score(self, pred_bboxes: np.ndarray, target_bboxes: np.ndarray):
-        """
-        :param pred_bboxes: (N, 6(xmin, ymin, xmax, ymax, class, score))
-        :param target_bboxes: (N, 5(xmin, ymin, xmax, ymax, class))
+    def _summarize(self, ap_by_classes: np.ndarray):
         """
-        detected_indices = []
-        for i in range(pred_bboxes.shape[0]):
-            pred_label, pred_score = int(pred_bboxes[i][4]), pred_bboxes[i][5]
-            matched = False
-            for j in filter(lambda k: int(target_bboxes[k][4]) == pred_label and k not in detected_indices,
-                            range(target_bboxes.shape[0])):
-                overlap, union, iou = calc_bbox_overlap_union_iou(pred_bboxes[i], target_bboxes[j])
-                if iou >= 0.5:
-                    detected_indices.append(j)
-                    self.fp_list_by_classes[pred_label].append(0)
-                    self.tp_list_by_classes[pred_label].append(1)
-                    matched = True
-                    break
-            if not matched:
-                self.fp_list_by_classes[pred_label].append(1)
-                self.tp_list_by_classes[pred_label].append(0)
-            self.score_list_by_classes[pred_label].append(pred_score)
-
-    def _update_num_annotations(self, target_bboxes: np.ndarray):
+        :param ap_by_classes: (classes, thresholds)
+        :return: Classes without annotations are excluded like COCO evaluation.
         """
-        :param target_bboxes: (N, 5(xmin, ymin, xmax, ymax, class))
-        """
-        counts = list(map(lambda i: np.count_nonzero(target_bboxes[:, 4] == i), range(self._n_classes)))
-        self.num_annotations_by_classes = list(
-            map(lambda i: counts[i] + self.num_annotations_by_classes[i], range(self._n_classes)))
+        ap_by_classes = ap_by_classes.mean(axis=1)
+        if self._by_classes:
+            return ap_by_classes.tolist()
+        is_valid = ~np.isnan(ap_by_classes)
+        return float(ap_by_classes[is_valid].mean()) if np.any(is_valid) else float("nan")
 
     def _compute_average_precision(self, recall_curve: np.ndarray, precision_curve: np.ndarray):
+        """
+        :param recall_curve: (N, ) or (N, thresholds)
+        :param precision_curve: (N, ) or (N, thresholds)
+        :return: float or (thresholds, )
+        """
         # Reference by https://github.com/toandaominh1997/EfficientDet.Pytorch/blob/master/eval.py
-        assert recall_curve.ndim == 1 and precision_curve.ndim == 1
+        assert recall_curve.ndim in (1, 2) and recall_curve.shape == precision_curve.shape
         # correct AP calculation
         # first append sentinel values at the end
-        mean_recall = np.concatenate(([0.], recall_curve, [1.]))
-        mean_precision = np.concatenate(([0.], precision_curve, [0.]))
+        sentinel_shape = [1] + list(recall_curve.shape[1:])
+        mean_recall = np.concatenate((np.zeros(sentinel_shape), recall_curve, np.ones(sentinel_shape)))
+        mean_precision = np.concatenate((np.zeros(sentinel_shape), precision_curve, np.zeros(sentinel_shape)))
 
         # compute the precision envelope
-        for i in range(mean_precision.size - 1, 0, -1):
-            mean_precision[i - 1] = np.maximum(mean_precision[i - 1], mean_precision[i])
-
-        # to calculate area under PR curve, look for points
-        # where X axis (recall) changes value
-        i = np.where(mean_recall[1:] != mean_recall[:-1])[0]
+        mean_precision = np.maximum.accumulate(mean_precision[::-1], axis=0)[::-1]
 
-        # and sum (\Delta recall) * prec
-        ap = np.sum((mean_recall[i + 1] - mean_recall[i]) * mean_precision[i + 1])
+        # sum (\Delta recall) * prec. Points where X axis (recall) does not change have no area.
+        ap = np.sum((mean_recall[1:] - mean_recall[:-1]) * mean_precision[1:], axis=0)
         return ap
 
+
+class MeanAveragePrecision(BaseMeanAveragePrecision):
+    def __init__(self, n_classes: int, by_classes=False, iou_thresholds: List[float] = None,
+                 initial_capacity: int = 1024):
+        """
+        :param n_classes:
+        :param by_classes:
+        :param iou_thresholds: see BaseMeanAveragePrecision.
+        :param initial_capacity: Initial length of detection buffers. Buffers grow twice when they are full.
+        """
+        super().__init__(n_classes, by_classes=by_classes, iou_thresholds=iou_thresholds)
+        # Detections of all classes are stored in flat buffers. Unused area has label -1.
+        self.add_state("score_buffer", default=torch.zeros(initial_capacity), dist_reduce_fx="cat")
+        self.add_state("label_buffer", default=torch.full([initial_capacity], -1, dtype=torch.int32),
+                       dist_reduce_fx="cat")
+        self.add_state("category_buffer",
+                       default=torch.zeros([initial_capacity, self._iou_thresholds.shape[0]], dtype=torch.int8),
+                       dist_reduce_fx="cat")
+        self.add_state("detection_count", default=torch.tensor(0), dist_reduce_fx="sum")
+        # Same as detection_count. Kept on host not to synchronize device every update.
+        self._host_detection_count = 0
+
     def reset(self):
-        self.fp_list_by_classes = [[] for _ in range(self._n_classes)]
-        self.tp_list_by_classes = [[] for _ in range(self._n_classes)]
-        self.score_list_by_classes = [[] for _ in range(self._n_classes)]
-        self.num_annotations_by_classes = [0 for _ in range(self._n_classes)]
+        """
+        Keep allocated buffers and only clear them.
+        """
+        self.label_buffer.fill_(-1)
+        self.detection_count.zero_()
+        self.num_annotations_by_area_ranges.zero_()
+        self._host_detection_count = 0
+
+    def _accumulate(self, scores: torch.Tensor, labels: torch.Tensor, categories: torch.Tensor):
+        count, n_detections = self._host_detection_count, scores.shape[0]
+        self._reserve(count + n_detections)
+        for name, values in [("score_buffer", scores), ("label_buffer", labels), ("category_buffer", categories)]:
+            buffer = getattr(self, name)
+            buffer[count:count + n_detections] = values.to(buffer)
+        self.detection_count += n_detections
+        self._host_detection_count += n_detections
+
+    def _category_counts_by_classes(self) -> List[np.ndarray]:
+        count = int(self.detection_count)
+        labels = self.label_buffer[:count].cpu().numpy().astype(np.int64)
+        is_valid = labels >= 0
+        labels = labels[is_valid]
+        scores = self.score_buffer[:count].cpu().numpy()[is_valid]
+        categories = self.category_buffer[:count].cpu().numpy().astype(np.int64)[is_valid]
+
+        # Sort by label and descending score, then each class is a contiguous segment.
+        indices = np.lexsort((-scores, labels))
+        labels, categories = labels[indices], categories[indices]
+        class_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self._n_classes))])
+        # Each detection is 1 point. (N, thresholds, categories)
+        category_counts = np.eye(N_DETECTION_CATEGORIES, dtype=np.int64)[categories]
+        return [category_counts[class_offsets[label]:class_offsets[label + 1]] for label in range(self._n_classes)]
+
+    def _reserve(self, capacity: int):
+        """
+        Grow buffers if their length is less than capacity.
+        """
+        current_capacity = self.score_buffer.shape[0]
+        if current_capacity >= capacity:
+            return
+        new_capacity = max(capacity, current_capacity * 2)
+        for name, fill_value in [("score_buffer", 0), ("label_buffer", -1), ("category_buffer", 0)]:
+            buffer = getattr(self, name)
+            new_buffer = torch.full([new_capacity] + list(buffer.shape[1:]), fill_value, dtype=buffer.dtype,
+                                    device=buffer.device)
+            new_buffer[:current_capacity] = buffer
+            setattr(self, name, new_buffer)
+
+    def _sync_dist(self, dist_sync_fn=gather_all_tensors):
+        # All processes must gather same length buffers, so buffers are cut or grown to max detection count.
+        max_count = int(torch.stack(dist_sync_fn(self.detection_count, group=self.process_group)).max())
+        self._reserve(max_count)
+        buffer_names = ["score_buffer", "label_buffer", "category_buffer"]
+        for name in buffer_names:
+            setattr(self, name, getattr(self, name)[:max_count])
+        super()._sync_dist(dist_sync_fn)
+
+        # Gathered buffers are (processes, max count, ...), remove padding of each process.
+        is_valid = self.label_buffer.reshape(-1) >= 0
+        for name in buffer_names:
+            buffer = getattr(self, name)
+            setattr(self, name, buffer.reshape([-1] + list(buffer.shape[2:]))[is_valid])
+
+
+class StreamingMeanAveragePrecision(BaseMeanAveragePrecision):
+    """
+    Bounded memory mAP. Detections are accumulated into score histograms by class instead of keeping each detection,
+    so memory is O(classes * bins) and compute is O(classes * bins) regardless of dataset size.
+    Detections in the same score bin are treated as same score, so the result is an approximation of
+    MeanAveragePrecision. Scores must be in [0, 1].
+    The error decreases with n_score_bins. With 1000 bins the absolute error of mAP is about 1e-3 or less
+    (see test_streaming_mAP_approximation).
+    """
+
+    def __init__(self, n_classes: int, by_classes=False, iou_thresholds: List[float] = None,
+                 n_score_bins: int = 1000):
+        """
+        :param n_classes:
+        :param by_classes:
+        :param iou_thresholds: see BaseMeanAveragePrecision.
+        :param n_score_bins: Number of score bins by class.
+        """
+        super().__init__(n_classes, by_classes=by_classes, iou_thresholds=iou_thresholds)
+        self._n_score_bins = n_score_bins
+        self.add_state("score_histogram",
+                       default=torch.zeros([n_classes, n_score_bins, self._iou_thresholds.shape[0],
+                                            N_DETECTION_CATEGORIES], dtype=torch.long),
+                       dist_reduce_fx="sum")
+
+    def _accumulate(self, scores: torch.Tensor, labels: torch.Tensor, categories: torch.Tensor):
+        n_thresholds = self._iou_thresholds.shape[0]
+        score_bins = (scores * self._n_score_bins).long().clamp(0, self._n_score_bins - 1)
+        # Flat index of (class, bin, threshold, category)
+        class_bin_indices = labels.long().clamp(min=0) * self._n_score_bins + score_bins
+        indices = class_bin_indices[:, None] * n_thresholds + torch.arange(n_thresholds, device=scores.device)[None, :]
+        indices = indices * N_DETECTION_CATEGORIES + categories.long()
+        is_valid = (labels >= 0)[:, None].expand_as(indices)
+        self.score_histogram.view(-1).index_add_(0, indices.reshape(-1), is_valid.reshape(-1).long())
+
+    def _category_counts_by_classes(self) -> List[np.ndarray]:
+        # Each bin is 1 point, sorted by descending score.
+        score_histogram = self.score_histogram.cpu().numpy()[:, ::-1]
+        return [score_histogram[label] for label in range(self._n_classes)]
@@ -2,32 +2,114 @@ import torch
 import pytorch_lightning as pl
 
 
-class SegmentationIoU(pl.metrics.Metric):
-    def __init__(self, n_classes: int, by_classes: bool = False, without_background_class: bool = False):
+def calc_iou_by_classes(confusion_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    :param confusion_matrix: (classes, classes) Rows are targets, columns are predictions.
+    :return: (classes, ) NaN if class appears in neither targets nor predictions.
+    """
+    overlap = torch.diagonal(confusion_matrix)
+    union = confusion_matrix.sum(dim=0) + confusion_matrix.sum(dim=1) - overlap
+    return overlap / union
+
+
+def calc_dice_by_classes(confusion_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    :param confusion_matrix: (classes, classes) Rows are targets, columns are predictions.
+    :return: (classes, ) NaN if class appears in neither targets nor predictions.
+    """
+    overlap = torch.diagonal(confusion_matrix)
+    return 2 * overlap / (confusion_matrix.sum(dim=0) + confusion_matrix.sum(dim=1))
+
+
+def calc_recall_by_classes(confusion_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    :param confusion_matrix: (classes, classes) Rows are targets, columns are predictions.
+    :return: (classes, ) NaN if class does not appear in targets.
+    """
+    return torch.diagonal(confusion_matrix) / confusion_matrix.sum(dim=1)
+
+
+def calc_pixel_accuracy(confusion_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    :param confusion_matrix: (classes, classes) Rows are targets, columns are predictions.
+    :return: Rate of correct pixels.
+    """
+    return torch.diagonal(confusion_matrix).sum() / confusion_matrix.sum()
+
+
+class SegmentationConfusionMatrix(pl.metrics.Metric):
+    def __init__(self, n_classes: int, ignore_index: int = None):
+        """
+        :param n_classes:
+        :param ignore_index: Target pixels of this value are not counted. Values out of [0, n_classes) are also ignored.
+        """
         super().__init__(compute_on_step=False)
         self._n_classes = n_classes
-        self._without_background_class = without_background_class
-        self._by_classes = by_classes
-        self.add_state("overlap_by_classes", default=torch.tensor([0 for _ in range(n_classes)]), dist_reduce_fx="sum")
-        self.add_state("union_by_classes", default=torch.tensor([0 for _ in range(n_classes)]), dist_reduce_fx="sum")
+        self._ignore_index = ignore_index
+        # Rows are targets, columns are predictions.
+        self.add_state("confusion_matrix", default=torch.zeros([n_classes, n_classes], dtype=torch.long),
+                       dist_reduce_fx="sum")
 
     def update(self, preds: torch.Tensor, targets: torch.Tensor):
-        preds, targets = preds.reshape([preds.shape[0], -1]), targets.reshape([targets.shape[0], -1])
-        for label_val in range(self._n_classes):
-            targets_indices, preds_indices = (targets == label_val), (preds == label_val)
-            overlap_indices = targets_indices & preds_indices
-            overlap = torch.count_nonzero(overlap_indices)
-            union = torch.count_nonzero(targets_indices) + torch.count_nonzero(preds_indices) - overlap
-            self.overlap_by_classes[label_val] += overlap
-            self.union_by_classes[label_val] += union
+        """
+        :param preds: (Batch size, height, width) Label index.
+        :param targets: (Batch size, height, width) Label index.
+        """
+        preds, targets = preds.reshape(-1).long(), targets.reshape(-1).long()
+        is_valid = (targets >= 0) & (targets < self._n_classes) & (preds >= 0) & (preds < self._n_classes)
+        if self._ignore_index is not None:
+            is_valid &= targets != self._ignore_index
+        # Invalid pixels are counted in the last bin and dropped.
+        indices = torch.where(is_valid, targets * self._n_classes + preds,
+                              torch.full_like(targets, self._n_classes ** 2))
+        counts = torch.bincount(indices, minlength=self._n_classes ** 2 + 1)[:self._n_classes ** 2]
+        self.confusion_matrix += counts.reshape(self._n_classes, self._n_classes)
+
+    def compute(self):
+        """
+        :return: (classes, classes) confusion matrix. Rows are targets, columns are predictions.
+        """
+        return self.confusion_matrix
+
+
+class SegmentationIoU(SegmentationConfusionMatrix):
+    def __init__(self, n_classes: int, by_classes: bool = False, without_background_class: bool = False,
+                 ignore_index: int = None):
+        super().__init__(n_classes, ignore_index=ignore_index)
+        self._without_background_class = without_background_class
+        self._by_classes = by_classes
 
     def compute(self):
         """
         :return: mean IoU
         """
-        iou_by_classes = self.overlap_by_classes / self.union_by_classes
+        iou_by_classes = calc_iou_by_classes(self.confusion_matrix)
         if self._without_background_class:
             iou_by_classes = iou_by_classes[1:]
         if self._by_classes:
             return iou_by_classes
         return torch.mean(iou_by_classes)
+
+
+class SegmentationMetrics(SegmentationConfusionMatrix):
+    def __init__(self, n_classes: int, by_classes: bool = False, without_background_class: bool = False,
+                 ignore_index: int = None):
+        super().__init__(n_classes, ignore_index=ignore_index)
+        self._without_background_class = without_background_class
+        self._by_classes = by_classes
+
+    def compute(self):
+        """
+        All metrics are computed from one confusion matrix.
+        :return: dict of iou, dice, recall and pixel_accuracy. Classes without pixels are excluded from mean.
+        """
+        result = {}
+        for key, metric_func in [("iou", calc_iou_by_classes), ("dice", calc_dice_by_classes),
+                                 ("recall", calc_recall_by_classes)]:
+            value_by_classes = metric_func(self.confusion_matrix)
+            if self._without_background_class:
+                value_by_classes = value_by_classes[1:]
+            is_valid = ~torch.isnan(value_by_classes)
+            result[key] = value_by_classes if self._by_classes else torch.mean(value_by_classes[is_valid])
+        result["pixel_accuracy"] = calc_pixel_accuracy(self.confusion_matrix)
+        return result
@@ -1,18 +1,61 @@
 from abc import ABCMeta, abstractmethod
+from typing import Callable, Optional, Tuple, List
 from warnings import warn
 import numpy as np
 import torch
 from pytorch_lightning import LightningModule
 from torch.utils import mobile_optimizer
 
+from ..layers.basic import InputNormalization
+from ...image_process.convert import try_cuda
+
 
 class BaseDeepextModel(LightningModule, metaclass=ABCMeta):
-    def save_model_for_mobile(self, width: int, height: int, out_filepath: str, for_os="cpu"):
+    _batch_augmentation: Optional[Callable] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Inputs of network pass through this, so uint8 images can be transferred from workers.
+        self.input_normalization = try_cuda(InputNormalization())
+
+    def set_input_normalization(self, scale: float = 1 / 255., mean: List[float] = None, std: List[float] = None):
+        """
+        Normalization at the front of model. Included in exported model.
+        :param scale: Scale of uint8 images.
+        :param mean: Mean by channel of scaled images.
+        :param std: Standard deviation by channel of scaled images.
+        """
+        self.input_normalization = InputNormalization(scale, mean, std).to(self.input_normalization.scale.device)
+
+    def set_batch_augmentation(self, batch_augmentation: Optional[Callable]):
+        """
+        :param batch_augmentation: Applied to training batch on device. (e.g. transforms.BatchAugmentationCompose)
+        None disables it.
+        """
+        self._batch_augmentation = batch_augmentation
+
+    def augment_batch(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) \
+            -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        :param images: (Batch size, channels, height, width)
+        :param bboxes: (Batch size, max bboxes, 5(xmin, ymin, xmax, ymax, label)) padded by -1
+        :param masks: (Batch size, classes, height, width) one-hot or (Batch size, height, width) index
+        :return: images, bboxes, masks
+        """
+        if self._batch_augmentation is None:
+            return images, bboxes, masks
+        return self._batch_augmentation(images, bboxes, masks)
+
+    def save_model_for_mobile(self, width: int, height: int, out_filepath: str, for_os="cpu", uint8_input=False):
+        """
+        :param uint8_input: Exported model takes uint8 images (0~255). Otherwise float images (0~1).
+        """
         torch_model = self.to("cpu")
         torch_model.eval()
 
         if for_os == "cpu":
-            example = torch.rand(1, 3, height, width).to("cpu")
+            example = torch.randint(0, 256, [1, 3, height, width], dtype=torch.uint8) if uint8_input \
+                else torch.rand(1, 3, height, width)
             traced_script_module = torch.jit.trace(torch_model, example)
             traced_script_module.save(out_filepath)
             return
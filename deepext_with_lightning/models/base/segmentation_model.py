@@ -12,7 +12,7 @@ class SegmentationModel(BaseDeepextModel):
     forward
         input:
             image: (Batch size, channels, height, width)
-            target: (Batch size, classes, height, width) one-hot
+            target: (Batch size, classes, height, width) one-hot or (Batch size, height, width) index mask
         output:
             (Batch size, classes, height, width)
     """
@@ -48,3 +48,17 @@ class SegmentationModel(BaseDeepextModel):
     def result_to_index_image(self, result: torch.Tensor):
         result = result.permute(0, 2, 3, 1)
         return torch.argmax(result, dim=3)
+
+    def prepare_teacher(self, teacher: torch.Tensor) -> torch.Tensor:
+        """
+        :param teacher: (Batch size, classes, height, width) one-hot or (Batch size, height, width) index mask
+        :return: float one-hot or long index mask for loss.
+        """
+        return teacher.float() if teacher.ndim == 4 else teacher.long()
+
+    def teacher_to_index_image(self, teacher: torch.Tensor) -> torch.Tensor:
+        """
+        :param teacher: (Batch size, classes, height, width) one-hot or (Batch size, height, width) index mask
+        :return: (Batch size, height, width)
+        """
+        return self.result_to_index_image(teacher) if teacher.ndim == 4 else teacher.long()
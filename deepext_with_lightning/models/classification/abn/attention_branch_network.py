@@ -7,7 +7,7 @@ from ...base import AttentionClassificationModel
 from ...classification.abn.modules import ABNModel
 from ...layers.backbone_key import BackBoneKey
 from ....image_process.convert import try_cuda
-from ....metrics.classification import ClassificationAccuracy
+from ....metrics.classification import ClassificationMetricCollection
 
 
 class AttentionBranchNetwork(AttentionClassificationModel):
@@ -21,11 +21,11 @@ class AttentionBranchNetwork(AttentionClassificationModel):
         self._lr = lr
         self._model = try_cuda(
             ABNModel(n_classes=n_classes, pretrained=pretrained, backbone=backbone, n_blocks=n_blocks))
-        self._train_acc: pl.metrics.Metric = try_cuda(ClassificationAccuracy(n_classes))
-        self._val_acc: pl.metrics.Metric = try_cuda(ClassificationAccuracy(n_classes))
+        self._train_metrics: pl.metrics.Metric = try_cuda(ClassificationMetricCollection(n_classes))
+        self._val_metrics: pl.metrics.Metric = try_cuda(ClassificationMetricCollection(n_classes))
 
     def forward(self, x):
-        labels, attention_labels, attention_map = self._model(x)
+        labels, attention_labels, attention_map = self._model(self.input_normalization(x))
         labels = F.softmax(labels, dim=1)
         attention_labels = F.softmax(attention_labels, dim=1)
         return labels, attention_labels, attention_map
@@ -34,8 +34,9 @@ class AttentionBranchNetwork(AttentionClassificationModel):
         self._model.train()
         inputs, targets = batch
         targets = self.onehot_to_label(targets)
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).long()
-        out = self._model(inputs)
+        inputs, _, _ = self.augment_batch(try_cuda(inputs))
+        targets = try_cuda(targets).long()
+        out = self._model(self.input_normalization(inputs))
         loss = self._calc_loss(out, targets)
         pred_prob, _, attention_map = out
         pred_labels = torch.argmax(pred_prob, dim=1)
@@ -44,27 +45,27 @@ class AttentionBranchNetwork(AttentionClassificationModel):
 
     def training_step_end(self, outputs):
         preds, targets = outputs["preds"], outputs["target"]
-        self._train_acc(preds, targets)
+        self._train_metrics(preds, targets)
         return outputs["loss"]
 
     def training_epoch_end(self, outputs: List[Any]) -> None:
-        value = self._train_acc.compute()
-        self.log('train_acc', value, on_step=False, on_epoch=True)
-        self._train_acc.reset()
+        values = self._train_metrics.compute()
+        self.log_dict({f"train_{key}": value for key, value in values.items()}, on_step=False, on_epoch=True)
+        self._train_metrics.reset()
 
     def validation_step(self, batch, batch_idx):
         self._model.eval()
         inputs, targets = batch
         targets = self.onehot_to_label(targets)
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).long()
-        pred_prob, _, attention_map = self._model(inputs)
+        inputs, targets = try_cuda(inputs), try_cuda(targets).long()
+        pred_prob, _, attention_map = self._model(self.input_normalization(inputs))
         pred_labels = torch.argmax(pred_prob, dim=1)
-        self._val_acc(pred_labels, targets)
+        self._val_metrics(pred_labels, targets)
 
     def on_validation_epoch_end(self) -> None:
-        value = self._val_acc.compute()
-        self.log("val_acc", value, on_step=False, on_epoch=True)
-        self._val_acc.reset()
+        values = self._val_metrics.compute()
+        self.log_dict({f"val_{key}": value for key, value in values.items()}, on_step=False, on_epoch=True)
+        self._val_metrics.reset()
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(lr=self._lr, params=self._model.parameters())
@@ -88,8 +89,8 @@ class AttentionBranchNetwork(AttentionClassificationModel):
     def predict_label_and_heatmap(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         with torch.no_grad():
             self._model.eval()
-            x = try_cuda(x).float()
-            pred, _, heatmap = self._model(x)
+            x = try_cuda(x)
+            pred, _, heatmap = self._model(self.input_normalization(x))
             heatmap = heatmap[:, 0]
             heatmap = self._normalize_heatmap(heatmap)
             return torch.argmax(pred, dim=1), pred, heatmap
@@ -97,8 +98,8 @@ class AttentionBranchNetwork(AttentionClassificationModel):
     def predict_label(self, img: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         with torch.no_grad():
             self._model.eval()
-            img = try_cuda(img).float()
-            pred_prob, _, heatmap = self._model(img)
+            img = try_cuda(img)
+            pred_prob, _, heatmap = self._model(self.input_normalization(img))
             return torch.argmax(pred_prob, dim=1), pred_prob
 
     def generate_model_name(self, suffix: str = "") -> str:
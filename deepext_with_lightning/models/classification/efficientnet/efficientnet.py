@@ -7,7 +7,7 @@ import pytorch_lightning as pl
 from ....models.base.classification_model import ClassificationModel
 from ....image_process.convert import try_cuda
 from .efficientnet_lib.model import EfficientNetPredictor
-from ....metrics.classification import ClassificationAccuracy
+from ....metrics.classification import ClassificationMetricCollection
 
 __all__ = ['EfficientNet']
 
@@ -21,26 +21,27 @@ class EfficientNet(ClassificationModel):
             EfficientNetPredictor.from_name(network, override_params={'num_classes': self._num_classes}))
         self._network = network
         self._lr = lr
-        self._train_acc: pl.metrics.Metric = try_cuda(ClassificationAccuracy(num_classes))
-        self._val_acc: pl.metrics.Metric = try_cuda(ClassificationAccuracy(num_classes))
+        self._train_metrics: pl.metrics.Metric = try_cuda(ClassificationMetricCollection(num_classes))
+        self._val_metrics: pl.metrics.Metric = try_cuda(ClassificationMetricCollection(num_classes))
 
     def forward(self, x):
-        result = self._model(x)
+        result = self._model(self.input_normalization(x))
         return F.softmax(result, dim=1)
 
     def predict_label(self, img: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         with torch.no_grad():
             self._model.eval()
             img = try_cuda(img)
-            pred_prob = self._model(img)
+            pred_prob = self._model(self.input_normalization(img))
             return torch.argmax(pred_prob, dim=1), pred_prob
 
     def training_step(self, batch, batch_idx):
         self._model.train()
         inputs, targets = batch
         targets = self.onehot_to_label(targets)
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).long()
-        pred_prob = self._model(inputs)
+        inputs, _, _ = self.augment_batch(try_cuda(inputs))
+        targets = try_cuda(targets).long()
+        pred_prob = self._model(self.input_normalization(inputs))
         pred_labels = torch.argmax(pred_prob, dim=1)
         loss = F.cross_entropy(pred_prob, targets, reduction="mean")
         self.log('train_loss', loss)
@@ -48,27 +49,27 @@ class EfficientNet(ClassificationModel):
 
     def training_step_end(self, outputs) -> None:
         preds, targets = outputs["preds"], outputs["target"]
-        self._train_acc(preds, targets)
+        self._train_metrics(preds, targets)
         return outputs["loss"]
 
     def training_epoch_end(self, outputs: List[Any]) -> None:
-        value = self._train_acc.compute()
-        self.log('train_acc', value, on_step=False, on_epoch=True)
-        self._train_acc.reset()
+        values = self._train_metrics.compute()
+        self.log_dict({f"train_{key}": value for key, value in values.items()}, on_step=False, on_epoch=True)
+        self._train_metrics.reset()
 
     def validation_step(self, batch, batch_idx):
         self._model.eval()
         inputs, targets = batch
         targets = self.onehot_to_label(targets)
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).long()
-        pred_prob = self._model(inputs)
+        inputs, targets = try_cuda(inputs), try_cuda(targets).long()
+        pred_prob = self._model(self.input_normalization(inputs))
         pred_labels = torch.argmax(pred_prob, dim=1)
-        self._val_acc(pred_labels, targets)
+        self._val_metrics(pred_labels, targets)
 
     def on_validation_epoch_end(self) -> None:
-        value = self._val_acc.compute()
-        self.log("val_acc", value, on_step=False, on_epoch=True)
-        self._val_acc.reset()
+        values = self._val_metrics.compute()
+        self.log_dict({f"val_{key}": value for key, value in values.items()}, on_step=False, on_epoch=True)
+        self._val_metrics.reset()
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(lr=self._lr, params=self._model.parameters())
@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
@@ -184,3 +186,40 @@ class DropBlock2d(nn.Module):
 
     def _compute_threshold(self):
         return self.dropout_rate / (self.block_size ** 2)
+
+
+class InputNormalization(nn.Module):
+    """
+    Convert input images to float32 and normalize by channel at the front of model.
+    uint8 images (0~255) are scaled, float images are regarded as already scaled (0~1).
+    Buffers are saved in checkpoints. Checkpoints saved before that keep default normalization when loaded.
+    """
+    _buffer_names = ["scale", "mean", "std"]
+
+    def __init__(self, scale: float = 1 / 255., mean: List[float] = None, std: List[float] = None):
+        """
+        :param scale: Scale of uint8 images.
+        :param mean: Mean by channel of scaled images. Channel order is same as images. (BGR for pil_to_cv)
+        :param std: Standard deviation by channel of scaled images.
+        """
+        super().__init__()
+        self.register_buffer("scale", torch.tensor(scale))
+        self.register_buffer("mean", torch.tensor(mean if mean is not None else [0.]).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std if std is not None else [1.]).view(1, -1, 1, 1))
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        for name in self._buffer_names:
+            if prefix + name in state_dict:
+                # Number of channels of saved normalization can be different from default.
+                buffer = getattr(self, name)
+                setattr(self, name, buffer.new_empty(state_dict[prefix + name].shape))
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+        old_keys = [prefix + name for name in self._buffer_names if prefix + name not in state_dict]
+        missing_keys[:] = [key for key in missing_keys if key not in old_keys]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.is_floating_point():
+            return (x.float() - self.mean) / self.std
+        return (x.float() * self.scale - self.mean) / self.std
@@ -1,13 +1,44 @@
-from typing import List
+from typing import List, Tuple
 import torch
 from torch import nn
 from torch.nn import functional as F
 
 from ...image_process.convert import try_cuda
 
+# Same as boundary of VOC segmentation.
+SEGMENTATION_IGNORE_INDEX = 255
+
+
+def index_to_onehot(teacher: torch.Tensor, n_classes: int, ignore_index: int = None) \
+        -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    :param teacher: (Batch size, height, width) Index mask.
+    :param n_classes:
+    :param ignore_index: Pixels of this value are ignored. Values out of [0, n_classes) are also ignored.
+    :return: (Batch size, classes, height, width) float one-hot (ignored pixels are zero),
+             (Batch size, 1, height, width) valid pixels
+    """
+    teacher = teacher.long()
+    is_valid = (teacher >= 0) & (teacher < n_classes)
+    if ignore_index is not None:
+        is_valid &= teacher != ignore_index
+    onehot = F.one_hot(torch.where(is_valid, teacher, torch.zeros_like(teacher)), n_classes).permute(0, 3, 1, 2)
+    is_valid = is_valid.unsqueeze(1)
+    return onehot.float() * is_valid, is_valid
+
+
+def _masked_mean(loss: torch.Tensor, is_valid: torch.Tensor) -> torch.Tensor:
+    """
+    :param loss: (Batch size, classes, height, width)
+    :param is_valid: (Batch size, 1, height, width)
+    """
+    return (loss * is_valid).sum() / (is_valid.sum() * loss.shape[1]).clamp(min=1)
+
 
 class JaccardLoss(torch.nn.Module):
     def forward(self, pred: torch.Tensor, teacher: torch.Tensor, smooth=1.0):
+        if teacher.ndim == 3:
+            teacher = index_to_onehot(teacher, pred.shape[1])[0]
         teacher = teacher.float()
         intersection = (pred * teacher).sum((-1, -2))
         sum_ = (pred.abs() + pred.abs()).sum((-1, -2))
@@ -22,10 +53,12 @@ class DiceLoss(torch.nn.Module):
     def forward(self, pred: torch.Tensor, teacher: torch.Tensor, smooth=1.0):
         """
         :param pred:
-        :param teacher:
+        :param teacher: One-hot or index mask.
         :param smooth:
         :return:
         """
+        if teacher.ndim == 3:
+            teacher = index_to_onehot(teacher, pred.shape[1])[0]
         pred = F.normalize(pred - pred.min(), 1)
         pred, teacher = teacher.float(), pred.float()
 
@@ -46,10 +79,12 @@ class DiceLossWithAreaPenalty(torch.nn.Module):
     def forward(self, pred, teacher, smooth=1.0):
         """
         :param pred: 推論結果 (Batch size * class num * height * width)
-        :param teacher: 教師データ (Batch size * class num * height * weigh )
+        :param teacher: 教師データ (Batch size * class num * height * weigh ) or index mask
         :param smooth:
         :return:
         """
+        if teacher.ndim == 3:
+            teacher = index_to_onehot(teacher, pred.shape[1])[0]
         pred = F.normalize(pred - pred.min(), 1)
         # print("pred", pred.sum(1, ))
 
@@ -81,8 +116,12 @@ class DiceLossWithAreaPenalty(torch.nn.Module):
 
 
 class AdaptiveCrossEntropyLoss(nn.Module):
-    def __init__(self):
+    def __init__(self, ignore_index: int = SEGMENTATION_IGNORE_INDEX):
+        """
+        :param ignore_index: Ignored value of index mask.
+        """
         super().__init__()
+        self._ignore_index = ignore_index
 
     def forward(self, pred: torch.Tensor, teacher: torch.Tensor):
         """
@@ -95,21 +134,24 @@ class AdaptiveCrossEntropyLoss(nn.Module):
             # return nn.BCEWithLogitsLoss()(pred, teacher)
             # return F.binary_cross_entropy(nn.LogSoftmax(dim=1)(pred), teacher, reduction="mean")
         if pred.ndim == 4 and teacher.ndim == 3:
-            return F.cross_entropy(pred, teacher, reduction="mean")
+            return F.cross_entropy(pred, teacher.long(), reduction="mean", ignore_index=self._ignore_index)
         if pred.ndim == 2 and teacher.ndim == 1:
             return F.cross_entropy(pred, teacher, reduction="mean")
         assert False, f"Invalid pred or teacher type,  {pred.shape} and {teacher.shape}"
 
 
 class SegmentationFocalLoss(nn.Module):
-    def __init__(self, gamma=2, weights: List[float] = None, logits=True):
+    def __init__(self, gamma=2, weights: List[float] = None, logits=True,
+                 ignore_index: int = SEGMENTATION_IGNORE_INDEX):
         """
         :param gamma: 簡単なサンプルの重み. 大きいほど簡単なサンプルを重視しない.
         :param weights: weights by classes,
         :param logits:
+        :param ignore_index: Ignored value of index mask.
         """
         super().__init__()
         self.gamma = gamma
+        self._ignore_index = ignore_index
         self.class_weight_tensor = try_cuda(torch.tensor(weights).view(-1, 1, 1)) if weights else None
         self.logits = logits
         if not logits and weights is not None:
@@ -118,10 +160,14 @@ class SegmentationFocalLoss(nn.Module):
     def forward(self, pred: torch.Tensor, teacher: torch.Tensor) -> float:
         """
         :param pred: batch_size, n_classes, height, width
-        :param teacher: batch_size, n_classes, height, width
+        :param teacher: batch_size, n_classes, height, width (one-hot) or batch_size, height, width (index)
         :return:
         """
+        is_valid = None
         if self.logits:
+            if teacher.ndim == 3:
+                # One-hot is required only for binary cross entropy.
+                teacher, is_valid = index_to_onehot(teacher, pred.shape[1], self._ignore_index)
             ce_loss = F.binary_cross_entropy_with_logits(pred, teacher, reduce=False)
             pt = torch.exp(-ce_loss)
             if self.class_weight_tensor is not None:
@@ -133,9 +179,17 @@ class SegmentationFocalLoss(nn.Module):
             else:
                 focal_loss = (1. - pt) ** self.gamma * ce_loss
         else:
-            ce_loss = F.cross_entropy(pred, teacher.argmax(1), reduce=False)
+            if teacher.ndim == 3:
+                is_valid = (teacher.long() != self._ignore_index).unsqueeze(1)
+                ce_loss = F.cross_entropy(pred, teacher.long(), reduce=False, ignore_index=self._ignore_index)
+            else:
+                ce_loss = F.cross_entropy(pred, teacher.argmax(1), reduce=False)
             pt = torch.exp(-ce_loss)
             focal_loss = (1. - pt) ** self.gamma * ce_loss
+            if is_valid is not None:
+                focal_loss = focal_loss.unsqueeze(1)
+        if is_valid is not None:
+            return _masked_mean(focal_loss, is_valid)
         return torch.mean(focal_loss)
 
 
@@ -223,15 +277,18 @@ class ClassificationFocalLossWithLabelSmoothing(nn.Module):
 
 
 class SegmentationFocalLossWithLabelSmoothing(nn.Module):
-    def __init__(self, n_classes: int, gamma=2, alpha=0.3, weights: List[float] = None, logits=True):
+    def __init__(self, n_classes: int, gamma=2, alpha=0.3, weights: List[float] = None, logits=True,
+                 ignore_index: int = SEGMENTATION_IGNORE_INDEX):
         """
         :param alpha: parameter of Label Smoothing.
         :param gamma: 簡単なサンプルの重み. 大きいほど簡単なサンプルを重視しない.
         :param weights: weights by classes,
         :param logits:
+        :param ignore_index: Ignored value of index mask.
         """
         super().__init__()
         self.gamma = gamma
+        self._ignore_index = ignore_index
         self._alpha = alpha
         self._noise_val = alpha / n_classes
         self.class_weight_tensor = try_cuda(torch.tensor(weights).view(-1, 1, 1)) if weights else None
@@ -239,9 +296,12 @@ class SegmentationFocalLossWithLabelSmoothing(nn.Module):
     def forward(self, pred: torch.Tensor, teacher: torch.Tensor) -> float:
         """
         :param pred: batch_size, n_classes, height, width
-        :param teacher: batch_size, n_classes, height, width
+        :param teacher: batch_size, n_classes, height, width (one-hot) or batch_size, height, width (index)
         :return:
         """
+        is_valid = None
+        if teacher.ndim == 3:
+            teacher, is_valid = index_to_onehot(teacher, pred.shape[1], self._ignore_index)
         teacher = teacher * (1 - self._alpha) + self._noise_val
 
         ce_loss = F.binary_cross_entropy_with_logits(pred, teacher, reduce=False)
@@ -255,4 +315,6 @@ class SegmentationFocalLossWithLabelSmoothing(nn.Module):
         else:
             focal_loss = (1. - pt) ** self.gamma * ce_loss
 
+        if is_valid is not None:
+            return _masked_mean(focal_loss, is_valid)
         return torch.mean(focal_loss)
@@ -1,2 +1,3 @@
 from .efficientdet import EfficientDetector
 from . import functions
+from . import result_store
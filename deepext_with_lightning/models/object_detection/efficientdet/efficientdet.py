@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 import torch
 import numpy as np
@@ -7,6 +7,7 @@ import pytorch_lightning as pl
 from ....models.base.detection_model import DetectionModel
 from .efficientdet_lib.models.efficientdet import EfficientDet
 from ....metrics.object_detection import DetectionIoU, MeanAveragePrecision
+from ....metrics.async_metric import AsyncMetric
 from .efficientdet_lib.utils import EFFICIENTDET
 from ....image_process.convert import try_cuda
 
@@ -15,7 +16,11 @@ __all__ = ['EfficientDetector']
 
 class EfficientDetector(DetectionModel):
     def __init__(self, n_classes, network='efficientdet-d0', lr=1e-4, score_threshold=0.5, max_detections=50,
-                 backbone_path: str = None, backbone_pretrained=True):
+                 backbone_path: str = None, backbone_pretrained=True, async_metrics=False, pre_nms_top_k=1000):
+        """
+        :param async_metrics: Update validation metrics in background thread (opt-in). see AsyncMetric.
+        :param pre_nms_top_k: Number of candidates by image before NMS.
+        """
         super().__init__()
         self.save_hyperparameters()
         self._model = try_cuda(EfficientDet(num_classes=n_classes,
@@ -24,7 +29,8 @@ class EfficientDetector(DetectionModel):
                                             D_bifpn=EFFICIENTDET[network]['D_bifpn'],
                                             D_class=EFFICIENTDET[network]['D_class'], backbone_path=backbone_path,
                                             backbone_pretrained=backbone_pretrained,
-                                            threshold=score_threshold))
+                                            threshold=score_threshold, pre_nms_top_k=pre_nms_top_k,
+                                            max_detections=max_detections))
         self._n_classes = n_classes
         self._network = network
         self._max_detections = max_detections
@@ -34,47 +40,66 @@ class EfficientDetector(DetectionModel):
         self._val_map: pl.metrics.Metric = try_cuda(MeanAveragePrecision(n_classes))
         self._train_iou: pl.metrics.Metric = try_cuda(DetectionIoU(n_classes))
         self._val_iou: pl.metrics.Metric = try_cuda(DetectionIoU(n_classes))
+        if async_metrics:
+            self._val_map, self._val_iou = AsyncMetric(self._val_map), AsyncMetric(self._val_iou)
 
     def forward(self, x: torch.Tensor):
-        return self._model(x)
+        return self._model(self.input_normalization(x))
+
+    def save_model_for_mobile(self, width: int, height: int, out_filepath: str, for_os="cpu", uint8_input=False):
+        """
+        Anchors of (height, width) are kept in exported model as constants.
+        """
+        self._model.is_training = False
+        self._model.anchors.fix_image_size(height, width)
+        # Custom autograd function of memory efficient swish can not be exported.
+        self._model.backbone.set_swish(memory_efficient=False)
+        super().save_model_for_mobile(width, height, out_filepath, for_os, uint8_input)
+        self._model.backbone.set_swish(memory_efficient=True)
 
     def predict_bboxes(self, imgs: torch.Tensor) -> List[np.ndarray]:
+        padded_bboxes = self.predict_padded_bboxes(imgs).cpu().numpy()
+        return [bboxes[bboxes[:, 4] >= 0] for bboxes in padded_bboxes]
+
+    def predict_padded_bboxes(self, imgs: torch.Tensor) -> torch.Tensor:
+        """
+        Result stays on device of model.
+        :param imgs: (Batch size, channels, height, width)
+        :return: (Batch size, max detections, 6(xmin, ymin, xmax, ymax, label, score)) Sorted by score.
+                 Padding has label -1.
+        """
         with torch.no_grad():
             self._model.eval()
             self._model.is_training = False
             assert imgs.ndim == 4
+            return self._model.detect(self.input_normalization(try_cuda(imgs)), max_detections=self._max_detections)
 
-            result = []
-            for i in range(imgs.shape[0]):
-                # TODO ここtensorにしたいけど公式がnumpy
-                image = imgs[i].float().unsqueeze(0)
-                scores, labels, boxes = self._model(try_cuda(image))
-                scores = scores.detach().cpu().numpy()
-                labels = labels.detach().cpu().numpy()
-                boxes = boxes.detach().cpu().numpy()
-                scores_sort = np.argsort(-scores)[:self._max_detections]
-                # select detections
-                image_boxes = boxes[scores_sort, :]
-                image_scores = scores[scores_sort]
-                image_labels = labels[scores_sort]
-                image_detections = np.concatenate([
-                    image_boxes,
-                    np.expand_dims(image_labels, axis=1),
-                    np.expand_dims(image_scores, axis=1),
-                ], axis=1)
-                result.append(image_detections)
-            return result
+    def predict_raw_detections(self, imgs: torch.Tensor, score_threshold: float = None) \
+            -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Detections before NMS. Used to tune post processing without inference. see result_store.
+        :param imgs: (Batch size, channels, height, width)
+        :param score_threshold: Minimum score (exclusive). Default is score_threshold of model.
+        :return: (scores (N, ), labels (N, ), boxes (N, 4(xmin, ymin, xmax, ymax))) by image.
+        """
+        with torch.no_grad():
+            self._model.eval()
+            self._model.is_training = False
+            assert imgs.ndim == 4
+            result = self._model.forward_pre_nms(self.input_normalization(try_cuda(imgs)), threshold=score_threshold)
+            return [(scores.cpu().numpy(), labels.cpu().numpy(), boxes.cpu().numpy())
+                    for scores, labels, boxes in result]
 
     def training_step(self, batch, batch_idx):
         self._model.train()
         self._model.is_training = True
         self._model.freeze_bn()
 
-        inputs, targets = batch
-        annotations = torch.tensor(targets) if not isinstance(targets, torch.Tensor) else targets
-        annotations = try_cuda(annotations.float())
-        images = try_cuda(inputs)
-        classification_loss, regression_loss = self._model([images, annotations])
+        # Targets are padded float32 tensor from AdjustDetectionTensorCollator. (no copy)
+        inputs, targets = batch[0], batch[1]
+        annotations = try_cuda(torch.as_tensor(targets, dtype=torch.float32))
+        images, annotations, _ = self.augment_batch(try_cuda(inputs), bboxes=annotations)
+        classification_loss, regression_loss = self._model([self.input_normalization(images), annotations])
         classification_loss = classification_loss.mean()
         regression_loss = regression_loss.mean()
         loss = classification_loss + regression_loss
@@ -85,10 +110,10 @@ class EfficientDetector(DetectionModel):
         self._model.eval()
         self._model.is_training = False
 
-        inputs, targets = batch
-        targets = torch.tensor(targets) if not isinstance(targets, torch.Tensor) else targets
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).long()
-        result = self.predict_bboxes(inputs)
+        inputs, targets = batch[0], batch[1]
+        targets = torch.as_tensor(targets, dtype=torch.float32)
+        inputs, targets = try_cuda(inputs), try_cuda(targets).float()
+        result = self.predict_padded_bboxes(inputs)
         self._val_iou(result, targets)
         self._val_map(result, targets)
 
@@ -1,4 +1,4 @@
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -7,7 +7,7 @@ from .efficientnet import EfficientNet
 from .bifpn import BIFPN
 from .retinahead import RetinaHead
 from .module import RegressionModel, ClassificationModel, Anchors, ClipBoxes, BBoxTransform
-from torchvision.ops import nms
+from torchvision.ops import batched_nms
 from .losses import FocalLoss
 
 MODEL_MAP = {
@@ -32,7 +32,9 @@ class EfficientDet(nn.Module):
                  is_training=True,
                  threshold=0.01,
                  iou_threshold=0.5,
-                 backbone_path: str = None, backbone_pretrained=True):
+                 backbone_path: str = None, backbone_pretrained=True,
+                 pre_nms_top_k=1000,
+                 max_detections=100):
         super(EfficientDet, self).__init__()
         self.backbone: EfficientNet = EfficientNet.from_pretrained(
             MODEL_MAP[network]) if backbone_pretrained else EfficientNet.from_name(MODEL_MAP[network])
@@ -52,6 +54,8 @@ class EfficientDet(nn.Module):
         self.clipBoxes = ClipBoxes()
         self.threshold = threshold
         self.iou_threshold = iou_threshold
+        self.pre_nms_top_k = pre_nms_top_k
+        self.max_detections = max_detections
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
@@ -63,41 +67,97 @@ class EfficientDet(nn.Module):
         self.criterion = FocalLoss()
 
     def forward(self, inputs: Union[Tuple[torch.Tensor, torch.Tensor], torch.Tensor]) -> Union[
-        torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
         """
-        :param inputs: predicting (channels, height, width) or
+        :param inputs: predicting (batch size, channels, height, width) or
                         training (batch size, channels, height, width), (batch size, bounding box count, 5)
                             (x_min, y_min, x_max, y_max, class label)
-        :return: predicting (BBox, ), (BBox, ), (BBox, 4) or training loss (float, float)
+        :return: predicting (batch size, max detections, 6) see detect, or training loss (float, float)
         """
         if self.is_training:
             inputs, annotations = inputs
-        else:
-            inputs = inputs
+            classification, regression = self._head(inputs)
+            return self.criterion(classification, regression, self.anchors(inputs), annotations,
+                                  self.anchors.centers_sizes(inputs))
+        return self.detect(inputs)
+
+    def detect(self, inputs: torch.Tensor, threshold: float = None, max_detections: int = None) -> torch.Tensor:
+        """
+        Detections of all images by one forward. Top-k selection, decoding and NMS stay on device.
+        Boxes are decoded only for top pre_nms_top_k anchors over threshold by image, and NMS is by (image, class).
+        :param inputs: (batch size, channels, height, width)
+        :param threshold: Minimum score (exclusive). Default is self.threshold
+        :param max_detections: Default is self.max_detections
+        :return: (batch size, max detections, 6(x_min, y_min, x_max, y_max, label, score)) Sorted by score.
+                 Padding has label -1.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        max_detections = self.max_detections if max_detections is None else max_detections
+        classification, regression = self._head(inputs)
+        image_indices, anchor_indices, scores, labels = self._select_top(classification, threshold)
+        boxes = self._decode_boxes(inputs, regression, image_indices, anchor_indices)
+
+        # Offset by image and class, so NMS of all images runs at once. Result is sorted by score.
+        keep = batched_nms(boxes, scores, image_indices * classification.shape[2] + labels, self.iou_threshold)
+        keep = keep[torch.argsort(image_indices[keep] * keep.shape[0] +
+                                  torch.arange(keep.shape[0], device=keep.device))]
+        image_indices = image_indices[keep]
+        counts = torch.bincount(image_indices, minlength=inputs.shape[0])
+        positions = torch.arange(keep.shape[0], device=keep.device) - (torch.cumsum(counts, 0) - counts)[image_indices]
+        is_kept = positions < max_detections
+        result = torch.full([inputs.shape[0], max_detections, 6], -1., device=inputs.device)
+        result[image_indices[is_kept], positions[is_kept]] = torch.cat([
+            boxes[keep][is_kept], labels[keep][is_kept].unsqueeze(1).float(), scores[keep][is_kept].unsqueeze(1)
+        ], dim=1)
+        return result
+
+    def forward_pre_nms(self, inputs: torch.Tensor, threshold: float = None) \
+            -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """
+        Decoded detections before NMS. Same candidates as detect. (top pre_nms_top_k anchors over threshold by image)
+        Each anchor has max score class.
+        :param inputs: (batch size, channels, height, width)
+        :param threshold: Minimum score (exclusive). Default is self.threshold
+        :return: (scores (N, ), labels (N, ), boxes (N, 4)) by image. Sorted by score.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        classification, regression = self._head(inputs)
+        image_indices, anchor_indices, scores, labels = self._select_top(classification, threshold)
+        boxes = self._decode_boxes(inputs, regression, image_indices, anchor_indices)
+        counts = torch.bincount(image_indices, minlength=inputs.shape[0]).tolist()
+        return list(zip(scores.split(counts), labels.split(counts), boxes.split(counts)))
+
+    def _select_top(self, classification: torch.Tensor, threshold: float) \
+            -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Top pre_nms_top_k anchors by image, and then scores over threshold.
+        Top-k does not depend on threshold, so candidates over higher threshold are subset of them.
+        :return: image indices, anchor indices, scores, labels (N, ) Sorted by image and score.
+        """
+        scores, labels = torch.max(classification, dim=2)
+        top_scores, top_anchor_indices = scores.topk(min(self.pre_nms_top_k, scores.shape[1]), dim=1)
+        image_indices, top_indices = torch.nonzero(top_scores > threshold, as_tuple=True)
+        anchor_indices = top_anchor_indices[image_indices, top_indices]
+        return image_indices, anchor_indices, top_scores[image_indices, top_indices], \
+               labels[image_indices, anchor_indices]
+
+    def _head(self, inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        :return: classification (batch size, anchors, classes), regression (batch size, anchors, 4)
+        """
         x = self.extract_feat(inputs)
         outs = self.bbox_head(x)
-        classification = torch.cat([out for out in outs[0]], dim=1)
-        regression = torch.cat([out for out in outs[1]], dim=1)
-        anchors = self.anchors(inputs)
-        if self.is_training:
-            return self.criterion(classification, regression, anchors, annotations)
-        else:
-            transformed_anchors = self.regressBoxes(anchors, regression)
-            transformed_anchors = self.clipBoxes(transformed_anchors, inputs)
-            scores = torch.max(classification, dim=2, keepdim=True)[0]
-            scores_over_thresh = (scores > self.threshold)[0, :, 0]
+        return torch.cat([out for out in outs[0]], dim=1), torch.cat([out for out in outs[1]], dim=1)
 
-            if scores_over_thresh.sum() == 0:
-                # print('No boxes to NMS')
-                # no boxes to NMS, just return
-                return torch.zeros(0), torch.zeros(0), torch.zeros(0, 4)
-            classification = classification[:, scores_over_thresh, :]
-            transformed_anchors = transformed_anchors[:, scores_over_thresh, :]
-            scores = scores[:, scores_over_thresh, :]
-            anchors_nms_idx = nms(
-                transformed_anchors[0, :, :], scores[0, :, 0], iou_threshold=self.iou_threshold)
-            nms_scores, nms_class = classification[0, anchors_nms_idx, :].max(dim=1)
-            return nms_scores, nms_class, transformed_anchors[0, anchors_nms_idx, :]
+    def _decode_boxes(self, inputs: torch.Tensor, regression: torch.Tensor, image_indices: torch.Tensor,
+                      anchor_indices: torch.Tensor) -> torch.Tensor:
+        """
+        Decode only selected anchors.
+        :return: (N, 4)
+        """
+        boxes = self.regressBoxes(None, regression[image_indices, anchor_indices].unsqueeze(0),
+                                  self.anchors.centers_sizes(inputs)[:, anchor_indices])
+        return self.clipBoxes(boxes, inputs)[0]
 
     def freeze_bn(self):
         '''Freeze BatchNorm layers.'''
@@ -1,15 +1,20 @@
-import numpy as np
 import torch
 import torch.nn as nn
 
 
 def calc_iou(a, b):
-    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    """
+    :param a: (N, 4)
+    :param b: (M, 4) or (batch size, M, 4)
+    :return: (N, M) or (batch size, N, M)
+    """
+    b = b.unsqueeze(-3)
+    area = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
 
     iw = torch.min(torch.unsqueeze(
-        a[:, 2], dim=1), b[:, 2]) - torch.max(torch.unsqueeze(a[:, 0], 1), b[:, 0])
+        a[:, 2], dim=1), b[..., 2]) - torch.max(torch.unsqueeze(a[:, 0], 1), b[..., 0])
     ih = torch.min(torch.unsqueeze(
-        a[:, 3], dim=1), b[:, 3]) - torch.max(torch.unsqueeze(a[:, 1], 1), b[:, 1])
+        a[:, 3], dim=1), b[..., 3]) - torch.max(torch.unsqueeze(a[:, 1], 1), b[..., 1])
 
     iw = torch.clamp(iw, min=0)
     ih = torch.clamp(ih, min=0)
@@ -26,127 +31,117 @@ def calc_iou(a, b):
     return IoU
 
 
-class FocalLoss(nn.Module):
-    # def __init__(self):
-
-    def forward(self, classifications, regressions, anchors, annotations):
-        alpha = 0.25
-        gamma = 2.0
-        batch_size = classifications.shape[0]
-        classification_losses = []
-        regression_losses = []
-
-        anchor = anchors[0, :, :]
-
-        anchor_widths = anchor[:, 2] - anchor[:, 0]
-        anchor_heights = anchor[:, 3] - anchor[:, 1]
-        anchor_ctr_x = anchor[:, 0] + 0.5 * anchor_widths
-        anchor_ctr_y = anchor[:, 1] + 0.5 * anchor_heights
-
-        for j in range(batch_size):
-
-            classification = classifications[j, :, :]
-            regression = regressions[j, :, :]
-
-            bbox_annotation = annotations[j, :, :]
-            bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
-
-            if bbox_annotation.shape[0] == 0:
-                regression_losses.append(torch.tensor(0).float().cuda())
-                classification_losses.append(torch.tensor(0).float().cuda())
-
-                continue
-
-            classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
-
-            # num_anchors x num_annotations
-            IoU = calc_iou(anchors[0, :, :], bbox_annotation[:, :4])
-
-            IoU_max, IoU_argmax = torch.max(IoU, dim=1)  # num_anchors x 1
-
-            #import pdb
-            # pdb.set_trace()
-
-            # compute the loss for classification
-            targets = torch.ones(classification.shape) * -1
-            targets = targets.cuda()
-
-            targets[torch.lt(IoU_max, 0.4), :] = 0
-
-            positive_indices = torch.ge(IoU_max, 0.5)
-
-            num_positive_anchors = positive_indices.sum()
-
-            assigned_annotations = bbox_annotation[IoU_argmax, :]
+class NegativeFocalLossImplementation(torch.autograd.Function):
+    """
+    Sum by anchor of p^gamma * -log(1 - p) over classes with p clamped to (1e-4, 1 - 1e-4).
+    Only input is saved for backward like MemoryEfficientSwish, so intermediates of (batch size, anchors, classes)
+    are not kept until backward.
+    """
+
+    @staticmethod
+    def forward(ctx, classifications, gamma):
+        ctx.gamma = gamma
+        ctx.save_for_backward(classifications)
+        classification = torch.clamp(classifications, 1e-4, 1.0 - 1e-4)
+        return (torch.pow(classification, gamma) * -torch.log1p(-classification)).sum(dim=2)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        classifications = ctx.saved_tensors[0]
+        gamma = ctx.gamma
+        classification = torch.clamp(classifications, 1e-4, 1.0 - 1e-4)
+        # d/dp p^gamma * -log(1 - p) = gamma * p^(gamma - 1) * -log(1 - p) + p^gamma / (1 - p)
+        grad = torch.pow(classification, gamma - 1) * (
+                gamma * -torch.log1p(-classification) + classification / (1. - classification))
+        # No gradient where clamped.
+        grad = grad.masked_fill_((classifications < 1e-4) | (classifications > 1.0 - 1e-4), 0.)
+        return grad * grad_output.unsqueeze(2), None
 
-            targets[positive_indices, :] = 0
-            targets[positive_indices,
-                    assigned_annotations[positive_indices, 4].long()] = 1
 
-            alpha_factor = torch.ones(targets.shape).cuda() * alpha
-
-            alpha_factor = torch.where(
-                torch.eq(targets, 1.), alpha_factor, 1. - alpha_factor)
-            focal_weight = torch.where(
-                torch.eq(targets, 1.), 1. - classification, classification)
-            focal_weight = alpha_factor * torch.pow(focal_weight, gamma)
-
-            bce = -(targets * torch.log(classification) +
-                    (1.0 - targets) * torch.log(1.0 - classification))
-
-            # cls_loss = focal_weight * torch.pow(bce, gamma)
-            cls_loss = focal_weight * bce
-
-            cls_loss = torch.where(
-                torch.ne(targets, -1.0), cls_loss, torch.zeros(cls_loss.shape).cuda())
-
-            classification_losses.append(
-                cls_loss.sum()/torch.clamp(num_positive_anchors.float(), min=1.0))
-
-            # compute the loss for regression
-
-            if positive_indices.sum() > 0:
-                assigned_annotations = assigned_annotations[positive_indices, :]
-
-                anchor_widths_pi = anchor_widths[positive_indices]
-                anchor_heights_pi = anchor_heights[positive_indices]
-                anchor_ctr_x_pi = anchor_ctr_x[positive_indices]
-                anchor_ctr_y_pi = anchor_ctr_y[positive_indices]
-
-                gt_widths = assigned_annotations[:,
-                                                 2] - assigned_annotations[:, 0]
-                gt_heights = assigned_annotations[:,
-                                                  3] - assigned_annotations[:, 1]
-                gt_ctr_x = assigned_annotations[:, 0] + 0.5 * gt_widths
-                gt_ctr_y = assigned_annotations[:, 1] + 0.5 * gt_heights
-
-                # clip widths to 1
-                gt_widths = torch.clamp(gt_widths, min=1)
-                gt_heights = torch.clamp(gt_heights, min=1)
-
-                targets_dx = (gt_ctr_x - anchor_ctr_x_pi) / anchor_widths_pi
-                targets_dy = (gt_ctr_y - anchor_ctr_y_pi) / anchor_heights_pi
-                targets_dw = torch.log(gt_widths / anchor_widths_pi)
-                targets_dh = torch.log(gt_heights / anchor_heights_pi)
-
-                targets = torch.stack(
-                    (targets_dx, targets_dy, targets_dw, targets_dh))
-                targets = targets.t()
-
-                targets = targets/torch.Tensor([[0.1, 0.1, 0.2, 0.2]]).cuda()
-
-                negative_indices = 1 + (~positive_indices)
-
-                regression_diff = torch.abs(
-                    targets - regression[positive_indices, :])
-
-                regression_loss = torch.where(
-                    torch.le(regression_diff, 1.0 / 9.0),
-                    0.5 * 9.0 * torch.pow(regression_diff, 2),
-                    regression_diff - 0.5 / 9.0
-                )
-                regression_losses.append(regression_loss.mean())
-            else:
-                regression_losses.append(torch.tensor(0).float().cuda())
+class FocalLoss(nn.Module):
+    """
+    Focal loss and smooth L1 loss of all images at once on device of inputs.
+    Anchors with IoU >= 0.5 are positive, < 0.4 are negative and others are ignored.
+    """
+
+    def __init__(self, alpha=0.25, gamma=2.0, regression_std=(0.1, 0.1, 0.2, 0.2)):
+        super(FocalLoss, self).__init__()
+        self.alpha = alpha
+        self.gamma = gamma
+        self.regression_std = regression_std
+
+    def forward(self, classifications, regressions, anchors, annotations, anchor_centers_sizes=None):
+        """
+        :param classifications: (batch size, anchors, classes) Probabilities.
+        :param regressions: (batch size, anchors, 4)
+        :param anchors: (1, anchors, 4)
+        :param annotations: (batch size, max bounding box count, 5) Padding has label -1.
+        :param anchor_centers_sizes: Anchors.centers_sizes. Computed from anchors if None.
+        :return: classification loss (1, ), regression loss (1, )
+        """
+        if anchor_centers_sizes is None:
+            anchor = anchors[0, :, :]
+            anchor_widths = anchor[:, 2] - anchor[:, 0]
+            anchor_heights = anchor[:, 3] - anchor[:, 1]
+            anchor_ctr_x = anchor[:, 0] + 0.5 * anchor_widths
+            anchor_ctr_y = anchor[:, 1] + 0.5 * anchor_heights
+        else:
+            anchor_ctr_x, anchor_ctr_y, anchor_widths, anchor_heights = anchor_centers_sizes[0].unbind(dim=1)
+
+        is_valid_annotation = annotations[:, :, 4] != -1
+        # Images without annotation have no loss.
+        has_annotation = is_valid_annotation.any(dim=1)
+        if annotations.shape[1] == 0 or not has_annotation.any():
+            zero = classifications.new_zeros([1])
+            return zero, zero.clone()
+
+        # Assign annotation of max IoU to each anchor. (batch size, anchors)
+        IoU = calc_iou(anchors[0, :, :], annotations[:, :, :4])
+        IoU = IoU.masked_fill(~is_valid_annotation.unsqueeze(1), -1.)
+        IoU_max, IoU_argmax = torch.max(IoU, dim=2)
+        positive_indices = torch.ge(IoU_max, 0.5) & has_annotation.unsqueeze(1)
+        is_target = (torch.lt(IoU_max, 0.4) | positive_indices) & has_annotation.unsqueeze(1)
+        num_positive_anchors = positive_indices.sum(dim=1).float()
+        assigned_annotations = torch.gather(annotations, 1, IoU_argmax.unsqueeze(2).expand(-1, -1, 5))
+
+        # Loss as negative for all classes, then replace assigned class of positive anchors.
+        # So dense targets (batch size, anchors, classes) are not needed.
+        negative_losses = NegativeFocalLossImplementation.apply(classifications, self.gamma)
+        assigned_labels = assigned_annotations[:, :, 4].long().clamp(min=0).unsqueeze(2)
+        assigned_classification = torch.clamp(torch.gather(classifications, 2, assigned_labels).squeeze(2),
+                                              1e-4, 1.0 - 1e-4)
+        positive_losses = self.alpha * torch.pow(1. - assigned_classification, self.gamma) * \
+                          -torch.log(assigned_classification) - \
+                          (1. - self.alpha) * torch.pow(assigned_classification, self.gamma) * \
+                          -torch.log(1. - assigned_classification)
+        cls_loss = ((1. - self.alpha) * negative_losses * is_target).sum(dim=1) + \
+                   (positive_losses * positive_indices).sum(dim=1)
+        classification_losses = cls_loss / torch.clamp(num_positive_anchors, min=1.0)
+
+        # Regression targets of all anchors, only positive anchors are summed.
+        gt_widths = assigned_annotations[:, :, 2] - assigned_annotations[:, :, 0]
+        gt_heights = assigned_annotations[:, :, 3] - assigned_annotations[:, :, 1]
+        gt_ctr_x = assigned_annotations[:, :, 0] + 0.5 * gt_widths
+        gt_ctr_y = assigned_annotations[:, :, 1] + 0.5 * gt_heights
+
+        # clip widths to 1
+        gt_widths = torch.clamp(gt_widths, min=1)
+        gt_heights = torch.clamp(gt_heights, min=1)
+
+        targets = torch.stack([
+            (gt_ctr_x - anchor_ctr_x) / anchor_widths,
+            (gt_ctr_y - anchor_ctr_y) / anchor_heights,
+            torch.log(gt_widths / anchor_widths),
+            torch.log(gt_heights / anchor_heights),
+        ], dim=2) / regressions.new_tensor(self.regression_std)
+
+        regression_diff = torch.abs(targets - regressions)
+        regression_loss = torch.where(
+            torch.le(regression_diff, 1.0 / 9.0),
+            0.5 * 9.0 * torch.pow(regression_diff, 2),
+            regression_diff - 0.5 / 9.0
+        )
+        regression_loss = (regression_loss.sum(dim=2) * positive_indices).sum(dim=1)
+        regression_losses = regression_loss / torch.clamp(num_positive_anchors * 4, min=1.0)
+        return classification_losses.mean(dim=0, keepdim=True), regression_losses.mean(dim=0, keepdim=True)
 
-        return torch.stack(classification_losses).mean(dim=0, keepdim=True), torch.stack(regression_losses).mean(dim=0, keepdim=True)
@@ -1,4 +1,7 @@
 
+from collections import OrderedDict
+from typing import Tuple
+
 import numpy as np
 import torch
 import warnings
@@ -21,12 +24,17 @@ class BBoxTransform(nn.Module):
         else:
             self.std = std
 
-    def forward(self, boxes, deltas):
-
-        widths = boxes[:, :, 2] - boxes[:, :, 0]
-        heights = boxes[:, :, 3] - boxes[:, :, 1]
-        ctr_x = boxes[:, :, 0] + 0.5 * widths
-        ctr_y = boxes[:, :, 1] + 0.5 * heights
+    def forward(self, boxes, deltas, centers_sizes=None):
+        """
+        :param centers_sizes: Anchors.centers_sizes of boxes. Computed from boxes if None.
+        """
+        if centers_sizes is None:
+            widths = boxes[:, :, 2] - boxes[:, :, 0]
+            heights = boxes[:, :, 3] - boxes[:, :, 1]
+            ctr_x = boxes[:, :, 0] + 0.5 * widths
+            ctr_y = boxes[:, :, 1] + 0.5 * heights
+        else:
+            ctr_x, ctr_y, widths, heights = centers_sizes.unbind(dim=2)
 
         dx = deltas[:, :, 0] * self.std[0] + self.mean[0]
         dy = deltas[:, :, 1] * self.std[1] + self.mean[1]
@@ -143,7 +151,12 @@ class ClassificationModel(nn.Module):
 
 
 class Anchors(nn.Module):
-    def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None):
+    """
+    Anchors (1, N, 4(x1, y1, x2, y2)) of all pyramid levels.
+    Generated as tensor on device and cached by (height, width, dtype, device) with LRU.
+    """
+
+    def __init__(self, pyramid_levels=None, strides=None, sizes=None, ratios=None, scales=None, cache_size=8):
         super(Anchors, self).__init__()
 
         if pyramid_levels is None:
@@ -157,27 +170,59 @@ class Anchors(nn.Module):
         if scales is None:
             self.scales = np.array(
                 [2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)])
+        # Reference windows by level. float64 same as numpy version.
+        self._base_anchors = [torch.from_numpy(generate_anchors(base_size=size, ratios=self.ratios, scales=self.scales))
+                              for size in self.sizes]
+        self._cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self.fixed_image_size = None
+        self.register_buffer("fixed_anchors", None, persistent=False)
+        self.register_buffer("fixed_centers_sizes", None, persistent=False)
 
     def forward(self, image):
-
-        image_shape = image.shape[2:]
-        image_shape = np.array(image_shape)
-        image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x)
-                        for x in self.pyramid_levels]
-
-        # compute anchors over all pyramid levels
-        all_anchors = np.zeros((0, 4)).astype(np.float32)
-
+        return self._get(image)[0]
+
+    def centers_sizes(self, image) -> torch.Tensor:
+        """
+        For BBoxTransform and FocalLoss.
+        :return: (1, N, 4(center x, center y, width, height))
+        """
+        return self._get(image)[1]
+
+    def fix_image_size(self, height: int, width: int, device: torch.device = None):
+        """
+        Register anchors of image size as buffers, so exported models keep them as constants.
+        """
+        self.fixed_image_size = (height, width)
+        device = device if device is not None else torch.device("cpu")
+        self.fixed_anchors, self.fixed_centers_sizes = self._generate(height, width, torch.float32, device)
+
+    def _get(self, image) -> Tuple[torch.Tensor, torch.Tensor]:
+        height, width = image.shape[2:]
+        dtype = image.dtype if image.is_floating_point() else torch.float32
+        if self.fixed_anchors is not None and self.fixed_image_size == (height, width) and \
+                self.fixed_anchors.device == image.device and self.fixed_anchors.dtype == dtype:
+            return self.fixed_anchors, self.fixed_centers_sizes
+        key = (height, width, dtype, image.device)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        anchors = self._generate(height, width, dtype, image.device)
+        self._cache[key] = anchors
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return anchors
+
+    def _generate(self, height: int, width: int, dtype: torch.dtype, device: torch.device) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        all_anchors = []
         for idx, p in enumerate(self.pyramid_levels):
-            anchors = generate_anchors(
-                base_size=self.sizes[idx], ratios=self.ratios, scales=self.scales)
-            shifted_anchors = shift(
-                image_shapes[idx], self.strides[idx], anchors)
-            all_anchors = np.append(all_anchors, shifted_anchors, axis=0)
-
-        all_anchors = np.expand_dims(all_anchors, axis=0)
-
-        return torch.from_numpy(all_anchors.astype(np.float32)).to(image.device)
+            shape = ((height + 2 ** p - 1) // (2 ** p), (width + 2 ** p - 1) // (2 ** p))
+            all_anchors.append(shift_tensor(shape, self.strides[idx], self._base_anchors[idx].to(device)))
+        all_anchors = torch.cat(all_anchors, dim=0).unsqueeze(0)
+        sizes = all_anchors[:, :, 2:] - all_anchors[:, :, :2]
+        centers = all_anchors[:, :, :2] + 0.5 * sizes
+        return all_anchors.to(dtype), torch.cat([centers, sizes], dim=2).to(dtype)
 
 
 def generate_anchors(base_size=16, ratios=None, scales=None):
@@ -273,6 +318,19 @@ def shift(shape, stride, anchors):
     return all_anchors
 
 
+def shift_tensor(shape, stride, anchors: torch.Tensor) -> torch.Tensor:
+    """
+    Same as shift on device of anchors.
+    :param anchors: (A, 4)
+    :return: (K * A, 4)
+    """
+    shift_x = (torch.arange(shape[1], dtype=anchors.dtype, device=anchors.device) + 0.5) * stride
+    shift_y = (torch.arange(shape[0], dtype=anchors.dtype, device=anchors.device) + 0.5) * stride
+    shift_y, shift_x = torch.meshgrid(shift_y, shift_x, indexing="ij")
+    shifts = torch.stack([shift_x.reshape(-1), shift_y.reshape(-1)] * 2, dim=1)
+    return (anchors.unsqueeze(0) + shifts.unsqueeze(1)).reshape(-1, 4)
+
+
 def conv_ws_2d(input,
                weight,
                bias=None,
@@ -88,11 +88,12 @@ def _get_detections(dataset, model, score_threshold=0.05, max_detections=100, sa
             scale = data['scale']
 
             # run network
-            scores, labels, boxes = model(data['img'].permute(
-                2, 0, 1).cuda().float().unsqueeze(dim=0))
-            scores = scores.cpu().numpy()
-            labels = labels.cpu().numpy()
-            boxes = boxes.cpu().numpy()
+            detections = model(data['img'].permute(
+                2, 0, 1).cuda().float().unsqueeze(dim=0))[0]
+            detections = detections[detections[:, 4] >= 0].cpu().numpy()
+            scores = detections[:, 5]
+            labels = detections[:, 4].astype(np.int64)
+            boxes = detections[:, :4]
 
             # correct boxes for image scale
             boxes /= scale
@@ -0,0 +1,212 @@
+import glob
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Iterator, Union
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision.ops import batched_nms
+
+from .efficientdet import EfficientDetector
+from ...metrics.object_detection import DetectionIoU, RecallPrecision, MeanAveragePrecision
+
+__all__ = ["DetectionResultWriter", "DetectionResultStore", "store_detection_results", "postprocess_raw_detections",
+           "sweep_detection_results"]
+
+RawDetection = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _chunk_paths(root_dir: str) -> List[str]:
+    """
+    :return: Chunk file paths sorted by index.
+    """
+    return sorted(glob.glob(os.path.join(root_dir, "chunk_*.npz")), key=_chunk_index)
+
+
+def _chunk_index(chunk_path: str) -> int:
+    return int(os.path.basename(chunk_path)[len("chunk_"):-len(".npz")])
+
+
+class DetectionResultWriter:
+    """
+    Save raw (before NMS) detections and targets to chunked npz files.
+    Each chunk has flat scores (N, ), labels (N, ), boxes (N, 4), offsets (images + 1, ) and padded targets.
+    """
+
+    def __init__(self, root_dir: str, chunk_size: int = 256, compress: bool = True, append: bool = False):
+        """
+        :param root_dir:
+        :param chunk_size: Number of images by chunk file.
+        :param compress:
+        :param append: If True, chunks are added after existing chunks in root_dir.
+        If False, existing chunks are removed, so results of previous run (e.g. before retraining) are not mixed.
+        """
+        os.makedirs(root_dir, exist_ok=True)
+        self._root_dir = root_dir
+        self._chunk_size = chunk_size
+        self._compress = compress
+        chunk_paths = _chunk_paths(root_dir)
+        if not append:
+            for chunk_path in chunk_paths:
+                os.remove(chunk_path)
+        # Next of max index, so existing chunk is not overwritten even if numbering has gaps.
+        self._n_chunks = _chunk_index(chunk_paths[-1]) + 1 if append and len(chunk_paths) > 0 else 0
+        self._raw_detections: List[RawDetection] = []
+        self._targets: List[np.ndarray] = []
+
+    def append(self, raw_detections: List[RawDetection], targets: Union[np.ndarray, torch.Tensor]):
+        """
+        :param raw_detections: (scores (N, ), labels (N, ), boxes (N, 4)) by image.
+        :param targets: (batch size, bounding box count, 5(x_min, y_min, x_max, y_max, label)) Padding has label -1.
+        """
+        targets = targets.cpu().numpy() if isinstance(targets, torch.Tensor) else np.asarray(targets)
+        for raw_detection, target in zip(raw_detections, targets):
+            self._raw_detections.append(raw_detection)
+            self._targets.append(target[target[:, 4] >= 0])
+            if len(self._raw_detections) >= self._chunk_size:
+                self.flush()
+
+    def flush(self):
+        if len(self._raw_detections) == 0:
+            return
+        max_targets = max([target.shape[0] for target in self._targets])
+        targets = np.full([len(self._targets), max(max_targets, 1), 5], -1, dtype=np.float32)
+        for i, target in enumerate(self._targets):
+            targets[i, :target.shape[0]] = target
+        counts = [scores.shape[0] for scores, _, _ in self._raw_detections]
+        save_func = np.savez_compressed if self._compress else np.savez
+        save_func(os.path.join(self._root_dir, f"chunk_{self._n_chunks:05d}.npz"),
+                  scores=np.concatenate([scores for scores, _, _ in self._raw_detections]).astype(np.float32),
+                  labels=np.concatenate([labels for _, labels, _ in self._raw_detections]).astype(np.int32),
+                  boxes=np.concatenate([boxes for _, _, boxes in self._raw_detections]).astype(
+                      np.float32).reshape(-1, 4),
+                  offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                  targets=targets)
+        self._n_chunks += 1
+        self._raw_detections, self._targets = [], []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DetectionResultStore:
+    def __init__(self, root_dir: str):
+        self._chunk_paths = _chunk_paths(root_dir)
+        assert len(self._chunk_paths) > 0, f"No detection results in {root_dir}"
+
+    def __len__(self):
+        total = 0
+        for chunk_path in self._chunk_paths:
+            with np.load(chunk_path) as chunk:
+                total += chunk["offsets"].shape[0] - 1
+        return total
+
+    def chunks(self) -> Iterator[Tuple[List[RawDetection], np.ndarray]]:
+        """
+        :return: Raw detections by image and padded targets (images, bounding box count, 5) of each chunk.
+        """
+        for chunk_path in self._chunk_paths:
+            with np.load(chunk_path) as chunk:
+                scores, labels, boxes, offsets = chunk["scores"], chunk["labels"], chunk["boxes"], chunk["offsets"]
+                targets = chunk["targets"]
+            raw_detections = [(scores[start:end], labels[start:end], boxes[start:end])
+                              for start, end in zip(offsets[:-1], offsets[1:])]
+            yield raw_detections, targets
+
+
+def store_detection_results(model: EfficientDetector, data_loader: DataLoader, root_dir: str,
+                            min_score_threshold: float = 0.01, chunk_size: int = 256, append: bool = False):
+    """
+    Run inference once and save raw detections. Scores not greater than min_score_threshold are dropped,
+    so score thresholds of sweep must be greater than or equal to it.
+    :param model:
+    :param data_loader: Returns (images, targets)
+    :param root_dir:
+    :param min_score_threshold:
+    :param chunk_size: Number of images by chunk file.
+    :param append: see DetectionResultWriter.
+    """
+    with DetectionResultWriter(root_dir, chunk_size=chunk_size, append=append) as writer:
+        for inputs, targets in data_loader:
+            writer.append(model.predict_raw_detections(inputs, score_threshold=min_score_threshold), targets)
+
+
+def postprocess_raw_detections(raw_detection: RawDetection, score_threshold: float, nms_iou_threshold: float,
+                               max_detections: int) -> np.ndarray:
+    """
+    Same post processing as EfficientDetector.predict_bboxes. (NMS by class)
+    Raw detections of EfficientDetector.predict_raw_detections are already top pre_nms_top_k anchors.
+    :param raw_detection: scores (N, ), labels (N, ), boxes (N, 4)
+    :param score_threshold: Minimum score (exclusive).
+    :param nms_iou_threshold:
+    :param max_detections:
+    :return: (bounding boxes, 6(x_min, y_min, x_max, y_max, label, score)) Sorted by score.
+    """
+    scores, labels, boxes = raw_detection
+    is_over_threshold = scores > score_threshold
+    scores, labels, boxes = scores[is_over_threshold], labels[is_over_threshold], boxes[is_over_threshold]
+    if scores.shape[0] == 0:
+        return np.zeros([0, 6], dtype=np.float32)
+    # batched_nms returns indices sorted by score.
+    keep = batched_nms(torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(labels).long(),
+                       iou_threshold=nms_iou_threshold).numpy()
+    keep = keep[:max_detections]
+    return np.concatenate([boxes[keep], labels[keep, None].astype(np.float32), scores[keep, None]], axis=1)
+
+
+def _init_worker():
+    # Parallelism is by processes.
+    torch.set_num_threads(1)
+
+
+def _evaluate_setting(args: Tuple[str, int, List[float], float, float, int]) -> dict:
+    root_dir, n_classes, iou_thresholds, score_threshold, nms_iou_threshold, max_detections = args
+    map_metric = MeanAveragePrecision(n_classes, iou_thresholds=iou_thresholds)
+    iou_metric, recall_precision_metric = DetectionIoU(n_classes), RecallPrecision(n_classes)
+    for raw_detections, targets in DetectionResultStore(root_dir).chunks():
+        preds = [postprocess_raw_detections(raw_detection, score_threshold, nms_iou_threshold, max_detections)
+                 for raw_detection in raw_detections]
+        for metric in [map_metric, iou_metric, recall_precision_metric]:
+            metric.update(preds, targets)
+
+    result = {"score_threshold": score_threshold, "nms_iou_threshold": nms_iou_threshold,
+              "max_detections": max_detections}
+    map_value = map_metric.compute()
+    result.update(map_value if isinstance(map_value, dict) else {"map": map_value})
+    recall, precision, f_score = recall_precision_metric.compute()
+    result.update({"iou": iou_metric.compute().item(), "recall": recall.item(), "precision": precision.item(),
+                   "f_score": f_score.item()})
+    return result
+
+
+def sweep_detection_results(root_dir: str, n_classes: int, score_thresholds: List[float],
+                            nms_iou_thresholds: List[float] = None, max_detections_list: List[int] = None,
+                            iou_thresholds: List[float] = None, n_workers: int = None) -> List[dict]:
+    """
+    Evaluate every combination of post processing parameters from stored raw detections.
+    :param root_dir: Directory of DetectionResultWriter.
+    :param n_classes:
+    :param score_thresholds:
+    :param nms_iou_thresholds: Default is [0.5] (same as EfficientDet)
+    :param max_detections_list: Default is [50] (same as EfficientDetector)
+    :param iou_thresholds: see MeanAveragePrecision.
+    :param n_workers: Number of worker processes. If 0, evaluate in this process. Default is CPU count.
+    :return: dict of parameters and metrics (map, iou, recall, precision, f_score) by combination.
+    """
+    nms_iou_thresholds = nms_iou_thresholds or [0.5]
+    max_detections_list = max_detections_list or [50]
+    settings = [(root_dir, n_classes, iou_thresholds, score_threshold, nms_iou_threshold, max_detections)
+                for score_threshold, nms_iou_threshold, max_detections in
+                itertools.product(score_thresholds, nms_iou_thresholds, max_detections_list)]
+    if n_workers == 0:
+        return [_evaluate_setting(setting) for setting in settings]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as executor:
+        return list(executor.map(_evaluate_setting, settings))
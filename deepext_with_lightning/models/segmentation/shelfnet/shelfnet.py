@@ -44,7 +44,7 @@ class ShelfNet(SegmentationModel):
         self._aux_weight = aux_weight
 
     def forward(self, x):
-        return self._model(x)
+        return self._model(self.input_normalization(x))
 
     def predict_index_image(self, img: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         with torch.no_grad():
@@ -56,7 +56,8 @@ class ShelfNet(SegmentationModel):
     def training_step(self, batch, batch_idx):
         self._model.train()
         inputs, targets = batch
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).float()
+        inputs, _, targets = self.augment_batch(try_cuda(inputs), masks=try_cuda(targets))
+        targets = self.prepare_teacher(targets)
         pred, pred_b, pred_c = self(inputs)[:3]
         loss_a = self._loss_func(pred, targets)
         loss_b = self._loss_func(pred_b, targets)
@@ -64,7 +65,7 @@ class ShelfNet(SegmentationModel):
         loss = loss_a + loss_b * self._aux_weight + loss_c * self._aux_weight
         self.log('train_loss', loss)
         pred_labels = self.result_to_index_image(pred)
-        targets = self.result_to_index_image(targets)
+        targets = self.teacher_to_index_image(targets)
         return {'loss': loss, 'preds': pred_labels, 'target': targets}
 
     def training_step_end(self, outputs) -> None:
@@ -80,10 +81,10 @@ class ShelfNet(SegmentationModel):
     def validation_step(self, batch, batch_idx):
         self._model.eval()
         inputs, targets = batch
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).float()
+        inputs, targets = try_cuda(inputs), try_cuda(targets)
         pred_prob = self(inputs)[0]
         pred_labels = self.result_to_index_image(pred_prob)
-        targets = self.result_to_index_image(targets)
+        targets = self.teacher_to_index_image(targets)
         self._val_iou(pred_labels, targets)
 
     def on_validation_epoch_end(self) -> None:
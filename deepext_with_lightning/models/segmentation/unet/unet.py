@@ -29,7 +29,7 @@ class UNet(SegmentationModel):
         self._lr = lr
 
     def forward(self, x: torch.Tensor):
-        return self._model(x)
+        return self._model(self.input_normalization(x))
 
     def predict_index_image(self, img: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         with torch.no_grad():
@@ -41,12 +41,13 @@ class UNet(SegmentationModel):
     def training_step(self, batch, batch_idx):
         self._model.train()
         inputs, targets = batch
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).float()
+        inputs, _, targets = self.augment_batch(try_cuda(inputs), masks=try_cuda(targets))
+        targets = self.prepare_teacher(targets)
         pred = self(inputs)
         loss = self._loss_func(pred, targets)
         self.log('train_loss', loss)
         pred_labels = self.result_to_index_image(pred)
-        targets = self.result_to_index_image(targets)
+        targets = self.teacher_to_index_image(targets)
         return {'loss': loss, 'preds': pred_labels, 'target': targets}
 
     def training_step_end(self, outputs) -> None:
@@ -62,10 +63,10 @@ class UNet(SegmentationModel):
     def validation_step(self, batch, batch_idx):
         self._model.eval()
         inputs, targets = batch
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).float()
+        inputs, targets = try_cuda(inputs), try_cuda(targets)
         pred_prob = self(inputs)
         pred_labels = self.result_to_index_image(pred_prob)
-        targets = self.result_to_index_image(targets)
+        targets = self.teacher_to_index_image(targets)
         self._val_iou(pred_labels, targets)
 
     def on_validation_epoch_end(self) -> None:
@@ -100,7 +101,7 @@ class ResUNet(SegmentationModel):
         self._lr = lr
 
     def forward(self, x: torch.Tensor):
-        return self._model(x)
+        return self._model(self.input_normalization(x))
 
     def predict_index_image(self, img: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         self._model.eval()
@@ -111,12 +112,13 @@ class ResUNet(SegmentationModel):
     def training_step(self, batch, batch_idx):
         self._model.train()
         inputs, targets = batch
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).float()
+        inputs, _, targets = self.augment_batch(try_cuda(inputs), masks=try_cuda(targets))
+        targets = self.prepare_teacher(targets)
         pred = self(inputs)
         loss = self._loss_func(pred, targets)
         self.log('train_loss', loss)
         pred_labels = self.result_to_index_image(pred)
-        targets = self.result_to_index_image(targets)
+        targets = self.teacher_to_index_image(targets)
         return {'loss': loss, 'preds': pred_labels, 'target': targets}
 
     def training_step_end(self, outputs) -> None:
@@ -132,10 +134,10 @@ class ResUNet(SegmentationModel):
     def validation_step(self, batch, batch_idx):
         self._model.eval()
         inputs, targets = batch
-        inputs, targets = try_cuda(inputs).float(), try_cuda(targets).float()
+        inputs, targets = try_cuda(inputs), try_cuda(targets)
         pred_prob = self(inputs)
         pred_labels = self.result_to_index_image(pred_prob)
-        targets = self.result_to_index_image(targets)
+        targets = self.teacher_to_index_image(targets)
         self._val_iou(pred_labels, targets)
 
     def on_validation_epoch_end(self) -> None:
@@ -2,3 +2,4 @@ from .common import *
 from .segmentation import *
 from .detection import *
 from .classification import *
+from .batch import *
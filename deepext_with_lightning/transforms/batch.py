@@ -0,0 +1,190 @@
+from typing import List, Tuple, Optional
+
+import torch
+import torch.nn.functional as F
+
+__all__ = ["BatchAugmentationCompose", "BatchRandomHorizontalFlip", "BatchRandomVerticalFlip", "BatchColorJitter",
+           "BatchRandomResizedCrop", "BatchNormalize"]
+
+# images (Batch size, channels, height, width), bboxes (Batch size, max bboxes, 5), masks (Batch size, (classes,) h, w)
+T_BATCH = Tuple[torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]
+
+
+def _to_float(images: torch.Tensor) -> torch.Tensor:
+    """
+    uint8 (0~255) to float32 (0~1). Float images are regarded as already scaled.
+    """
+    if images.is_floating_point():
+        return images
+    return images.float() / 255.
+
+
+def _random_mask(batch_size: int, p: float, device: torch.device) -> torch.Tensor:
+    return torch.rand(batch_size, device=device) < p
+
+
+def _random_uniform(batch_size: int, value_range: Tuple[float, float], device: torch.device) -> torch.Tensor:
+    return torch.empty(batch_size, device=device).uniform_(value_range[0], value_range[1])
+
+
+def _valid_bboxes_mask(bboxes: torch.Tensor) -> torch.Tensor:
+    # Padding of AdjustDetectionTensorCollator has negative label.
+    return bboxes[:, :, 4] >= 0
+
+
+class BatchAugmentationCompose:
+    """
+    Augmentation of collated batch. Run on device of batch in main process, so workers only decode and resize images.
+    Images are uint8 (0~255) or float (0~1), result images are float32.
+    Bounding boxes are padded tensor of AdjustDetectionTensorCollator (pascal_voc format),
+    masks are one-hot (Batch size, classes, height, width) or index (Batch size, height, width).
+    (e.g. BatchAugmentationCompose([BatchRandomHorizontalFlip(), BatchColorJitter(), BatchNormalize(mean, std)]))
+    """
+
+    def __init__(self, augmentations: List):
+        self._augmentations = augmentations
+
+    def __call__(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) -> T_BATCH:
+        for augmentation in self._augmentations:
+            images, bboxes, masks = augmentation(images, bboxes, masks)
+        return _to_float(images), bboxes, masks
+
+
+class BatchRandomHorizontalFlip:
+    def __init__(self, p=0.5):
+        self._p = p
+
+    def __call__(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) -> T_BATCH:
+        is_flip = _random_mask(images.shape[0], self._p, images.device)
+        images = torch.where(is_flip[:, None, None, None], images.flip(-1), images)
+        if masks is not None:
+            masks = torch.where(is_flip.view([-1] + [1] * (masks.ndim - 1)), masks.flip(-1), masks)
+        if bboxes is not None:
+            flipped = bboxes.clone()
+            flipped[:, :, 0], flipped[:, :, 2] = images.shape[-1] - bboxes[:, :, 2], images.shape[-1] - bboxes[:, :, 0]
+            bboxes = torch.where((is_flip[:, None] & _valid_bboxes_mask(bboxes))[:, :, None], flipped, bboxes)
+        return images, bboxes, masks
+
+
+class BatchRandomVerticalFlip:
+    def __init__(self, p=0.5):
+        self._p = p
+
+    def __call__(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) -> T_BATCH:
+        is_flip = _random_mask(images.shape[0], self._p, images.device)
+        images = torch.where(is_flip[:, None, None, None], images.flip(-2), images)
+        if masks is not None:
+            masks = torch.where(is_flip.view([-1] + [1] * (masks.ndim - 1)), masks.flip(-2), masks)
+        if bboxes is not None:
+            flipped = bboxes.clone()
+            flipped[:, :, 1], flipped[:, :, 3] = images.shape[-2] - bboxes[:, :, 3], images.shape[-2] - bboxes[:, :, 1]
+            bboxes = torch.where((is_flip[:, None] & _valid_bboxes_mask(bboxes))[:, :, None], flipped, bboxes)
+        return images, bboxes, masks
+
+
+class BatchColorJitter:
+    """
+    Random brightness, contrast and gamma by image.
+    """
+
+    def __init__(self, brightness: Tuple[float, float] = (0.8, 1.2), contrast: Tuple[float, float] = (0.8, 1.2),
+                 gamma: Tuple[float, float] = (0.8, 1.2), p=0.5):
+        """
+        :param brightness: Range of brightness factor.
+        :param contrast: Range of contrast factor.
+        :param gamma: Range of gamma.
+        :param p: Probability of each adjustment.
+        """
+        self._brightness = brightness
+        self._contrast = contrast
+        self._gamma = gamma
+        self._p = p
+
+    def __call__(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) -> T_BATCH:
+        images = _to_float(images)
+        batch_size, device = images.shape[0], images.device
+        brightness, contrast, gamma = [
+            torch.where(_random_mask(batch_size, self._p, device), _random_uniform(batch_size, value_range, device),
+                        torch.ones(batch_size, device=device)).view(-1, 1, 1, 1).to(images.dtype)
+            for value_range in [self._brightness, self._contrast, self._gamma]]
+        images = images * brightness
+        gray_mean = images.mean(dim=(1, 2, 3), keepdim=True)
+        images = ((images - gray_mean) * contrast + gray_mean).clamp(0., 1.)
+        return images ** gamma, bboxes, masks
+
+
+class BatchRandomResizedCrop:
+    """
+    Crop random area of each image and resize to (height, width) at once by grid_sample.
+    Bounding boxes outside of crop are replaced with padding (-1).
+    """
+
+    def __init__(self, height: int, width: int, scale: Tuple[float, float] = (0.08, 1.),
+                 ratio: Tuple[float, float] = (3 / 4, 4 / 3), min_bbox_size: float = 1.):
+        """
+        :param height: Result height.
+        :param width: Result width.
+        :param scale: Range of crop area rate.
+        :param ratio: Range of crop aspect ratio (width / height).
+        :param min_bbox_size: Bounding boxes smaller than this after crop are removed.
+        """
+        self._height, self._width = height, width
+        self._scale = scale
+        self._log_ratio = (torch.log(torch.tensor(ratio[0])).item(), torch.log(torch.tensor(ratio[1])).item())
+        self._min_bbox_size = min_bbox_size
+
+    def __call__(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) -> T_BATCH:
+        batch_size, device = images.shape[0], images.device
+        image_height, image_width = images.shape[-2:]
+        areas = _random_uniform(batch_size, self._scale, device) * image_height * image_width
+        ratios = torch.exp(_random_uniform(batch_size, self._log_ratio, device))
+        crop_widths = torch.sqrt(areas * ratios).clamp(1., image_width)
+        crop_heights = torch.sqrt(areas / ratios).clamp(1., image_height)
+        crop_x = torch.rand(batch_size, device=device) * (image_width - crop_widths)
+        crop_y = torch.rand(batch_size, device=device) * (image_height - crop_heights)
+
+        # Output coordinates (-1~1) to input coordinates (-1~1) of each image.
+        theta = torch.zeros([batch_size, 2, 3], device=device)
+        theta[:, 0, 0] = crop_widths / image_width
+        theta[:, 0, 2] = (2 * crop_x + crop_widths) / image_width - 1
+        theta[:, 1, 1] = crop_heights / image_height
+        theta[:, 1, 2] = (2 * crop_y + crop_heights) / image_height - 1
+        grid = F.affine_grid(theta, [batch_size, 1, self._height, self._width], align_corners=False)
+        result_images = F.grid_sample(_to_float(images), grid, mode="bilinear", align_corners=False)
+        if not images.is_floating_point():
+            result_images = (result_images * 255.).round().to(images.dtype)
+
+        if masks is not None:
+            mask_4d = masks if masks.ndim == 4 else masks.unsqueeze(1)
+            result_masks = F.grid_sample(mask_4d.float(), grid, mode="nearest", align_corners=False).to(masks.dtype)
+            masks = result_masks if masks.ndim == 4 else result_masks.squeeze(1)
+
+        if bboxes is not None:
+            offsets = torch.stack([crop_x, crop_y, crop_x, crop_y], dim=1)[:, None, :]
+            scales = torch.stack([self._width / crop_widths, self._height / crop_heights] * 2, dim=1)[:, None, :]
+            coords = (bboxes[:, :, :4] - offsets) * scales
+            coords[:, :, 0::2] = coords[:, :, 0::2].clamp(0, self._width)
+            coords[:, :, 1::2] = coords[:, :, 1::2].clamp(0, self._height)
+            is_valid = _valid_bboxes_mask(bboxes) & (coords[:, :, 2] - coords[:, :, 0] >= self._min_bbox_size) & \
+                       (coords[:, :, 3] - coords[:, :, 1] >= self._min_bbox_size)
+            bboxes = torch.where(is_valid[:, :, None], torch.cat([coords, bboxes[:, :, 4:]], dim=2),
+                                 torch.full_like(bboxes, -1))
+        return result_images, bboxes, masks
+
+
+class BatchNormalize:
+    """
+    Scale to 0~1 and normalize by channel.
+    """
+
+    def __init__(self, mean: Tuple[float, ...] = None, std: Tuple[float, ...] = None):
+        """
+        :param mean: Mean by channel of 0~1 images. Channel order is same as images. (BGR for pil_to_cv)
+        :param std: Standard deviation by channel of 0~1 images.
+        """
+        self._mean = torch.tensor(mean if mean is not None else [0.]).view(1, -1, 1, 1)
+        self._std = torch.tensor(std if std is not None else [1.]).view(1, -1, 1, 1)
+
+    def __call__(self, images: torch.Tensor, bboxes: torch.Tensor = None, masks: torch.Tensor = None) -> T_BATCH:
+        images = _to_float(images)
+        return (images - self._mean.to(images.device)) / self._std.to(images.device), bboxes, masks
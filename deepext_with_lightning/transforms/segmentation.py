@@ -9,10 +9,20 @@ from ..transforms import ImageToOneHot
 
 class AlbumentationsSegmentationWrapperTransform:
     def __init__(self, albumentations_transforms: A.Compose, class_num: int, is_image_normalize=True,
-                 require_onehot=True, ignore_indices: List[int] = None):
+                 require_onehot=True, ignore_indices: List[int] = None, ignore_index: int = None):
+        """
+        :param albumentations_transforms:
+        :param class_num:
+        :param is_image_normalize: If False, image stays uint8 and is scaled by InputNormalization of model.
+        :param require_onehot: If False, teacher is index mask (height, width) tensor of original dtype (e.g. uint8).
+        :param ignore_indices: Pixels of these values are replaced with ignore_index.
+        :param ignore_index: Default is 0 (background). For index mask, value out of classes (e.g. 255) is ignored by
+        losses and metrics.
+        """
         self._albumentations_transforms = albumentations_transforms
         self._require_onehot = require_onehot
-        self._to_onehot = ImageToOneHot(class_num)
+        self._ignore_index = ignore_index if ignore_index is not None else 0
+        self._to_onehot = ImageToOneHot(class_num, ignore_index=ignore_index)
         self._is_image_normalize = is_image_normalize
         self._ignore_indices = ignore_indices
 
@@ -21,14 +31,17 @@ class AlbumentationsSegmentationWrapperTransform:
             image = pil_to_cv(image)
         if isinstance(teacher, Image.Image):
             teacher = np.array(teacher)
-        for ignore_index in self._ignore_indices:
-            teacher[teacher == ignore_index] = 0
+        if self._ignore_indices:
+            # Not in place, teacher may be read-only view. (e.g. PackedImageDataset)
+            teacher = np.where(np.isin(teacher, self._ignore_indices), self._ignore_index, teacher) \
+                .astype(teacher.dtype)
 
         result_dict = self._albumentations_transforms(image=image, mask=teacher)
         image, teacher = result_dict["image"], result_dict["mask"]
-        if teacher.ndim == 2:
-            teacher = teacher.expand([1, ] + list(teacher.shape))
+        # Index mask keeps (height, width) and small dtype to reduce transfer from workers.
         if self._require_onehot:
+            if teacher.ndim == 2:
+                teacher = teacher.expand([1, ] + list(teacher.shape))
             teacher = self._to_onehot(teacher)
         if self._is_image_normalize:
             image = image.float() / 255.
@@ -0,0 +1,59 @@
+import argparse
+
+import torchvision
+
+from deepext_with_lightning.dataset import CSVAnnotationDataset, VOCDataset, IndexImageDataset, \
+    VOCAnnotationTransform, pack_dataset
+from deepext_with_lightning.dataset.functions import create_label_list_and_dict, label_names_to_dict
+
+from common import DETECTION_DATASET_INFO
+
+VALID_DATASET_KEYS = ["csv", "voc", "index_image", "voc2007", "voc2012", "voc2007_segmentation",
+                      "voc2012_segmentation"]
+
+
+def build_dataset(args):
+    """
+    :return: dataset, target type, target transform
+    """
+    label_dict = create_label_list_and_dict(args.label_file_path)[1] if args.label_file_path else None
+    if args.dataset == "csv":
+        return CSVAnnotationDataset.create(args.images_dir, args.annotation_path, transforms=None,
+                                           label_dict=label_dict), "label", None
+    if args.dataset == "voc":
+        return VOCDataset.create(args.images_dir, args.annotation_path, transforms=None,
+                                 class_index_dict=label_dict), "bboxes", None
+    if args.dataset == "index_image":
+        return IndexImageDataset.create(args.images_dir, args.annotation_path, transforms=None), "mask", None
+    if args.dataset in ["voc2007", "voc2012"]:
+        class_index_dict = label_names_to_dict(DETECTION_DATASET_INFO[args.dataset]["label_names"])
+        dataset = torchvision.datasets.VOCDetection(root=args.dataset_root, download=True, year=args.dataset[3:],
+                                                    image_set=args.image_set)
+        return dataset, "bboxes", VOCAnnotationTransform(class_index_dict)
+    if args.dataset in ["voc2007_segmentation", "voc2012_segmentation"]:
+        dataset = torchvision.datasets.VOCSegmentation(root=args.dataset_root, download=True, year=args.dataset[3:7],
+                                                       image_set=args.image_set)
+        return dataset, "mask", None
+    raise RuntimeError(f"Invalid dataset name: {args.dataset}")
+
+
+parser = argparse.ArgumentParser(description='Decode and resize dataset once into memory mapped file.')
+
+parser.add_argument('--dataset', type=str, required=True, help=f'Dataset type in {VALID_DATASET_KEYS}')
+parser.add_argument('--out_dir', type=str, required=True, help='Output directory')
+parser.add_argument('--width', type=int, required=True, help='Image width after resize')
+parser.add_argument('--height', type=int, required=True, help='Image height after resize')
+parser.add_argument('--images_dir', type=str, default=None, help='Image directory (csv, voc, index_image)')
+parser.add_argument('--annotation_path', type=str, default=None,
+                    help='CSV file path or annotation directory (csv, voc, index_image)')
+parser.add_argument('--label_file_path', type=str, default=None, help='Label names file (csv, voc)')
+parser.add_argument('--dataset_root', type=str, default=None, help='torchvision dataset folder path (voc20XX)')
+parser.add_argument('--image_set', type=str, default="train", help='torchvision VOC image set (voc20XX)')
+parser.add_argument('--n_workers', type=int, default=4, help='Number of decode workers')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    dataset, target_type, target_transform = build_dataset(args)
+    pack_dataset(dataset, args.out_dir, image_size=(args.height, args.width), target_type=target_type,
+                 target_transform=target_transform, n_workers=args.n_workers)
+    print(f"Packed {len(dataset)} samples to {args.out_dir}")
@@ -1,7 +1,9 @@
 import numpy as np
 from collections import OrderedDict
 
-from deepext_with_lightning.dataset import DatasetSplitter
+from torch.utils.data import DataLoader
+
+from deepext_with_lightning.dataset import DatasetSplitter, classification
 from deepext_with_lightning.dataset.classification import CSVAnnotationDataset
 
 n_classes = 3
@@ -123,3 +125,40 @@ def test_split_with_under_sampling():
     assert root_dist[0] - 1 <= total_dist[0] <= root_dist[0] + 1
     assert root_dist[1] - 1 <= total_dist[1] <= root_dist[1] + 1
     assert root_dist[2] - 1 <= total_dist[2] <= root_dist[2] + 1
+
+
+def test_load_annotation_arrays(tmp_path):
+    annotation_path = tmp_path / "annotation.csv"
+    annotation_path.write_text("dir/a.jpg,0\nb.jpg,label2\nc.jpg,unknown\na.jpg,1\nd.jpg,2\n")
+    filenames, labels = CSVAnnotationDataset._load_annotation_arrays(str(annotation_path), {"label2": 2},
+                                                                      chunk_size=2)
+    # Same as dict: duplicated filename keeps first position and last label.
+    assert filenames.tolist() == ["a.jpg", "b.jpg", "d.jpg"]
+    assert labels.tolist() == [1, 2, 2]
+
+
+def test_split_dataset_keeps_order():
+    split_dataset = dummy_dataset.split_dataset(np.array([11, 1, 3, 3]))
+    assert len(split_dataset) == 3
+    assert [split_dataset._filenames[i] for i in range(3)] == ["test0-2", "test1-2", "test2-2"]
+
+
+def test_under_sampling_by_epoch(monkeypatch):
+    # Image is replaced with file path.
+    monkeypatch.setattr(classification, "open_image", lambda file_path, **kwargs: file_path)
+    under_sampling_dataset = dummy_dataset.apply_under_sampling([1, 0.5, 1.], seed=0)
+    assert under_sampling_dataset.labels_distribution() == [2, 4, 4]
+    # Persistent workers see epoch set in main process.
+    data_loader = DataLoader(under_sampling_dataset, batch_size=4, num_workers=2, persistent_workers=True,
+                             sampler=under_sampling_dataset.create_sampler(), collate_fn=lambda batch: batch)
+    filepaths_by_epoch = []
+    for epoch in range(3):
+        # Same as Lightning at start of each epoch.
+        data_loader.sampler.set_epoch(epoch)
+        batch_items = [item for batch in data_loader for item in batch]
+        assert np.bincount([label for _, label in batch_items]).tolist() == [2, 4, 4]
+        filepaths_by_epoch.append(sorted([filepath for filepath, _ in batch_items]))
+    assert filepaths_by_epoch[0] != filepaths_by_epoch[1] and filepaths_by_epoch[1] != filepaths_by_epoch[2]
+    data_loader.sampler.set_epoch(0)
+    assert sorted([filepath for batch in data_loader for filepath, _ in batch]) == filepaths_by_epoch[0]
+
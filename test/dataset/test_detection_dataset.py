@@ -1,4 +1,7 @@
-from deepext_with_lightning.dataset.detection import VOCDataset
+import numpy as np
+import torch
+
+from deepext_with_lightning.dataset.detection import VOCDataset, AdjustDetectionTensorCollator
 
 
 def test_reading_file():
@@ -26,3 +29,15 @@ def test_reading_file_with_invalid_suffix():
     dataset = VOCDataset.create(images_path, annotations_path, transforms=None, class_index_dict=class_index_dict,
                                 valid_suffixes=["*.png"])
     assert len(dataset) == 0
+
+
+def test_collator():
+    batch = [(torch.zeros(3, 4, 4), [[1, 2, 3, 4, 0]]), (torch.zeros(3, 4, 4), []),
+             (torch.zeros(3, 4, 4), np.array([[1, 2, 3, 4, 1], [5, 6, 7, 8, 2]]))]
+    images, bboxes, counts = AdjustDetectionTensorCollator(return_counts=True)(batch)
+    assert images.shape == (3, 3, 4, 4)
+    assert bboxes.dtype == torch.float32 and bboxes.shape == (3, 2, 5)
+    assert counts.tolist() == [1, 0, 2]
+    assert bboxes[0].tolist() == [[1, 2, 3, 4, 0], [-1, -1, -1, -1, -1]]
+    assert bboxes[1].tolist() == [[-1] * 5] * 2
+    assert bboxes[2].tolist() == [[1, 2, 3, 4, 1], [5, 6, 7, 8, 2]]
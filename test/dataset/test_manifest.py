@@ -0,0 +1,91 @@
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from deepext_with_lightning.dataset.common import create_filepath_ls
+from deepext_with_lightning.dataset.manifest import build_manifest, ImageManifest
+
+
+def _create_image_tree(root_dir: str):
+    for dir_name in ["a", "b", os.path.join("b", "c")]:
+        os.makedirs(os.path.join(root_dir, dir_name))
+    for i, relative_path in enumerate(["0.png", "a/1.png", "a/2.jpg", "b/c/3.png"]):
+        Image.new("RGB", (10 + i, 20 + i)).save(os.path.join(root_dir, relative_path))
+    with open(os.path.join(root_dir, "b", "broken.png"), "wb") as file:
+        file.write(b"not image")
+    with open(os.path.join(root_dir, "a", "note.txt"), "w") as file:
+        file.write("not target")
+
+
+def test_build_manifest(tmp_path):
+    root_dir = str(tmp_path.joinpath("images"))
+    _create_image_tree(root_dir)
+    manifest_path = str(tmp_path.joinpath("manifest.npz"))
+    manifest = build_manifest(root_dir, manifest_path, n_workers=4)
+    assert [os.path.relpath(file_path, root_dir) for file_path in manifest.file_paths()] == \
+           ["0.png", "a/1.png", "a/2.jpg", "b/c/3.png"]
+    assert [os.path.relpath(file_path, root_dir) for file_path in manifest.invalid_file_paths()] == ["b/broken.png"]
+    assert manifest.image_sizes[manifest.is_valid].tolist() == [[10, 20], [11, 21], [12, 22], [13, 23]]
+    assert manifest.scan_stats == {"scanned_dirs": 4, "reused_dirs": 0, "probed_files": 5}
+
+    loaded_manifest = ImageManifest.load(manifest_path)
+    assert loaded_manifest.file_paths() == manifest.file_paths()
+    assert np.array_equal(loaded_manifest.image_sizes, manifest.image_sizes)
+
+
+def test_rescan_changed_directories(tmp_path):
+    root_dir = str(tmp_path.joinpath("images"))
+    _create_image_tree(root_dir)
+    manifest_path = str(tmp_path.joinpath("manifest.npz"))
+    build_manifest(root_dir, manifest_path)
+
+    manifest = build_manifest(root_dir, manifest_path)
+    assert manifest.scan_stats == {"scanned_dirs": 0, "reused_dirs": 4, "probed_files": 0}
+    assert len(manifest.file_paths()) == 4
+
+    # Add file to a and remove directory c.
+    Image.new("RGB", (30, 40)).save(os.path.join(root_dir, "a", "5.png"))
+    shutil.rmtree(os.path.join(root_dir, "b", "c"))
+    stat = os.stat(os.path.join(root_dir, "a"))
+    os.utime(os.path.join(root_dir, "a"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    stat = os.stat(os.path.join(root_dir, "b"))
+    os.utime(os.path.join(root_dir, "b"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    manifest = build_manifest(root_dir, manifest_path)
+    # Only new file is opened.
+    assert manifest.scan_stats == {"scanned_dirs": 2, "reused_dirs": 1, "probed_files": 1}
+    assert [os.path.relpath(file_path, root_dir) for file_path in manifest.file_paths()] == \
+           ["0.png", "a/1.png", "a/2.jpg", "a/5.png"]
+
+
+def test_create_filepath_ls_with_manifest(tmp_path):
+    manifest_path = str(tmp_path.joinpath("manifest.npz"))
+    image_dir = "test/dataset/test_images"
+    expected = [file_path.name for file_path in create_filepath_ls(image_dir)]
+    assert [file_path.name for file_path in create_filepath_ls(image_dir, manifest_path=manifest_path)] == expected
+    assert create_filepath_ls(image_dir, valid_suffixes=["*.png"], manifest_path=manifest_path) == []
+
+
+def test_rescan_when_recursive_changed(tmp_path):
+    root_dir = str(tmp_path.joinpath("images"))
+    _create_image_tree(root_dir)
+    manifest_path = str(tmp_path.joinpath("manifest.npz"))
+    # e.g. create_filepath_ls writes non-recursive manifest.
+    manifest = build_manifest(root_dir, manifest_path, recursive=False)
+    assert [os.path.relpath(file_path, root_dir) for file_path in manifest.file_paths()] == ["0.png"]
+
+    manifest = build_manifest(root_dir, manifest_path, recursive=True)
+    assert manifest.scan_stats["reused_dirs"] == 0
+    assert [os.path.relpath(file_path, root_dir) for file_path in manifest.file_paths()] == \
+           ["0.png", "a/1.png", "a/2.jpg", "b/c/3.png"]
+    manifest = build_manifest(root_dir, manifest_path, recursive=False)
+    assert manifest.scan_stats["reused_dirs"] == 0
+    assert [os.path.relpath(file_path, root_dir) for file_path in manifest.file_paths()] == ["0.png"]
+    assert build_manifest(root_dir, manifest_path, recursive=False).scan_stats["reused_dirs"] == 1
+
+    # Manifest saved before recursive was stored is not reused.
+    with np.load(manifest_path) as data:
+        np.savez(manifest_path, **{key: data[key] for key in data.files if key != "recursive"})
+    assert ImageManifest.load(manifest_path).recursive is None
+    assert build_manifest(root_dir, manifest_path, recursive=False).scan_stats["reused_dirs"] == 0
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from deepext_with_lightning.dataset.cache import SharedImageCache
+from deepext_with_lightning.dataset.common import open_image, ImageOnlyDataset
+from deepext_with_lightning.dataset.classification import CSVAnnotationDataset
+
+
+def _save_dummy_image(file_path: str, width: int = 800, height: int = 600):
+    Image.fromarray(np.random.RandomState(0).randint(0, 256, [height, width, 3], dtype=np.uint8)).save(file_path)
+
+
+def test_reduced_decode(tmp_path):
+    _save_dummy_image(str(tmp_path.joinpath("a.jpg")))
+    _save_dummy_image(str(tmp_path.joinpath("b.png")))
+    # 1/4 scale is smallest scale not less than decode size.
+    assert open_image(str(tmp_path.joinpath("a.jpg")), decode_size=(100, 100)).size == (200, 150)
+    assert open_image(str(tmp_path.joinpath("a.jpg")), decode_size=(100, 75)).size == (100, 75)
+    assert open_image(str(tmp_path.joinpath("a.jpg")), decode_size=(100, 80)).size == (200, 150)
+    assert open_image(str(tmp_path.joinpath("a.jpg"))).size == (800, 600)
+    # Not JPEG
+    assert open_image(str(tmp_path.joinpath("b.png")), decode_size=(100, 100)).size == (800, 600)
+
+
+def test_dataset_decode_size(tmp_path):
+    _save_dummy_image(str(tmp_path.joinpath("a.jpg")))
+    dataset = CSVAnnotationDataset.from_arrays(str(tmp_path), np.array(["a.jpg"]), np.array([1]), transforms=None,
+                                               decode_size=(300, 300))
+    assert dataset[0][0].size == (400, 300)
+    assert dataset.split_dataset(np.array([0]))[0][0].size == (400, 300)
+
+    image_only_dataset = ImageOnlyDataset(str(tmp_path), image_transform=None, decode_size=(300, 300))
+    assert image_only_dataset[0].size == (400, 300)
+    # Original size for restoring prediction.
+    assert image_only_dataset.current_image_size() == (800, 600)
+
+
+def test_original_size_with_cache(tmp_path, monkeypatch):
+    _save_dummy_image(str(tmp_path.joinpath("a.jpg")))
+    with SharedImageCache(16 * 1024 * 1024) as cache:
+        dataset = ImageOnlyDataset(str(tmp_path), image_transform=None, cache=cache, decode_size=(300, 300))
+        assert dataset[0].size == (400, 300)
+        assert dataset.current_image_size() == (800, 600)
+        # File is not opened on cache hit.
+        monkeypatch.setattr(Image, "open", lambda *args, **kwargs: pytest.fail("Image.open is called."))
+        assert dataset[0].size == (400, 300)
+        assert dataset.current_image_size() == (800, 600)
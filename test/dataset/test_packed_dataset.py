@@ -0,0 +1,49 @@
+import numpy as np
+from PIL import Image
+
+from deepext_with_lightning.dataset.detection import VOCDataset
+from deepext_with_lightning.dataset.segmentation import IndexImageDataset
+from deepext_with_lightning.dataset.packed import pack_dataset, PackedImageDataset
+
+images_path = "test/dataset/test_images"
+
+
+def test_pack_bboxes(tmp_path):
+    class_index_dict = {"aeroplane": 0, "dog": 1, "chair": 2}
+    dataset = VOCDataset.create(images_path, "test/dataset/test_bboxes", transforms=None,
+                                class_index_dict=class_index_dict)
+    pack_dataset(dataset, str(tmp_path), image_size=(64, 96), target_type="bboxes")
+    packed_dataset = PackedImageDataset(str(tmp_path))
+    assert len(packed_dataset) == len(dataset)
+    for i in range(len(dataset)):
+        original_image, original_bboxes = dataset[i]
+        image, bboxes = packed_dataset[i]
+        width, height = original_image.size
+        assert image.shape == (64, 96, 3) and image.dtype == np.uint8
+        assert tuple(packed_dataset.original_image_sizes[i]) == (width, height)
+        expected = np.array(original_bboxes, dtype=np.float32)
+        expected[:, [0, 2]] *= 96 / width
+        expected[:, [1, 3]] *= 64 / height
+        assert np.allclose(bboxes, expected)
+
+
+def test_pack_mask(tmp_path):
+    dataset = IndexImageDataset.create(images_path, "test/dataset/test_masks", transforms=None)
+    pack_dataset(dataset, str(tmp_path), image_size=(32, 32), target_type="mask")
+    packed_dataset = PackedImageDataset(str(tmp_path))
+    image, mask = packed_dataset[1]
+    assert image.shape == (32, 32, 3) and mask.shape == (32, 32)
+    # Nearest resize keeps index values.
+    assert set(np.unique(mask)) <= set(np.unique(np.array(dataset[1][1])))
+    # Zero copy view of memory map.
+    assert isinstance(image.base, np.memmap) or isinstance(image, np.memmap)
+    assert not image.flags.writeable
+
+
+def test_pack_labels_with_transforms(tmp_path):
+    dataset = [(Image.new("RGB", (20, 10), color=(i, 0, 0)), i) for i in range(3)]
+    pack_dataset(dataset, str(tmp_path), image_size=(5, 10), target_type="label")
+    packed_dataset = PackedImageDataset(str(tmp_path), transforms=lambda image, label: (image[..., 2].mean(), label))
+    assert packed_dataset.labels.tolist() == [0, 1, 2]
+    # BGR like pil_to_cv.
+    assert [packed_dataset[i] for i in range(3)] == [(0., 0), (1., 1), (2., 2)]
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from deepext_with_lightning.dataset import ClassResamplingSampler, AspectRatioBatchSampler, \
+    BucketTransformsWrapperDataset
+from deepext_with_lightning.dataset.sampler import sample_indices_by_classes
+
+labels = np.array([0] * 2 + [1] * 8 + [2] * 4)
+
+
+def test_sample_indices_by_classes():
+    indices = sample_indices_by_classes(labels, [1, 0.5, 2.5], np.random.default_rng(0))
+    assert np.bincount(labels[indices]).tolist() == [2, 4, 10]
+    # Under sampling does not duplicate samples.
+    assert np.unique(indices[labels[indices] == 1]).shape[0] == 4
+    # Over sampling repeats every sample at least rate // 1 times.
+    assert np.all(np.bincount(indices, minlength=labels.shape[0])[labels == 2] >= 2)
+
+
+def test_sampler_reproducible_by_epoch():
+    sampler = ClassResamplingSampler(labels, [1, 0.5, 1], seed=0)
+    first_epoch = list(sampler)
+    assert len(first_epoch) == len(sampler) == 10
+    assert list(ClassResamplingSampler(labels, [1, 0.5, 1], seed=0)) == first_epoch
+    sampler.set_epoch(1)
+    assert list(sampler) != first_epoch
+
+
+def test_sampler_rank_aware():
+    num_replicas = 3
+    samplers = [ClassResamplingSampler(labels, [1, 0.5, 2], seed=0, num_replicas=num_replicas, rank=rank)
+                for rank in range(num_replicas)]
+    shards = [list(sampler) for sampler in samplers]
+    assert all([len(shard) == len(samplers[0]) == 5 for shard in shards])
+    # Shards are parts of the same epoch indices padded by first indices.
+    all_indices = np.array(shards).T.reshape(-1)
+    expected = sample_indices_by_classes(labels, [1, 0.5, 2], np.random.default_rng([0, 0]))
+    assert all_indices[:expected.shape[0]].tolist() == expected.tolist()
+
+
+def test_aspect_ratio_batch_sampler():
+    # Landscape, portrait and square images.
+    image_sizes = np.array([[400, 200]] * 5 + [[200, 400]] * 3 + [[300, 300]] * 4)
+    sampler = AspectRatioBatchSampler(image_sizes, batch_size=2, base_size=256, seed=0)
+    assert sampler.bucket_shapes.tolist() == [[352, 192], [288, 224], [256, 256], [224, 288], [192, 352]]
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 3 + 2 + 2
+    assert sorted(index for batch in batches for index, _ in batch) == list(range(12))
+    for batch in batches:
+        shapes = set(shape for _, shape in batch)
+        assert len(shapes) == 1
+        height, width = shapes.pop()
+        assert all(np.sign(width - height) == np.sign(image_sizes[index, 0] - image_sizes[index, 1])
+                   for index, _ in batch)
+    assert list(AspectRatioBatchSampler(image_sizes, batch_size=2, base_size=256, seed=0)) == batches
+
+    report = sampler.padding_report()
+    assert report["bucket_padding_ratio"] < report["fixed_padding_ratio"]
+    assert report["saved_pixels_ratio"] > 0
+
+
+def test_aspect_ratio_batch_sampler_rank_aware():
+    image_sizes = np.array([[400, 200]] * 5 + [[200, 400]] * 3)
+    batches_by_rank = [list(AspectRatioBatchSampler(image_sizes, batch_size=2, base_size=256, drop_last=True,
+                                                    num_replicas=2, rank=rank)) for rank in range(2)]
+    assert [len(batches) for batches in batches_by_rank] == [2, 2]
+    indices = [index for batches in batches_by_rank for batch in batches for index, _ in batch]
+    assert len(set(indices)) == 6
+
+
+def test_bucket_transforms_wrapper_dataset():
+    dataset = BucketTransformsWrapperDataset([(np.zeros([2, 2]), 1)] * 3,
+                                             lambda height, width: lambda image, label: ((height, width), label),
+                                             default_shape=(32, 32))
+    assert dataset[(1, (64, 32))] == ((64, 32), 1)
+    assert dataset[2] == ((32, 32), 1)
+    with pytest.raises(ValueError):
+        BucketTransformsWrapperDataset([], lambda height, width: None, default_shape=None)
@@ -0,0 +1,87 @@
+import numpy as np
+from torch.utils.data import DataLoader
+
+from deepext_with_lightning.dataset.cache import SharedImageCache, _NBYTES, _NEXT, _HEAD, _N_ORDERED
+from deepext_with_lightning.dataset.detection import VOCDataset
+from deepext_with_lightning.dataset.segmentation import IndexImageDataset
+
+
+def test_lru_eviction():
+    with SharedImageCache(budget_bytes=256) as cache:
+        arrays = [np.full([8, 8], i, dtype=np.uint8) for i in range(5)]
+        for i in range(4):
+            assert cache.put(i, arrays[i])
+        assert np.array_equal(cache.get(0), arrays[0])
+        # 1 is least recently used.
+        cache.put(4, arrays[4])
+        assert cache.get(1) is None
+        assert [np.array_equal(cache.get(i), arrays[i]) for i in [0, 2, 3, 4]] == [True] * 4
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["evictions"], stats["n_entries"]) == (5, 1, 1, 4)
+        # Larger than budget is not cached.
+        assert not cache.put(5, np.zeros([512], dtype=np.uint8))
+
+
+def test_dtype_and_shape():
+    with SharedImageCache(budget_bytes=1024, max_entries=2) as cache:
+        array = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        cache.put(0, array)
+        cache.put(1, np.ones([3], dtype=np.int64))
+        # Evicted by number of entries.
+        cache.put(2, np.ones([3], dtype=np.int64))
+        assert cache.get(0) is None
+        assert np.array_equal(cache.get(1), np.ones([3], dtype=np.int64))
+
+
+
+def test_random_put_and_get():
+    random_state = np.random.RandomState(0)
+    with SharedImageCache(budget_bytes=4096, max_entries=16) as cache:
+        for _ in range(2000):
+            key = int(random_state.randint(-40, 40)) * 7919
+            if random_state.rand() < 0.5:
+                array = cache.get(key)
+                assert array is None or np.all(array == key % 251)
+            else:
+                assert cache.put(key, np.full([random_state.randint(1, 700)], key % 251, dtype=np.uint8))
+                # Just put array is most recently used and not evicted.
+                assert cache.get(key) is not None
+        # Hash slots, LRU list and offset order have same entries, and arrays do not overlap.
+        rows = np.nonzero(cache._table[:, _NBYTES] > 0)[0]
+        assert sorted(cache._slots[cache._slots > 0] - 1) == sorted(rows)
+        lru_rows, row = [], cache._counters[_HEAD]
+        while row >= 0:
+            lru_rows.append(row)
+            row = cache._table[row, _NEXT]
+        assert sorted(lru_rows) == sorted(rows)
+        n_ordered = cache._counters[_N_ORDERED]
+        assert sorted(cache._order_rows[:n_ordered]) == sorted(rows)
+        assert np.all(cache._order_ends[:n_ordered - 1] <= cache._order_offsets[1:n_ordered])
+        assert cache.stats()["n_entries"] == rows.shape[0] <= 16
+
+def test_shared_by_workers():
+    class_index_dict = {"aeroplane": 0, "dog": 1, "chair": 2}
+    with SharedImageCache(budget_bytes=8 * 1024 * 1024) as cache:
+        dataset = VOCDataset.create("test/dataset/test_images", "test/dataset/test_bboxes", transforms=None,
+                                    class_index_dict=class_index_dict, cache=cache)
+        data_loader = DataLoader(dataset, batch_size=None, num_workers=2, collate_fn=lambda sample: sample)
+        first_images = [np.asarray(image) for image, _ in data_loader]
+        assert cache.stats()["misses"] == 2 and cache.stats()["hits"] == 0
+        cache.reset_stats()
+        second_images = [np.asarray(image) for image, _ in data_loader]
+        assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 0
+        assert all(np.array_equal(a, b) for a, b in zip(first_images, second_images))
+
+
+def test_index_image(tmp_path):
+    with SharedImageCache(budget_bytes=8 * 1024 * 1024) as cache:
+        dataset = IndexImageDataset.create("test/dataset/test_images", "test/dataset/test_masks", transforms=None,
+                                           cache=cache)
+        uncached_dataset = IndexImageDataset.create("test/dataset/test_images", "test/dataset/test_masks",
+                                                    transforms=None)
+        for _ in range(2):
+            image, index_image = dataset[0]
+            expected_image, expected_index_image = uncached_dataset[0]
+            assert np.array_equal(np.array(image), np.array(expected_image))
+            assert np.array_equal(np.array(index_image), np.array(expected_index_image))
+        assert cache.stats()["hits"] == 2
@@ -0,0 +1,88 @@
+import os
+import shutil
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+
+from deepext_with_lightning.dataset.detection import VOCDataset, VOCAnnotationTransform
+from deepext_with_lightning.dataset.voc_index import VOCAnnotationIndex
+
+annotations_path = "test/dataset/test_bboxes"
+class_index_dict = {"aeroplane": 0, "dog": 1, "chair": 2}
+
+
+def _annotation_paths(annotation_dir: str):
+    return sorted([os.path.join(annotation_dir, filename) for filename in os.listdir(annotation_dir)])
+
+
+def test_same_as_xml():
+    annotation_paths = _annotation_paths(annotations_path)
+    index = VOCAnnotationIndex.build(annotation_paths, n_workers=0)
+    assert len(index) == 2
+    for size in [None, (100, 200)]:
+        voc_transform = VOCAnnotationTransform(class_index_dict, size=size)
+        for annotation_path in annotation_paths:
+            expected = voc_transform(ET.parse(annotation_path).getroot())
+            assert np.allclose(voc_transform(index[annotation_path]), expected)
+
+
+def test_lookup_by_path():
+    # Rows are in given order, lookup is by sorted paths.
+    annotation_paths = _annotation_paths(annotations_path)[::-1]
+    index = VOCAnnotationIndex.build(annotation_paths, n_workers=0)
+    for row, annotation_path in enumerate(annotation_paths):
+        assert annotation_path in index
+        assert np.array_equal(index[annotation_path].boxes, index.get_by_row(row).boxes)
+    assert "not_found.xml" not in index
+    with pytest.raises(KeyError):
+        index["not_found.xml"]
+    assert "a.xml" not in VOCAnnotationIndex.empty()
+
+
+def test_cache_invalidated_by_mtime(tmp_path):
+    annotation_dir = str(tmp_path.joinpath("annotations"))
+    shutil.copytree(annotations_path, annotation_dir)
+    annotation_paths = _annotation_paths(annotation_dir)
+    cache_path = str(tmp_path.joinpath("index.npz"))
+    index = VOCAnnotationIndex.build(annotation_paths, cache_path=cache_path, n_workers=2)
+    assert os.path.exists(cache_path)
+
+    # Add object to second file and update mtime.
+    tree = ET.parse(annotation_paths[1])
+    obj = ET.SubElement(tree.getroot(), "object")
+    ET.SubElement(obj, "name").text = "dog"
+    bndbox = ET.SubElement(obj, "bndbox")
+    for point, value in zip(["xmin", "ymin", "xmax", "ymax"], [1, 2, 3, 4]):
+        ET.SubElement(bndbox, point).text = str(value)
+    tree.write(annotation_paths[1])
+    stat = os.stat(annotation_paths[1])
+    os.utime(annotation_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    updated_index = VOCAnnotationIndex.build(annotation_paths, cache_path=cache_path, n_workers=0)
+    assert np.array_equal(updated_index[annotation_paths[0]].boxes, index[annotation_paths[0]].boxes)
+    new_annotation = updated_index[annotation_paths[1]]
+    assert new_annotation.boxes.shape[0] == index[annotation_paths[1]].boxes.shape[0] + 1
+    assert new_annotation.names[-1] == "dog" and new_annotation.boxes[-1].tolist() == [1, 2, 3, 4]
+    assert VOCAnnotationIndex.load(cache_path)[annotation_paths[1]].boxes.shape == new_annotation.boxes.shape
+
+
+def test_cache_reordered(tmp_path):
+    annotation_paths = _annotation_paths(annotations_path)
+    cache_path = str(tmp_path.joinpath("index.npz"))
+    index = VOCAnnotationIndex.build(annotation_paths, cache_path=cache_path, n_workers=0)
+    # Same files in other order are not parsed again, but rows follow new order.
+    reordered_index = VOCAnnotationIndex.build(annotation_paths[::-1], cache_path=cache_path, n_workers=2)
+    for row, annotation_path in enumerate(annotation_paths[::-1]):
+        assert np.array_equal(reordered_index.get_by_row(row).boxes, index[annotation_path].boxes)
+        assert reordered_index.get_by_row(row).names.tolist() == index[annotation_path].names.tolist()
+
+
+def test_voc_dataset_with_index(tmp_path):
+    dataset = VOCDataset.create("test/dataset/test_images", annotations_path, transforms=None,
+                                class_index_dict=class_index_dict)
+    indexed_dataset = VOCDataset.create("test/dataset/test_images", annotations_path, transforms=None,
+                                        class_index_dict=class_index_dict,
+                                        annotation_index_path=str(tmp_path.joinpath("index.npz")))
+    for i in range(len(dataset)):
+        assert np.allclose(indexed_dataset[i][1], dataset[i][1])
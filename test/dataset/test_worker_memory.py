@@ -0,0 +1,59 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from deepext_with_lightning.dataset import classification
+from deepext_with_lightning.dataset.classification import CSVAnnotationDataset
+from deepext_with_lightning.dataset.common import StringArray
+
+SMAPS_ROLLUP_PATH = "/proc/self/smaps_rollup"
+
+
+def _private_memory_kb() -> int:
+    with open(SMAPS_ROLLUP_PATH) as file:
+        return sum([int(line.split()[1]) for line in file if line.startswith(("Private_Clean", "Private_Dirty"))])
+
+
+def _collate_memory(batch):
+    return os.getpid(), _private_memory_kb()
+
+
+def test_string_array():
+    strings = ["a", "", "ああ", "abc"]
+    string_array = StringArray(strings)
+    assert len(string_array) == 4 and string_array.tolist() == strings
+    assert string_array[-1] == "abc"
+    assert string_array[np.array([3, 2, 2])].tolist() == ["abc", "ああ", "ああ"]
+    assert string_array[1:3].tolist() == ["", "ああ"]
+    assert string_array[np.array([True, False, False, True])].tolist() == ["a", "abc"]
+    assert len(StringArray()) == 0 and StringArray()[np.array([], dtype=np.int64)].tolist() == []
+
+
+@pytest.mark.skipif(not os.path.exists(SMAPS_ROLLUP_PATH), reason="Linux only")
+def test_worker_memory_growth(monkeypatch):
+    """
+    Private memory of forked workers must not grow with dataset size while an epoch.
+    (List of 300000 str grows about 10MB by updating reference counts.)
+    """
+    n_samples = 300000
+    # Measure file list only.
+    monkeypatch.setattr(classification, "open_image", lambda *args, **kwargs: Image.new("RGB", (1, 1)))
+    dataset = CSVAnnotationDataset.from_arrays("images", np.array([f"image_{i:08d}.jpg" for i in range(n_samples)]),
+                                               np.arange(n_samples) % 10, transforms=None)
+    data_loader = DataLoader(dataset, batch_size=n_samples // 10, num_workers=2, collate_fn=_collate_memory,
+                             multiprocessing_context="fork")
+    memory_by_worker = {}
+    # Objects of other tests are not touched by gc in workers.
+    gc.freeze()
+    try:
+        for pid, memory_kb in data_loader:
+            memory_by_worker.setdefault(pid, []).append(memory_kb)
+    finally:
+        gc.unfreeze()
+    # First batch of each worker includes warm-up allocation.
+    for memory_ls in memory_by_worker.values():
+        assert memory_ls[-1] - memory_ls[1] < 4 * 1024, memory_ls
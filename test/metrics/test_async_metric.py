@@ -0,0 +1,49 @@
+import pickle
+import warnings
+
+warnings.simplefilter('ignore')
+
+import numpy as np
+import pytest
+
+from deepext_with_lightning.metrics.async_metric import AsyncMetric
+from deepext_with_lightning.metrics.object_detection import MeanAveragePrecision
+from test.metrics.test_detection_metrics import _generate_random_detections
+
+n_classes = 3
+
+
+def test_async_metric_same_as_sync():
+    random_preds, random_targets = _generate_random_detections(n_images=32, n_classes=n_classes)
+    metric = MeanAveragePrecision(n_classes, by_classes=True)
+    async_metric = AsyncMetric(MeanAveragePrecision(n_classes, by_classes=True), max_queue_size=2)
+    for i in range(0, 32, 4):
+        metric(random_preds[i:i + 4], random_targets[i:i + 4])
+        async_metric(random_preds[i:i + 4], random_targets[i:i + 4])
+    expected = metric.compute()
+    assert np.allclose(async_metric.compute(), expected)
+    async_metric.reset()
+    async_metric(random_preds, random_targets)
+    assert np.allclose(async_metric.compute(), expected)
+
+
+def test_async_metric_error():
+    async_metric = AsyncMetric(MeanAveragePrecision(n_classes))
+    async_metric(None, None)
+    with pytest.raises(Exception):
+        async_metric.compute()
+    # Usable after error is raised.
+    random_preds, random_targets = _generate_random_detections(n_images=4, n_classes=n_classes)
+    async_metric(random_preds, random_targets)
+    assert async_metric.compute() >= 0
+
+
+def test_async_metric_pickle():
+    random_preds, random_targets = _generate_random_detections(n_images=4, n_classes=n_classes)
+    async_metric = AsyncMetric(MeanAveragePrecision(n_classes))
+    async_metric(random_preds, random_targets)
+    restored_metric = pickle.loads(pickle.dumps(async_metric))
+    assert restored_metric.compute() == async_metric.compute()
+    restored_metric.reset()
+    restored_metric(random_preds, random_targets)
+    assert restored_metric.compute() > 0
@@ -3,7 +3,8 @@ import torch
 
 warnings.simplefilter('ignore')
 
-from deepext_with_lightning.metrics.classification import ClassificationAccuracy, ClassificationRecallPrecision
+from deepext_with_lightning.metrics.classification import ClassificationAccuracy, ClassificationRecallPrecision, \
+    ClassificationConfusionMatrix, ClassificationMetricCollection
 
 n_classes = 3
 
@@ -85,3 +86,26 @@ def test_recall_precision_by_classes():
     recall, precision = metric.compute()
     assert recall.shape == (n_classes,)
     assert precision.shape == (n_classes,)
+
+
+def test_classification_metric_collection():
+    metric = ClassificationMetricCollection(n_classes, average=True)
+    metric(preds, targets)
+    metric_value = metric.compute()
+    expected_recall = (1. + 0. + 1 / 2) / 3
+    expected_precision = (1. + 0 + 1 / 3) / 3
+    expected_f_score = (1. + 0. + 2 * (1 / 2) * (1 / 3) / (1 / 2 + 1 / 3)) / 3
+    assert abs(metric_value["acc"].item() - expected_recall) < 1e-6
+    assert abs(metric_value["recall"].item() - expected_recall) < 1e-6
+    assert abs(metric_value["precision"].item() - expected_precision) < 1e-6
+    assert abs(metric_value["f_score"].item() - expected_f_score) < 1e-6
+
+
+def test_confusion_matrix_same_as_loop():
+    random_preds, random_targets = torch.randint(0, n_classes, [100]), torch.randint(0, n_classes, [100])
+    metric = ClassificationConfusionMatrix(n_classes)
+    metric(random_preds, random_targets)
+    expected = torch.zeros((n_classes, n_classes))
+    for i in range(random_preds.shape[0]):
+        expected[random_preds[i], random_targets[i]] += 1
+    assert torch.equal(metric.compute(), expected)
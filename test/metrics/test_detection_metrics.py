@@ -3,8 +3,13 @@ import warnings
 warnings.simplefilter('ignore')
 
 import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
-from deepext_with_lightning.metrics.object_detection import DetectionIoU, RecallPrecision, MeanAveragePrecision
+from deepext_with_lightning.metrics.object_detection import DetectionIoU, RecallPrecision, MeanAveragePrecision, \
+    StreamingMeanAveragePrecision, calc_bbox_overlap_union_iou, calc_bbox_overlap_union_iou_matrix, match_bboxes, \
+    match_batch_bboxes, COCO_IOU_THRESHOLDS
 
 n_classes = 3
 
@@ -78,3 +83,183 @@ def test_mAP_by_classes():
     metric(preds, teachers)
     metric_value = metric.compute()
     assert isinstance(metric_value, list)
+
+
+def test_coco_style_mAP():
+    metric = MeanAveragePrecision(n_classes, iou_thresholds=COCO_IOU_THRESHOLDS)
+    metric(preds, teachers)
+    result = metric.compute()
+    assert set(result.keys()) == {"map", "map_50", "map_75", "map_small", "map_medium", "map_large"}
+
+    legacy_metric = MeanAveragePrecision(n_classes)
+    legacy_metric(preds, teachers)
+    assert abs(result["map_50"] - legacy_metric.compute()) < 1e-8
+    assert result["map"] <= result["map_50"]
+    # Every bounding box of test data is medium size.
+    assert abs(result["map_medium"] - result["map"]) < 1e-8
+    assert np.isnan(result["map_small"]) and np.isnan(result["map_large"])
+
+
+def test_coco_style_mAP_by_classes():
+    metric = MeanAveragePrecision(n_classes, by_classes=True, iou_thresholds=COCO_IOU_THRESHOLDS)
+    metric(preds, teachers)
+    result = metric.compute()
+    assert len(result["map"]) == n_classes and len(result["map_75"]) == n_classes
+
+
+def test_iou_matrix():
+    overlap, union, iou = calc_bbox_overlap_union_iou_matrix(preds[0], teachers[0])
+    assert iou.shape == (preds.shape[1], teachers.shape[1])
+    for i in range(preds.shape[1]):
+        for j in range(teachers.shape[1]):
+            expected_overlap, expected_union, expected_iou = calc_bbox_overlap_union_iou(preds[0][i], teachers[0][j])
+            assert abs(overlap[i, j] - expected_overlap) < 1e-6
+            assert abs(union[i, j] - expected_union) < 1e-6
+            assert abs(iou[i, j] - expected_iou) < 1e-6
+
+
+def test_match_bboxes():
+    matched_indices = match_bboxes(preds[0], teachers[0])
+    assert matched_indices.tolist() == [0, -1, 1, -1, 2, -1, -1]
+
+
+def test_match_bboxes_by_score_order():
+    # Both predictions overlap same target, higher score prediction wins.
+    pred_bboxes = np.array([
+        [0, 0, 50, 50, 0, 0.6],
+        [1, 1, 51, 51, 0, 0.9],
+        [1, 1, 51, 51, 1, 0.8],
+    ])
+    target_bboxes = np.array([[0, 0, 50, 50, 0]])
+    matched_indices = match_bboxes(pred_bboxes, target_bboxes)
+    assert matched_indices.tolist() == [-1, 0, -1]
+
+
+def test_match_bboxes_multi_threshold():
+    random_preds, random_targets = _generate_random_detections(n_images=4, n_classes=n_classes)
+    for pred_bboxes, target_bboxes in zip(random_preds, random_targets):
+        target_bboxes = target_bboxes[target_bboxes[:, 4] >= 0]
+        matched_indices = match_bboxes(pred_bboxes, target_bboxes, iou_threshold=COCO_IOU_THRESHOLDS)
+        assert matched_indices.shape == (len(COCO_IOU_THRESHOLDS), pred_bboxes.shape[0])
+        for i, threshold in enumerate(COCO_IOU_THRESHOLDS):
+            assert matched_indices[i].tolist() == match_bboxes(pred_bboxes, target_bboxes, threshold).tolist()
+
+
+def _generate_random_detections(n_images: int, n_classes: int, seed: int = 0):
+    random_state = np.random.RandomState(seed)
+    random_preds, random_targets = [], np.full([n_images, 20, 5], -1.)
+    for i in range(n_images):
+        n_bboxes = random_state.randint(1, 20)
+        xy = random_state.uniform(0, 400, [n_bboxes, 2])
+        bboxes = np.concatenate([xy, xy + random_state.uniform(10, 80, [n_bboxes, 2]),
+                                 random_state.randint(0, n_classes, [n_bboxes, 1])], axis=1)
+        random_targets[i, :n_bboxes] = bboxes
+        pred = np.concatenate([bboxes[:, :4] + random_state.normal(0, 8, [n_bboxes, 4]), bboxes[:, 4:],
+                               random_state.uniform(0, 1, [n_bboxes, 1])], axis=1)
+        random_preds.append(pred[np.argsort(-pred[:, 5])])
+    return random_preds, random_targets
+
+
+def _map_ddp_worker(rank: int, world_size: int, init_file: str, out_dir: str):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    random_preds, random_targets = _generate_random_detections(n_images=6, n_classes=n_classes)
+    # Each process has different detection count.
+    metric = MeanAveragePrecision(n_classes, by_classes=True, initial_capacity=4)
+    metric(random_preds[rank::world_size], random_targets[rank::world_size])
+    np.save(f"{out_dir}/{rank}.npy", np.array(metric.compute()))
+    dist.destroy_process_group()
+
+
+def test_mAP_ddp(tmp_path):
+    world_size = 2
+    mp.spawn(_map_ddp_worker, args=(world_size, str(tmp_path / "init"), str(tmp_path)), nprocs=world_size)
+
+    random_preds, random_targets = _generate_random_detections(n_images=6, n_classes=n_classes)
+    metric = MeanAveragePrecision(n_classes, by_classes=True)
+    metric(random_preds, random_targets)
+    expected = np.array(metric.compute())
+    for rank in range(world_size):
+        assert np.allclose(np.load(str(tmp_path / f"{rank}.npy")), expected)
+
+
+def test_mAP_buffer_growth_and_reset():
+    metric = MeanAveragePrecision(n_classes, by_classes=True, initial_capacity=2)
+    metric(preds, teachers)
+    capacity = metric.score_buffer.shape[0]
+    assert capacity >= preds.shape[1]
+    expected = metric.compute()
+    assert int(metric.detection_count) == 0 and metric.score_buffer.shape[0] == capacity
+    metric(preds, teachers)
+    assert metric.compute() == expected
+
+
+def test_streaming_mAP_approximation():
+    random_preds, random_targets = _generate_random_detections(n_images=200, n_classes=n_classes)
+    exact_metric = MeanAveragePrecision(n_classes, iou_thresholds=COCO_IOU_THRESHOLDS)
+    exact_metric(random_preds, random_targets)
+    expected = exact_metric.compute()
+
+    metric = StreamingMeanAveragePrecision(n_classes, iou_thresholds=COCO_IOU_THRESHOLDS, n_score_bins=1000)
+    histogram_shape = metric.score_histogram.shape
+    # Memory does not depend on detection count.
+    for i in range(0, len(random_preds), 50):
+        metric(random_preds[i:i + 50], random_targets[i:i + 50])
+    assert metric.score_histogram.shape == histogram_shape
+    result = metric.compute()
+    for key in expected.keys():
+        assert np.isnan(expected[key]) == np.isnan(result[key])
+        if not np.isnan(expected[key]):
+            assert abs(result[key] - expected[key]) < 1e-3
+
+
+def test_streaming_mAP_by_classes():
+    metric = StreamingMeanAveragePrecision(n_classes, by_classes=True, n_score_bins=20)
+    metric(preds, teachers)
+    exact_metric = MeanAveragePrecision(n_classes, by_classes=True)
+    exact_metric(preds, teachers)
+    result, expected = metric.compute(), exact_metric.compute()
+    # Scores of class 0 and 2 fall into different bins, so they are exact.
+    assert np.allclose([result[0], result[2]], [expected[0], expected[2]])
+    # Tied scores of class 1 (FP and TP with 0.6) are one point in histogram, exact mode depends on input order.
+    assert abs(result[1] - 1 / 3) < 1e-8
+
+
+def _to_padded_tensor(random_preds):
+    max_count = max([pred.shape[0] for pred in random_preds])
+    padded_preds = torch.full([len(random_preds), max_count, 6], -1.)
+    for i, pred in enumerate(random_preds):
+        padded_preds[i, :pred.shape[0]] = torch.tensor(pred)
+    return padded_preds
+
+
+def test_match_batch_bboxes():
+    random_preds, random_targets = _generate_random_detections(n_images=8, n_classes=n_classes)
+    # Duplicated predictions compete for the same target.
+    random_preds = [np.concatenate([pred, pred + np.array([3., -3., 3., -3., 0., -0.01])]) for pred in random_preds]
+    matched_indices = match_batch_bboxes(_to_padded_tensor(random_preds), torch.tensor(random_targets),
+                                         torch.tensor(COCO_IOU_THRESHOLDS))
+    for i, (pred_bboxes, target_bboxes) in enumerate(zip(random_preds, random_targets)):
+        expected = match_bboxes(pred_bboxes, target_bboxes[target_bboxes[:, 4] >= 0], COCO_IOU_THRESHOLDS)
+        assert matched_indices[i, :, :pred_bboxes.shape[0]].tolist() == expected.tolist()
+        assert (matched_indices[i, :, pred_bboxes.shape[0]:] == -1).all()
+
+
+def test_tensor_metrics_same_as_numpy():
+    random_preds, random_targets = _generate_random_detections(n_images=8, n_classes=n_classes)
+    padded_preds, targets = _to_padded_tensor(random_preds), torch.tensor(random_targets)
+    for metric_class, kwargs in [(DetectionIoU, {}), (RecallPrecision, {}), (MeanAveragePrecision, {}),
+                                 (MeanAveragePrecision, {"iou_thresholds": COCO_IOU_THRESHOLDS}),
+                                 (StreamingMeanAveragePrecision, {"iou_thresholds": COCO_IOU_THRESHOLDS})]:
+        numpy_metric, tensor_metric = metric_class(n_classes, by_classes=True, **kwargs), metric_class(
+            n_classes, by_classes=True, **kwargs)
+        numpy_metric(random_preds, random_targets)
+        tensor_metric(padded_preds, targets)
+        expected, result = numpy_metric.compute(), tensor_metric.compute()
+        if isinstance(expected, dict):
+            expected, result = list(expected.values()), list(result.values())
+        elif isinstance(expected, tuple):
+            expected, result = torch.stack(expected).numpy(), torch.stack(result).numpy()
+        elif isinstance(expected, torch.Tensor):
+            expected, result = expected.numpy(), result.numpy()
+        assert np.allclose(np.array(result, dtype=np.float64), np.array(expected, dtype=np.float64), atol=1e-5,
+                           equal_nan=True)
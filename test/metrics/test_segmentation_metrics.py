@@ -4,7 +4,7 @@ warnings.simplefilter('ignore')
 
 import torch
 
-from deepext_with_lightning.metrics.segmentation import SegmentationIoU
+from deepext_with_lightning.metrics.segmentation import SegmentationIoU, SegmentationMetrics
 
 n_classes = 3
 a = torch.tensor([[[1, 0, 1, 0], [2, 2, 0, 0], [0, 0, 1, 2]]])
@@ -35,3 +35,38 @@ def test_segmentation_iou_by_classes():
     metric(a, b)
     metric_value = metric.compute()
     assert metric_value.shape == (n_classes,)
+
+
+def test_segmentation_iou_same_as_per_class_count():
+    random_state = torch.random.manual_seed(0)
+    preds = torch.randint(0, n_classes, [4, 32, 32], generator=random_state)
+    targets = torch.randint(0, n_classes, [4, 32, 32], generator=random_state)
+    metric = SegmentationIoU(n_classes=n_classes, by_classes=True)
+    metric(preds, targets)
+    metric_value = metric.compute()
+    for label_val in range(n_classes):
+        overlap = torch.count_nonzero((preds == label_val) & (targets == label_val))
+        union = torch.count_nonzero((preds == label_val) | (targets == label_val))
+        assert abs(metric_value[label_val].item() - overlap.item() / union.item()) < 1e-6
+
+
+def test_segmentation_iou_ignore_index():
+    ignored_targets = b.clone()
+    ignored_targets[0, 0] = 255
+    metric = SegmentationIoU(n_classes=n_classes, ignore_index=255)
+    metric(a, ignored_targets)
+    assert metric.confusion_matrix.sum() == a.numel() - a.shape[2]
+
+
+def test_segmentation_metrics():
+    metric = SegmentationMetrics(n_classes=n_classes)
+    metric(a, b)
+    metric_value = metric.compute()
+    # a is prediction, b is target.
+    assert abs(metric_value["pixel_accuracy"].item() - 9 / 12) < 1e-6
+    assert abs(metric_value["recall"].item() - (5 / 6 + 2 / 4 + 2 / 2) / 3) < 1e-6
+    assert abs(metric_value["dice"].item() - (10 / 12 + 4 / 7 + 4 / 5) / 3) < 1e-6
+
+    iou_metric = SegmentationIoU(n_classes=n_classes)
+    iou_metric(a, b)
+    assert abs(metric_value["iou"].item() - iou_metric.compute().item()) < 1e-6
@@ -1,5 +1,7 @@
 import warnings
 
+import torch
+
 warnings.simplefilter('ignore')
 
 from deepext_with_lightning.image_process.convert import try_cuda
@@ -67,3 +69,32 @@ def _test_attention_classification(model: AttentionClassificationModel, batch_si
     assert_tensor_shape(labels, expected_label_tensor_shape, "output label shape")
     assert_tensor_shape(probs, expected_prob_tensor_shape, "output prob shape")
     assert len(attention_map.shape) == expected_attention_shape_length
+
+
+def test_uint8_input_and_export(tmp_path):
+    model = try_cuda(MobileNetV3(n_classes, pretrained=False))
+    model.set_input_normalization(mean=[0.4, 0.45, 0.5], std=[0.2, 0.25, 0.3])
+    model.eval()
+    images = torch.randint(0, 256, (2, 3) + image_size, dtype=torch.uint8)
+    labels, probs = model.predict_label(images)
+    _, float_probs = model.predict_label(images.float() / 255.)
+    assert torch.allclose(probs, float_probs, atol=1e-5)
+    # Normalization is included in exported model.
+    model.save_model_for_mobile(image_size[1], image_size[0], str(tmp_path.joinpath("model.pt")), uint8_input=True)
+    exported_model = torch.jit.load(str(tmp_path.joinpath("model.pt")))
+    assert torch.allclose(exported_model(images), model(images), atol=1e-5)
+
+
+def test_input_normalization_in_checkpoint():
+    model = MobileNetV3(n_classes, pretrained=False)
+    model.set_input_normalization(mean=[0.4, 0.45, 0.5], std=[0.2, 0.25, 0.3])
+    state_dict = model.state_dict()
+    loaded_model = MobileNetV3(n_classes, pretrained=False)
+    loaded_model.load_state_dict(state_dict)
+    assert torch.allclose(loaded_model.input_normalization.mean, model.input_normalization.mean)
+    assert torch.allclose(loaded_model.input_normalization.std, model.input_normalization.std)
+    # Checkpoint saved before normalization was stored.
+    old_state_dict = {key: value for key, value in state_dict.items() if not key.startswith("input_normalization.")}
+    old_model = MobileNetV3(n_classes, pretrained=False)
+    old_model.load_state_dict(old_state_dict)
+    assert old_model.input_normalization.mean.flatten().tolist() == [0.]
@@ -2,8 +2,15 @@ import warnings
 
 warnings.simplefilter('ignore')
 
+import torch
+from torchvision.ops import nms
+
 from deepext_with_lightning.image_process.convert import try_cuda
 from deepext_with_lightning.models.object_detection import EfficientDetector
+from deepext_with_lightning.models.object_detection.efficientdet.efficientdet_lib.models.losses import calc_iou, \
+    FocalLoss, NegativeFocalLossImplementation
+from deepext_with_lightning.models.object_detection.efficientdet.efficientdet_lib.models.module import Anchors, \
+    anchors_for_shape
 from test.utils import gen_random_tensor, assert_tensor_shape
 
 n_classes = 10
@@ -38,3 +45,133 @@ def test_efficientdet_with_2scale():
 
     assert result[0].ndim == 2 and result[0].shape[
         -1] == 6, "Detection model result must contain (xmin, ymin, xmax, ymax, class, score)"
+
+
+def test_efficientdet_batched_nms():
+    model: EfficientDetector = try_cuda(EfficientDetector(n_classes=4, score_threshold=0.5, backbone_pretrained=False,
+                                                          max_detections=20, pre_nms_top_k=300))
+    efficientdet = model._model.eval()
+    test_image = try_cuda(gen_random_tensor(3, (128, 128)))
+    # Random head outputs, so scores are not tied.
+    n_anchors = efficientdet.anchors(test_image).shape[1]
+    classification = try_cuda(torch.rand(3, n_anchors, 4))
+    regression = try_cuda(torch.randn(3, n_anchors, 4) * 0.5)
+    efficientdet._head = lambda inputs: (classification[:inputs.shape[0]], regression[:inputs.shape[0]])
+    with torch.no_grad():
+        result = efficientdet.detect(test_image)
+        pre_nms_results = efficientdet.forward_pre_nms(test_image)
+    assert_tensor_shape(result, (3, 20, 6), "Padded detections")
+    for i, (scores, labels, bboxes) in enumerate(pre_nms_results):
+        top_k = scores.argsort(descending=True)[:300]
+        scores, labels, bboxes = scores[top_k], labels[top_k], bboxes[top_k]
+        keep = torch.cat([(labels == label).nonzero()[:, 0][nms(bboxes[labels == label], scores[labels == label], 0.5)]
+                          for label in labels.unique()])
+        keep = keep[scores[keep].argsort(descending=True)][:20]
+        expected = torch.cat([bboxes[keep], labels[keep, None].float(), scores[keep, None]], dim=1)
+        assert torch.allclose(result[i, :keep.shape[0]], expected)
+        assert (result[i, keep.shape[0]:, 4] == -1).all()
+
+
+def test_cached_anchors():
+    anchors = Anchors(cache_size=2)
+    for height, width in [(128, 128), (97, 333), (128, 128)]:
+        expected = anchors_for_shape((height, width), anchors.pyramid_levels, anchors.ratios, anchors.scales,
+                                     anchors.strides, anchors.sizes)
+        result = anchors(torch.zeros(1, 3, height, width))
+        assert torch.equal(result[0], torch.from_numpy(expected).float())
+    # Same tensor while cached.
+    assert anchors(torch.zeros(1, 3, 128, 128)) is result and len(anchors._cache) == 2
+    anchors.fix_image_size(64, 64)
+    assert anchors(torch.zeros(1, 3, 64, 64)) is anchors.fixed_anchors
+
+
+def test_efficientdet_training_step():
+    model: EfficientDetector = try_cuda(EfficientDetector(n_classes=4, backbone_pretrained=False))
+    images = torch.rand(2, 3, 128, 128)
+    # Second image has no bounding box.
+    targets = torch.tensor([[[10., 10., 60., 70., 1.], [40., 30., 120., 100., 3.]],
+                            [[-1., -1., -1., -1., -1.], [-1., -1., -1., -1., -1.]]])
+    loss = model.training_step((images, targets), 0)["loss"]
+    loss.backward()
+    assert torch.isfinite(loss) and loss.item() > 0
+    assert all([torch.isfinite(param.grad).all() for param in model.parameters() if param.grad is not None])
+
+
+def _reference_focal_loss(classifications, regressions, anchors, annotations, alpha=0.25, gamma=2.0):
+    """
+    Previous implementation of FocalLoss (loop by image and dense -1/0/1 targets).
+    """
+    anchor = anchors[0]
+    anchor_widths, anchor_heights = anchor[:, 2] - anchor[:, 0], anchor[:, 3] - anchor[:, 1]
+    anchor_ctr_x, anchor_ctr_y = anchor[:, 0] + 0.5 * anchor_widths, anchor[:, 1] + 0.5 * anchor_heights
+    classification_losses, regression_losses = [], []
+    for classification, regression, bbox_annotation in zip(classifications, regressions, annotations):
+        bbox_annotation = bbox_annotation[bbox_annotation[:, 4] != -1]
+        if bbox_annotation.shape[0] == 0:
+            classification_losses.append(classifications.new_zeros([]))
+            regression_losses.append(classifications.new_zeros([]))
+            continue
+        classification = torch.clamp(classification, 1e-4, 1.0 - 1e-4)
+        IoU_max, IoU_argmax = torch.max(calc_iou(anchor, bbox_annotation[:, :4]), dim=1)
+        targets = torch.full(classification.shape, -1.)
+        targets[torch.lt(IoU_max, 0.4), :] = 0
+        positive_indices = torch.ge(IoU_max, 0.5)
+        num_positive_anchors = positive_indices.sum()
+        assigned_annotations = bbox_annotation[IoU_argmax, :]
+        targets[positive_indices, :] = 0
+        targets[positive_indices, assigned_annotations[positive_indices, 4].long()] = 1
+        alpha_factor = torch.where(torch.eq(targets, 1.), alpha, 1. - alpha)
+        focal_weight = alpha_factor * torch.pow(torch.where(torch.eq(targets, 1.), 1. - classification,
+                                                            classification), gamma)
+        bce = -(targets * torch.log(classification) + (1.0 - targets) * torch.log(1.0 - classification))
+        cls_loss = torch.where(torch.ne(targets, -1.0), focal_weight * bce, torch.zeros_like(bce))
+        classification_losses.append(cls_loss.sum() / torch.clamp(num_positive_anchors.float(), min=1.0))
+
+        assigned_annotations = assigned_annotations[positive_indices, :]
+        gt_widths = assigned_annotations[:, 2] - assigned_annotations[:, 0]
+        gt_heights = assigned_annotations[:, 3] - assigned_annotations[:, 1]
+        gt_ctr_x = assigned_annotations[:, 0] + 0.5 * gt_widths
+        gt_ctr_y = assigned_annotations[:, 1] + 0.5 * gt_heights
+        gt_widths, gt_heights = torch.clamp(gt_widths, min=1), torch.clamp(gt_heights, min=1)
+        targets = torch.stack((
+            (gt_ctr_x - anchor_ctr_x[positive_indices]) / anchor_widths[positive_indices],
+            (gt_ctr_y - anchor_ctr_y[positive_indices]) / anchor_heights[positive_indices],
+            torch.log(gt_widths / anchor_widths[positive_indices]),
+            torch.log(gt_heights / anchor_heights[positive_indices]))).t() / torch.tensor([[0.1, 0.1, 0.2, 0.2]])
+        regression_diff = torch.abs(targets - regression[positive_indices, :])
+        regression_loss = torch.where(torch.le(regression_diff, 1.0 / 9.0), 0.5 * 9.0 * torch.pow(regression_diff, 2),
+                                      regression_diff - 0.5 / 9.0)
+        regression_losses.append(regression_loss.mean() if positive_indices.any() else classifications.new_zeros([]))
+    return torch.stack(classification_losses).mean(dim=0, keepdim=True), \
+           torch.stack(regression_losses).mean(dim=0, keepdim=True)
+
+
+def test_focal_loss_same_as_previous():
+    torch.manual_seed(0)
+    anchors = Anchors()(torch.zeros(1, 3, 128, 128))
+    classifications = torch.rand(3, anchors.shape[1], 4).requires_grad_()
+    regressions = torch.randn(3, anchors.shape[1], 4).requires_grad_()
+    # Boxes near anchors (positive), shifted boxes (ignored and negative), padding, and image without box.
+    annotations = torch.full([3, 4, 5], -1.)
+    annotations[0, 0] = torch.cat([anchors[0, 100], torch.tensor([1.])])
+    annotations[0, 1] = torch.tensor([20., 30., 90., 100., 3.])
+    annotations[1, :3] = torch.tensor([[10., 10., 60., 70., 0.], [40., 30., 120., 100., 2.], [0., 64., 32., 96., 1.]])
+    IoU_max = calc_iou(anchors[0], annotations[:2, :, :4]).masked_fill(annotations[:2, None, :, 4] == -1, -1).amax(2)
+    assert (IoU_max >= 0.5).any() and ((IoU_max >= 0.4) & (IoU_max < 0.5)).any() and (IoU_max < 0.4).any()
+
+    losses = FocalLoss()(classifications, regressions, anchors, annotations)
+    grads = torch.autograd.grad(sum(loss.sum() for loss in losses), [classifications, regressions])
+    expected_losses = _reference_focal_loss(classifications, regressions, anchors, annotations)
+    expected_grads = torch.autograd.grad(sum(loss.sum() for loss in expected_losses), [classifications, regressions])
+    for loss, expected_loss in zip(losses, expected_losses):
+        assert torch.allclose(loss, expected_loss, rtol=1e-4)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, rtol=1e-4, atol=1e-7)
+
+
+def test_negative_focal_loss_gradcheck():
+    torch.manual_seed(0)
+    # Inside of clamp range, where gradient is not zero.
+    classifications = (torch.rand(2, 5, 3, dtype=torch.float64) * 0.98 + 0.01).requires_grad_()
+    assert torch.autograd.gradcheck(lambda inputs: NegativeFocalLossImplementation.apply(inputs, 2.0),
+                                    (classifications,))
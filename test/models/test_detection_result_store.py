@@ -0,0 +1,107 @@
+import os
+import warnings
+
+warnings.simplefilter('ignore')
+
+import numpy as np
+import torch
+
+from deepext_with_lightning.models.object_detection import EfficientDetector
+from deepext_with_lightning.models.object_detection.result_store import DetectionResultWriter, DetectionResultStore, \
+    postprocess_raw_detections, sweep_detection_results
+
+n_classes = 3
+
+
+def _generate_raw_detections(n_images: int, seed: int = 0):
+    random_state = np.random.RandomState(seed)
+    raw_detections, targets = [], np.full([n_images, 10, 5], -1., dtype=np.float32)
+    for i in range(n_images):
+        n_bboxes = random_state.randint(1, 10)
+        xy = random_state.uniform(0, 400, [n_bboxes, 2])
+        bboxes = np.concatenate([xy, xy + random_state.uniform(20, 80, [n_bboxes, 2])], axis=1)
+        labels = random_state.randint(0, n_classes, n_bboxes)
+        targets[i, :n_bboxes, :4], targets[i, :n_bboxes, 4] = bboxes, labels
+        # Several noisy candidates by target like outputs before NMS.
+        boxes = np.repeat(bboxes, 5, axis=0) + random_state.normal(0, 5, [n_bboxes * 5, 4])
+        raw_detections.append((random_state.uniform(0, 1, n_bboxes * 5).astype(np.float32),
+                               np.repeat(labels, 5).astype(np.int32), boxes.astype(np.float32)))
+    return raw_detections, targets
+
+
+def test_store_chunks(tmp_path):
+    raw_detections, targets = _generate_raw_detections(n_images=10)
+    with DetectionResultWriter(str(tmp_path), chunk_size=4) as writer:
+        writer.append(raw_detections[:7], targets[:7])
+        writer.append(raw_detections[7:], targets[7:])
+    store = DetectionResultStore(str(tmp_path))
+    assert len(store) == 10
+
+    i = 0
+    for chunk_raw_detections, chunk_targets in store.chunks():
+        for (scores, labels, boxes), target in zip(chunk_raw_detections, chunk_targets):
+            assert np.array_equal(scores, raw_detections[i][0]) and np.array_equal(labels, raw_detections[i][1])
+            assert np.array_equal(boxes, raw_detections[i][2])
+            assert np.array_equal(target[target[:, 4] >= 0], targets[i][targets[i][:, 4] >= 0])
+            i += 1
+    assert i == 10
+
+
+def test_write_twice(tmp_path):
+    raw_detections, targets = _generate_raw_detections(n_images=10)
+    with DetectionResultWriter(str(tmp_path), chunk_size=4) as writer:
+        writer.append(raw_detections, targets)
+    # Results of previous run are replaced by default.
+    with DetectionResultWriter(str(tmp_path), chunk_size=4) as writer:
+        writer.append(raw_detections[:3], targets[:3])
+    assert len(DetectionResultStore(str(tmp_path))) == 3
+
+    # Appended after max index even if numbering has gaps.
+    os.rename(str(tmp_path.joinpath("chunk_00000.npz")), str(tmp_path.joinpath("chunk_00002.npz")))
+    with DetectionResultWriter(str(tmp_path), chunk_size=4, append=True) as writer:
+        writer.append(raw_detections[3:5], targets[3:5])
+    assert sorted(os.listdir(str(tmp_path))) == ["chunk_00002.npz", "chunk_00003.npz"]
+    store_raw_detections = [raw_detection for chunk_raw_detections, _ in DetectionResultStore(str(tmp_path)).chunks()
+                            for raw_detection in chunk_raw_detections]
+    assert len(store_raw_detections) == 5
+    for (scores, _, _), (expected_scores, _, _) in zip(store_raw_detections, raw_detections[:5]):
+        assert np.array_equal(scores, expected_scores)
+
+
+def test_postprocess_raw_detections():
+    raw_detections, _ = _generate_raw_detections(n_images=1)
+    result = postprocess_raw_detections(raw_detections[0], score_threshold=0.3, nms_iou_threshold=0.5,
+                                        max_detections=3)
+    assert result.shape[0] <= 3 and result.shape[1] == 6
+    assert np.all(result[:, 5] > 0.3) and np.all(np.diff(result[:, 5]) <= 0)
+
+
+def test_postprocess_same_as_detect():
+    model = EfficientDetector(n_classes=4, score_threshold=0.5, backbone_pretrained=False, max_detections=20,
+                              pre_nms_top_k=100)
+    images = torch.rand(2, 3, 128, 128)
+    # Random head outputs, so scores are not tied.
+    n_anchors = model._model.anchors(images).shape[1]
+    classification, regression = torch.rand(2, n_anchors, 4), torch.randn(2, n_anchors, 4) * 0.5
+    model._model._head = lambda inputs: (classification, regression)
+    expected = model.predict_bboxes(images)
+    raw_detections = model.predict_raw_detections(images, score_threshold=0.1)
+    for raw_detection, expected_bboxes in zip(raw_detections, expected):
+        assert raw_detection[0].shape[0] == 100
+        bboxes = postprocess_raw_detections(raw_detection, score_threshold=0.5, nms_iou_threshold=0.5,
+                                            max_detections=20)
+        assert np.allclose(bboxes, expected_bboxes)
+
+
+def test_sweep(tmp_path):
+    raw_detections, targets = _generate_raw_detections(n_images=10)
+    with DetectionResultWriter(str(tmp_path), chunk_size=4) as writer:
+        writer.append(raw_detections, targets)
+    results = sweep_detection_results(str(tmp_path), n_classes, score_thresholds=[0.1, 0.5],
+                                      nms_iou_thresholds=[0.3, 0.5], max_detections_list=[5, 50], n_workers=2)
+    assert len(results) == 8
+    assert all([0 <= result["map"] <= 1 for result in results])
+    # Same results in this process.
+    assert results == sweep_detection_results(str(tmp_path), n_classes, score_thresholds=[0.1, 0.5],
+                                              nms_iou_thresholds=[0.3, 0.5], max_detections_list=[5, 50],
+                                              n_workers=0)
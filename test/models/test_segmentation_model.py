@@ -1,5 +1,7 @@
 import warnings
 
+import torch
+
 warnings.simplefilter('ignore')
 
 from deepext_with_lightning.image_process.convert import try_cuda
@@ -48,3 +50,34 @@ def _test_segmentation(model: SegmentationModel, batch_size: int, n_classes=11,
     labels, probs = model.predict_index_image(test_tensor)
     assert_tensor_shape(labels, expected_label_tensor_shape, "output label shape")
     assert_tensor_shape(probs, expected_prob_tensor_shape, "output prob shape")
+
+
+def test_batch_augmentation_in_training_step():
+    model = try_cuda(UNet(n_classes))
+    received = {}
+
+    def augmentation(images, bboxes, masks):
+        received["images"], received["masks"] = images, masks
+        return images.float() / 255., bboxes, masks.flip(-1)
+
+    model.set_batch_augmentation(augmentation)
+    images = torch.randint(0, 256, (2, 3, 64, 64), dtype=torch.uint8)
+    masks = torch.eye(n_classes)[torch.randint(0, n_classes, (2, 64, 64))].permute(0, 3, 1, 2)
+    result = model.training_step((images, masks), 0)
+    # Augmentation receives uint8 batch before conversion.
+    assert received["images"].dtype == torch.uint8 and received["masks"].shape == masks.shape
+    assert torch.equal(result["target"].cpu(), masks.flip(-1).argmax(dim=1))
+
+
+def test_index_mask_training_step():
+    model = try_cuda(UNet(n_classes))
+    images = torch.rand(2, 3, 64, 64)
+    index_masks = torch.randint(0, n_classes, (2, 64, 64), dtype=torch.uint8)
+    index_masks[:, :8] = 255
+    onehot_masks = torch.eye(n_classes)[index_masks[:, 8:].long()].permute(0, 3, 1, 2)
+    result = model.training_step((images, index_masks), 0)
+    assert torch.equal(result["target"].cpu(), index_masks.long())
+    assert torch.isfinite(result["loss"])
+    # Ignored pixels do not affect loss.
+    pred = torch.randn(2, n_classes, 64, 64)
+    assert torch.allclose(model._loss_func(pred, index_masks), model._loss_func(pred[:, :, 8:], onehot_masks))
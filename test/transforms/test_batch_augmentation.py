@@ -0,0 +1,117 @@
+import torch
+import torch.nn.functional as F
+
+from deepext_with_lightning.transforms import BatchAugmentationCompose, BatchRandomHorizontalFlip, \
+    BatchRandomVerticalFlip, BatchColorJitter, BatchRandomResizedCrop, BatchNormalize
+
+batch_size, n_classes, image_size = 8, 4, (48, 64)
+
+
+def _generate_batch(seed: int = 0):
+    """
+    :return: uint8 images, padded bounding boxes and index masks. Each class has one rectangle by image.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    height, width = image_size
+    masks = torch.zeros([batch_size, height, width], dtype=torch.int64)
+    bboxes = torch.full([batch_size, n_classes + 1, 5], -1.)
+    band_height = height // (n_classes - 1)
+    for i in range(batch_size):
+        # Rectangles in separate horizontal bands, so they do not overlap. Last 2 rows are padding.
+        for j, label in enumerate(range(1, n_classes)):
+            x_min = torch.randint(0, width - 2, [1], generator=generator).item()
+            x_max = x_min + torch.randint(2, width - x_min + 1, [1], generator=generator).item()
+            y_min = j * band_height + torch.randint(0, band_height // 2, [1], generator=generator).item()
+            y_max = y_min + torch.randint(2, band_height // 2 + 1, [1], generator=generator).item()
+            masks[i, y_min:y_max, x_min:x_max] = label
+            bboxes[i, j] = torch.tensor([x_min, y_min, x_max, y_max, label])
+    images = (masks * 60).to(torch.uint8).unsqueeze(1).repeat(1, 3, 1, 1)
+    return images, bboxes, masks
+
+
+def _bboxes_of_masks(masks_by_class: torch.Tensor) -> torch.Tensor:
+    """
+    :param masks_by_class: (batch size, classes, height, width) bool
+    :return: (batch size, classes, 4) Bounding box of each class region. -1 if region is empty.
+    """
+    result = torch.full(masks_by_class.shape[:2] + (4,), -1.)
+    for i in range(masks_by_class.shape[0]):
+        for label in range(masks_by_class.shape[1]):
+            ys, xs = torch.nonzero(masks_by_class[i, label], as_tuple=True)
+            if ys.shape[0] > 0:
+                result[i, label] = torch.tensor([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]).float()
+    return result
+
+
+def _assert_consistent(bboxes: torch.Tensor, masks_by_class: torch.Tensor, atol: float = 0.):
+    mask_bboxes = _bboxes_of_masks(masks_by_class)
+    for i in range(bboxes.shape[0]):
+        is_valid = bboxes[i, :, 4] >= 0
+        # Padding and removed bounding boxes are -1.
+        assert (bboxes[i, ~is_valid] == -1).all()
+        for bbox in bboxes[i, is_valid]:
+            assert torch.allclose(bbox[:4], mask_bboxes[i, int(bbox[4])], atol=atol), (bbox, mask_bboxes[i])
+        # Regions larger than edge error of atol have bounding box.
+        sizes = mask_bboxes[i, :, 2:] - mask_bboxes[i, :, :2]
+        for label in range(1, masks_by_class.shape[1]):
+            if (sizes[label] >= 2 * atol + 1).all():
+                assert label in bboxes[i, is_valid, 4].long().tolist()
+
+
+def test_flips():
+    images, bboxes, masks = _generate_batch()
+    one_hot_masks = F.one_hot(masks, n_classes).permute(0, 3, 1, 2)
+    for flip in [BatchRandomHorizontalFlip(p=0.5), BatchRandomVerticalFlip(p=0.5)]:
+        for target_masks in [masks, one_hot_masks]:
+            result_images, result_bboxes, result_masks = flip(images, bboxes, target_masks)
+            assert result_images.dtype == torch.uint8 and result_masks.dtype == target_masks.dtype
+            masks_by_class = F.one_hot(result_masks, n_classes).permute(0, 3, 1, 2) if result_masks.ndim == 3 \
+                else result_masks
+            _assert_consistent(result_bboxes, masks_by_class.bool())
+            assert torch.equal(result_images[:, 0], (masks_by_class.argmax(dim=1) * 60).to(torch.uint8))
+            # Padding rows are not flipped.
+            assert (result_bboxes[:, -2:] == -1).all()
+    # p=1 flips all images.
+    _, result_bboxes, result_masks = BatchRandomHorizontalFlip(p=1.)(images, bboxes, masks)
+    assert torch.equal(result_masks, masks.flip(-1))
+
+
+def test_random_resized_crop():
+    torch.manual_seed(0)
+    images, bboxes, masks = _generate_batch()
+    one_hot_masks = F.one_hot(masks, n_classes).permute(0, 3, 1, 2)
+    crop = BatchRandomResizedCrop(32, 40, scale=(0.2, 1.))
+    n_removed = 0
+    for target_masks in [masks, one_hot_masks]:
+        result_images, result_bboxes, result_masks = crop(images, bboxes, target_masks)
+        assert result_images.shape == (batch_size, 3, 32, 40) and result_images.dtype == torch.uint8
+        assert result_masks.shape[-2:] == (32, 40) and result_masks.dtype == target_masks.dtype
+        masks_by_class = F.one_hot(result_masks, n_classes).permute(0, 3, 1, 2) if result_masks.ndim == 3 \
+            else result_masks
+        # Nearest sampling of masks differs at most 1 pixel from bounding box edges.
+        _assert_consistent(result_bboxes, masks_by_class.bool(), atol=1.)
+        assert (result_bboxes[:, -2:] == -1).all()
+        n_removed += ((result_bboxes[:, :-2, 4] == -1).sum()).item()
+    # Some bounding boxes are cropped away.
+    assert n_removed > 0
+
+
+def test_color_jitter_and_normalize():
+    images, bboxes, masks = _generate_batch()
+    for target_images in [images, images.float() / 255.]:
+        result_images, result_bboxes, result_masks = BatchColorJitter(p=1.)(target_images, bboxes, masks)
+        assert result_images.dtype == torch.float32
+        assert result_images.min() >= 0. and result_images.max() <= 1.
+        assert result_bboxes is bboxes and result_masks is masks
+
+    mean, std = (0.4, 0.45, 0.5), (0.2, 0.25, 0.3)
+    result_images, _, _ = BatchNormalize(mean, std)(torch.tensor([0, 255], dtype=torch.uint8).view(1, 1, 1, 2)
+                                                     .repeat(2, 3, 1, 1))
+    expected_min = (0. - torch.tensor(mean)) / torch.tensor(std)
+    expected_max = (1. - torch.tensor(mean)) / torch.tensor(std)
+    assert torch.allclose(result_images[:, :, 0, 0], expected_min.expand(2, 3))
+    assert torch.allclose(result_images[:, :, 0, 1], expected_max.expand(2, 3))
+
+    # Compose returns float images.
+    result_images, _, _ = BatchAugmentationCompose([BatchRandomHorizontalFlip()])(images, bboxes, masks)
+    assert result_images.dtype == torch.float32 and result_images.max() <= 1.
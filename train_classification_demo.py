@@ -43,13 +43,14 @@ def build_transforms(args) -> Tuple[any, any]:
         A.CoarseDropout(max_width=int(args.image_size / 8), max_height=int(args.image_size / 8), max_holes=3, p=0.3),
         ToTensorV2(),
     ])
-    train_transforms = AlbumentationsOnlyImageWrapperTransform(train_transforms)
+    # uint8 images are transferred from workers and scaled by InputNormalization of model.
+    train_transforms = AlbumentationsOnlyImageWrapperTransform(train_transforms, is_image_normalize=False)
 
     test_transforms = A.Compose([
         A.Resize(width=args.image_size, height=args.image_size),
         ToTensorV2(),
     ])
-    test_transforms = AlbumentationsOnlyImageWrapperTransform(test_transforms)
+    test_transforms = AlbumentationsOnlyImageWrapperTransform(test_transforms, is_image_normalize=False)
     return train_transforms, test_transforms
 
 
@@ -13,7 +13,7 @@ from deepext_with_lightning.models.object_detection import EfficientDetector
 
 from deepext_with_lightning.transforms import AlbumentationsDetectionWrapperTransform
 from deepext_with_lightning.callbacks import GenerateDetectionImageCallback
-from deepext_with_lightning.dataset import VOCAnnotationTransform, AdjustDetectionTensorCollator
+from deepext_with_lightning.dataset import VOCAnnotationTransform, AdjustDetectionTensorCollator, IndexedVOCDetection
 from deepext_with_lightning.dataset.functions import label_names_to_dict
 
 from common import DETECTION_DATASET_INFO, get_logger, build_data_loader
@@ -38,28 +38,32 @@ def build_transforms(args, class_index_dict: Dict[str, int]) -> Tuple[any, any]:
             A.Blur(blur_limit=5),
         ], p=0.5),
         ToTensorV2(),
-    ], annotation_transform=VOCAnnotationTransform(class_index_dict))
+    ], annotation_transform=VOCAnnotationTransform(class_index_dict), is_image_normalize=False)
     test_transforms = AlbumentationsDetectionWrapperTransform([
         A.Resize(width=args.image_size, height=args.image_size),
         ToTensorV2(),
-    ], annotation_transform=VOCAnnotationTransform(class_index_dict))
+    ], annotation_transform=VOCAnnotationTransform(class_index_dict), is_image_normalize=False)
     return train_transforms, test_transforms
 
 
 def build_dataset(args, train_transforms, test_transforms) -> Tuple[Dataset, Dataset]:
     if args.dataset == "voc2012":
         train_dataset = torchvision.datasets.VOCDetection(root=args.dataset_root, download=True, year="2012",
-                                                          transforms=train_transforms, image_set='trainval')
+                                                          image_set='trainval')
         test_dataset = torchvision.datasets.VOCDetection(root=args.dataset_root, download=True, year="2012",
-                                                         transforms=test_transforms, image_set='val')
-        return train_dataset, test_dataset
+                                                         image_set='val')
     elif args.dataset == "voc2007":
         train_dataset = torchvision.datasets.VOCDetection(root=args.dataset_root, download=True, year="2007",
-                                                          transforms=train_transforms, image_set='train')
+                                                          image_set='train')
         test_dataset = torchvision.datasets.VOCDetection(root=args.dataset_root, download=True, year="2007",
-                                                         transforms=test_transforms, image_set='val')
-        return train_dataset, test_dataset
-    raise RuntimeError(f"Invalid dataset name: {args.dataset_root}")
+                                                         image_set='val')
+    else:
+        raise RuntimeError(f"Invalid dataset name: {args.dataset_root}")
+    # Annotations are parsed once and cached.
+    return IndexedVOCDetection(train_dataset, transforms=train_transforms,
+                               annotation_index_path=f"{args.dataset_root}/{args.dataset}_train_annotations.npz"), \
+           IndexedVOCDetection(test_dataset, transforms=test_transforms,
+                               annotation_index_path=f"{args.dataset_root}/{args.dataset}_val_annotations.npz")
 
 
 parser = argparse.ArgumentParser(description='Pytorch Image detection training.')
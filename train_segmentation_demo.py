@@ -50,14 +50,15 @@ def build_transforms(args, n_classes):
         ]),
         ToTensorV2(),
     ])
+    # Index mask and uint8 image. Boundary (255) is ignored by loss and metrics.
     train_transforms = AlbumentationsSegmentationWrapperTransform(train_transforms, class_num=n_classes,
-                                                                  ignore_indices=[255, ])
+                                                                  require_onehot=False, is_image_normalize=False)
     test_transforms = A.Compose([
         A.Resize(width=args.image_size, height=args.image_size),
         ToTensorV2(),
     ])
     test_transforms = AlbumentationsSegmentationWrapperTransform(test_transforms, class_num=n_classes,
-                                                                 ignore_indices=[255, ])
+                                                                 require_onehot=False, is_image_normalize=False)
     return train_transforms, test_transforms
 
 